@@ -1,18 +1,49 @@
 import os
+import argparse
 import re
+import sys
+import copy
+import queue
 import asyncio
+import logging
+import logging.handlers
 import json
-from datetime import datetime
-from telethon import TelegramClient, events
+import signal
+import shutil
+import tempfile
+import sqlite3
+import contextlib
+import time
+import bisect
+import hashlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from telethon import TelegramClient, events, utils
+from telethon.tl import functions, types
+from telethon.tl.custom import ParticipantPermissions
 from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument, MessageMediaWebPage
-from telethon.errors import ChatWriteForbiddenError, ChannelPrivateError, UserBannedInChannelError
-from dotenv import load_dotenv
+from telethon.errors import (
+    ChatWriteForbiddenError, ChannelPrivateError, UserBannedInChannelError,
+    ChannelInvalidError, UsernameNotOccupiedError, FloodWaitError, SlowModeWaitError,
+    FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError, ChatForwardsRestrictedError,
+    MessageNotModifiedError, MessageIdInvalidError, UserNotParticipantError, MessageTooLongError
+)
+from dotenv import load_dotenv, dotenv_values
 
-# Lock برای جلوگیری از پردازش همزمان پیام‌ها
-message_processing_lock = asyncio.Lock()
+# Lock جداگانه برای هر کانال منبع (chat_id: Lock)
+# پیام‌های یک کانال به ترتیب و فقط یک بار پردازش می‌شوند و کانال‌های مختلف همزمان پیش می‌روند
+channel_locks = {}
 
-# Set برای ذخیره پیام‌هایی که در حال پردازش هستند (channel_key: message_id)
-processing_messages = set()
+# Lock جداگانه برای catch-up هر کانال منبع تا چند catch-up همزمان یک بازه را دوباره دریافت نکنند
+catch_up_locks = {}
+
+# زمان آخرین دریافت پیام‌های جا افتاده از event handler برای هر کانال منبع (chat_id: time.monotonic)
+gap_catch_up_times = {}
+
+# متغیرهای محیطی خود process (قبل از .env) که بارگذاری دوباره تنظیمات به آن‌ها برمی‌گردد
+PROCESS_ENVIRONMENT = dict(os.environ)
 
 # بارگذاری متغیرهای محیطی
 load_dotenv()
@@ -21,29 +52,1137 @@ load_dotenv()
 API_ID = int(os.getenv('API_ID'))
 API_HASH = os.getenv('API_HASH')
 SESSION_NAME = os.getenv('SESSION_NAME', 'bot_session')
-SOURCE_CHANNELS = os.getenv('SOURCE_CHANNELS', '').split(',')
-TARGET_CHANNEL = os.getenv('TARGET_CHANNEL')
-REPLACE_USERNAME = [u.strip() for u in os.getenv('REPLACE_USERNAME', '').split(',') if u.strip()]
-NEW_USERNAME = os.getenv('NEW_USERNAME', '')
+# حالت چند حسابی: نام session ها با کاما جدا می‌شوند (اولی حساب اصلی است)؛ کانال‌های منبع بین حساب‌ها
+# تقسیم می‌شوند و ارسال‌ها بین همه حساب‌ها پخش می‌شوند
+SESSION_NAMES = [s.strip() for s in os.getenv('SESSION_NAMES', SESSION_NAME).split(',') if s.strip()]
+# روش بررسی دسترسی نوشتن در کانال‌های هدف هنگام راه‌اندازی: permissions (خواندن مجوزهای حساب بدون
+# ارسال پیام)، post (ارسال و حذف یک پیام تست) یا off
+ACCESS_CHECK_MODE = os.getenv('ACCESS_CHECK_MODE', 'permissions').strip().lower()
+
+def read_channel_settings(settings=os.environ):
+    """خواندن تنظیمات کانال‌ها از متغیرهای محیطی یا dict تنظیمات (در راه‌اندازی و در هر بارگذاری دوباره تنظیمات)"""
+    source_channels = (settings.get('SOURCE_CHANNELS') or '').split(',')
+    target_channel = settings.get('TARGET_CHANNEL')
+    # چند کانال هدف با کاما جدا می‌شوند؛ هر پیام یک بار دریافت و به همه آن‌ها ارسال می‌شود
+    target_channels = [t.strip() for t in (target_channel or '').split(',') if t.strip()]
+    replace_username = [u.strip() for u in (settings.get('REPLACE_USERNAME') or '').split(',') if u.strip()]
+    new_username = settings.get('NEW_USERNAME') or ''
+    return source_channels, target_channel, target_channels, replace_username, new_username
+
+SOURCE_CHANNELS, TARGET_CHANNEL, TARGET_CHANNELS, REPLACE_USERNAME, NEW_USERNAME = read_channel_settings()
+
+# فایل تنظیماتی که هنگام تغییر (یا با سیگنال SIGHUP) دوباره خوانده می‌شود: کانال‌های منبع و هدف،
+# username ها و قوانین تبدیل متن بدون قطع اتصال به‌روز می‌شوند
+CONFIG_FILE = os.getenv('CONFIG_FILE', '.env')
+# فاصله (ثانیه) بررسی تغییر CONFIG_FILE و TRANSFORM_RULES_FILE؛ 0 فقط SIGHUP را فعال نگه می‌دارد
+CONFIG_WATCH_INTERVAL = float(os.getenv('CONFIG_WATCH_INTERVAL', '5'))
+
+# فایل snapshot برای کش entity های resolve شده (کانال‌های منبع و هدف)
+ENTITY_CACHE_FILE = os.getenv('ENTITY_CACHE_FILE', 'entity_cache.json')
+# مدت اعتبار هر entity در کش (ثانیه) - بعد از آن دوباره resolve می‌شود
+ENTITY_CACHE_TTL = float(os.getenv('ENTITY_CACHE_TTL', str(24 * 60 * 60)))
+
+# حداکثر تعداد پیام‌هایی که در هر دور برای هر کانال دریافت و ارسال می‌شوند (باقی در دور بعد)
+CATCHUP_MAX_MESSAGES = int(os.getenv('CATCHUP_MAX_MESSAGES', '200'))
+# برای کانالی که هنوز checkpoint ندارد، فقط این تعداد پیام آخر ارسال می‌شود
+CATCHUP_INITIAL_WINDOW = int(os.getenv('CATCHUP_INITIAL_WINDOW', '10'))
+# حداقل فاصله (ثانیه) بین دو دریافت پیام‌های جا افتاده از event handler برای هر کانال؛
+# فاصله شناسه‌ها اغلب فقط پیام حذف شده یا پیام سرویس است و در این مدت به بررسی دوره‌ای سپرده می‌شود
+GAP_CATCHUP_MIN_INTERVAL = float(os.getenv('GAP_CATCHUP_MIN_INTERVAL', '10'))
+
+# فایل اختیاری قوانین تبدیل متن (امضاهای قابل حذف برای هر کانال منبع و ...)
+TRANSFORM_RULES_FILE = os.getenv('TRANSFORM_RULES_FILE', 'transform_rules.json')
+
+# محدودیت نرخ ارسال برای هر کانال هدف (پیام در ثانیه) و حداکثر ارسال پشت سر هم
+SEND_RATE_PER_CHAT = float(os.getenv('SEND_RATE_PER_CHAT', '1'))
+SEND_BURST_PER_CHAT = int(os.getenv('SEND_BURST_PER_CHAT', '3'))
+# محدودیت نرخ ارسال کلی حساب (پیام در ثانیه) و حداکثر ارسال پشت سر هم
+SEND_RATE_GLOBAL = float(os.getenv('SEND_RATE_GLOBAL', '20'))
+SEND_BURST_GLOBAL = int(os.getenv('SEND_BURST_GLOBAL', '20'))
+# حداکثر تعداد تلاش مجدد بعد از FloodWait برای هر ارسال
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '5'))
+
+# تنظیمات تلاش مجدد outbox: تأخیر پایه و حداکثر تأخیر (ثانیه) و حداکثر تعداد تلاش
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv('OUTBOX_RETRY_BASE_SECONDS', '5'))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv('OUTBOX_RETRY_MAX_SECONDS', '600'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+# مدت نگهداری رکوردهای ارسال شده در outbox (ثانیه)
+OUTBOX_RETENTION_SECONDS = float(os.getenv('OUTBOX_RETENTION_SECONDS', str(24 * 60 * 60)))
+# حداکثر زمان (ثانیه) انتظار برای ارسال پیام‌های در حال ارسال و صف شده هنگام توقف با SIGTERM؛
+# باید کمتر از مهلت سکو باشد (مثلاً 30 ثانیه در Heroku) تا ذخیره وضعیت هم انجام شود
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '25'))
+# مدت نگهداری نگاشت پیام منبع به پیام‌های کانال هدف برای اعمال ویرایش و حذف (ثانیه)
+MESSAGE_MAP_RETENTION_SECONDS = float(os.getenv('MESSAGE_MAP_RETENTION_SECONDS', str(7 * 24 * 60 * 60)))
+
+# مدت زمان (ثانیه) جمع‌آوری بخش‌های یک آلبوم قبل از ارسال یکجا
+ALBUM_WINDOW_SECONDS = float(os.getenv('ALBUM_WINDOW_SECONDS', '1.5'))
+# حداکثر تعداد فایل در یک آلبوم تلگرام
+ALBUM_MAX_SIZE = 10
+
+# فایل snapshot شاخص پیام‌های تکراری (برای شروع گرم بعد از راه‌اندازی مجدد)
+DEDUP_SNAPSHOT_FILE = os.getenv('DEDUP_SNAPSHOT_FILE', 'dedup_index.json')
+# مدت (ثانیه) که یک خبر ارسال شده برای تشخیص نسخه‌های تکراری آن در کانال‌های دیگر نگه داشته می‌شود
+DEDUP_WINDOW_SECONDS = float(os.getenv('DEDUP_WINDOW_SECONDS', str(6 * 60 * 60)))
+# حداکثر تعداد اثرانگشت نگه داشته شده در حافظه (قدیمی‌ترین‌ها حذف می‌شوند)
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', '20000'))
+# حداقل فاصله (ثانیه) بین ذخیره‌های snapshot شاخص تکراری‌ها
+DEDUP_SNAPSHOT_INTERVAL = float(os.getenv('DEDUP_SNAPSHOT_INTERVAL', '30'))
+# فایل کش ارجاع رسانه‌ها (id، access_hash و file_reference) برای ارسال دوباره بدون دانلود و آپلود
+MEDIA_CACHE_FILE = os.getenv('MEDIA_CACHE_FILE', 'media_cache.json')
+# حداکثر تعداد رسانه‌های نگه داشته شده در کش (قدیمی‌ترین‌ها حذف می‌شوند)
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv('MEDIA_CACHE_MAX_ENTRIES', '5000'))
+# پوشه فایل‌های موقت وقتی رسانه باید دانلود و دوباره آپلود شود (پیش‌فرض: پوشه موقت سیستم)
+MEDIA_DOWNLOAD_DIR = os.getenv('MEDIA_DOWNLOAD_DIR') or None
+# تشخیص خبرهای بازنویسی شده: حداقل شباهت (Jaccard کلمات و جفت کلمات، بین 0 و 1) برای تکراری بودن
+# (0 این بررسی را غیرفعال می‌کند)
+NEAR_DUP_THRESHOLD = float(os.getenv('NEAR_DUP_THRESHOLD', '0.6'))
+# مدت (ثانیه) نگهداری اثرانگشت خبرهای ارسال شده برای تشخیص بازنویسی
+NEAR_DUP_WINDOW_SECONDS = float(os.getenv('NEAR_DUP_WINDOW_SECONDS', str(2 * 60 * 60)))
+# حداکثر تعداد امضای نگه داشته شده در پنجره تشخیص بازنویسی (جدا از DEDUP_MAX_ENTRIES)
+NEAR_DUP_MAX_ENTRIES = int(os.getenv('NEAR_DUP_MAX_ENTRIES', '100000'))
+# متن‌های کوتاه‌تر از این تعداد کلمه برای تشخیص بازنویسی بررسی نمی‌شوند
+NEAR_DUP_MIN_TOKENS = int(os.getenv('NEAR_DUP_MIN_TOKENS', '8'))
 
-# فایل برای ذخیره آخرین پست‌های دیده شده
+# حداکثر تعداد کانال‌هایی که در بررسی دوره‌ای همزمان دریافت می‌شوند
+POLL_CONCURRENCY = int(os.getenv('POLL_CONCURRENCY', '5'))
+# حداکثر زمان (ثانیه) برای دریافت پیام‌های هر کانال در بررسی دوره‌ای
+POLL_CHANNEL_TIMEOUT = float(os.getenv('POLL_CHANNEL_TIMEOUT', '30'))
+# فاصله بررسی دوره‌ای هر کانال تطبیقی است: وقتی event handler پیام‌ها را به موقع دریافت می‌کند
+# تا POLL_MAX_INTERVAL زیاد و بعد از خطا، قطع اتصال یا پیام جا افتاده تا POLL_MIN_INTERVAL کم می‌شود
+POLL_MIN_INTERVAL = float(os.getenv('POLL_MIN_INTERVAL', '30'))
+POLL_MAX_INTERVAL = float(os.getenv('POLL_MAX_INTERVAL', '600'))
+# ضریب افزایش فاصله بعد از هر بررسی بدون پیام جا افتاده
+POLL_BACKOFF_FACTOR = float(os.getenv('POLL_BACKOFF_FACTOR', '1.5'))
+
+# سطح لاگ (DEBUG، INFO، WARNING، ERROR) و قالب آن: text یا json (یک شیء JSON در هر خط)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+
+# آدرس و پورت endpoint متریک‌ها با فرمت Prometheus (پورت 0 آن را غیرفعال می‌کند)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+
+# فایل پایگاه داده برای ذخیره آخرین پست‌های دیده شده (SQLite در حالت WAL)
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', 'bot_state.db')
+
+# فایل قدیمی JSON - فقط یک بار در اولین اجرا به پایگاه داده منتقل می‌شود
 LAST_MESSAGES_FILE = 'last_messages.json'
 
-def load_last_messages():
-    """بارگذاری آخرین پیام‌های دیده شده از فایل"""
-    if os.path.exists(LAST_MESSAGES_FILE):
+# لاگر ربات؛ تا وقتی setup_logging صدا زده نشده (مثلاً در benchmark) چیزی چاپ نمی‌کند
+logger = logging.getLogger('bot')
+logger.addHandler(logging.NullHandler())
+
+# فیلدهای ساختاریافته‌ای که هر رکورد لاگ می‌تواند داشته باشد
+LOG_CONTEXT_FIELDS = ('channel', 'message_id', 'stage')
+
+def log_context(channel=None, message_id=None, stage=None):
+    """فیلدهای ساختاریافته یک رکورد لاگ برای پارامتر extra"""
+    return {'channel': channel, 'message_id': message_id, 'stage': stage}
+
+class JsonLogFormatter(logging.Formatter):
+    """قالب JSON lines: زمان، سطح، پیام و فیلدهای channel، message_id و stage"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler که traceback را جدا از متن پیام نگه می‌دارد (برای فیلد exception در JSON)"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging():
+    """راه‌اندازی لاگ غیرمسدودکننده
+
+    رکوردها فقط در یک صف قرار می‌گیرند و یک thread جداگانه (QueueListener) آن‌ها را
+    در stdout می‌نویسد، بنابراین کندی stdout (مثلاً log drain) event loop را متوقف نمی‌کند.
+    QueueListener برگردانده می‌شود تا در پایان برنامه با stop() باقی رکوردها نوشته شوند.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    logger.handlers = [StructuredQueueHandler(log_queue)]
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+    # لاگ‌های Telethon هم از همین مسیر (فقط هشدارها و خطاها)
+    telethon_logger = logging.getLogger('telethon')
+    telethon_logger.handlers = logger.handlers
+    telethon_logger.setLevel(logging.WARNING)
+    telethon_logger.propagate = False
+    listener.start()
+    return listener
+
+def format_labels(labels):
+    """قالب‌بندی label ها برای خروجی Prometheus"""
+    if not labels:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+class Counter:
+    """شمارنده افزایشی (مثلاً تعداد پیام‌های تکراری رد شده)"""
+
+    metric_type = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}  # label ها (tuple مرتب) -> مقدار
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+class Gauge(Counter):
+    """مقدار لحظه‌ای؛ اگر تابع داده شود در هر بار خواندن از آن محاسبه می‌شود"""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, function=None):
+        super().__init__(name, help_text)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception:
+                pass
+        return super().samples()
+
+class Histogram:
+    """هیستوگرام زمان‌ها با bucket های ثابت (مثل هیستوگرام Prometheus)"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        self._values = {}  # label ها -> [شمارش هر bucket، مجموع، تعداد]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self._values.get(key)
+        if entry is None:
+            entry = [[0] * len(self.buckets), 0.0, 0]
+            self._values[key] = entry
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][index] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """اندازه‌گیری زمان اجرای یک بلوک"""
+        started = time.perf_counter()
         try:
-            with open(LAST_MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(sorted(labels.items())))
+        return entry[2] if entry else 0
+
+    def samples(self):
+        for key, (bucket_counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', key + (('le', repr(float(bound))),), cumulative
+            yield f'{self.name}_bucket', key + (('le', '+Inf'),), count
+            yield f'{self.name}_sum', key, total
+            yield f'{self.name}_count', key, count
+
+class MetricsRegistry:
+    """مجموعه متریک‌های ربات و خروجی متنی آن‌ها با فرمت Prometheus"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.metric_type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+# bucket های زمانی (ثانیه) برای عملیات سریع محلی، ارسال به تلگرام و کل مسیر پیام
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+SEND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PIPELINE_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+source_to_publish_seconds = metrics.register(Histogram(
+    'forwarder_source_to_publish_seconds', 'Time from the source post date until it is published to the target', PIPELINE_BUCKETS))
+handler_seconds = metrics.register(Histogram(
+    'forwarder_handler_seconds', 'Time spent handling one NewMessage event', SEND_BUCKETS))
+poll_seconds = metrics.register(Histogram(
+    'forwarder_poll_seconds', 'Duration of one polling round over all source channels', PIPELINE_BUCKETS))
+lock_wait_seconds = metrics.register(Histogram(
+    'forwarder_lock_wait_seconds', 'Time spent waiting for per-channel locks', FAST_BUCKETS))
+checkpoint_io_seconds = metrics.register(Histogram(
+    'forwarder_checkpoint_io_seconds', 'Checkpoint and outbox database time', FAST_BUCKETS))
+send_seconds = metrics.register(Histogram(
+    'forwarder_send_seconds', 'Time to publish one message to the target by media type', SEND_BUCKETS))
+messages_sent_total = metrics.register(Counter(
+    'forwarder_messages_sent_total', 'Messages published by media type and target'))
+send_failures_total = metrics.register(Counter(
+    'forwarder_send_failures_total', 'Failed send attempts'))
+flood_wait_seconds_total = metrics.register(Counter(
+    'forwarder_flood_wait_seconds_total', 'Seconds of FloodWait/SlowModeWait imposed by Telegram'))
+flood_waits_total = metrics.register(Counter(
+    'forwarder_flood_waits_total', 'Number of FloodWait/SlowModeWait errors'))
+duplicates_skipped_total = metrics.register(Counter(
+    'forwarder_duplicates_skipped_total', 'Messages not sent because the same news was already published'))
+filter_rule_matches_total = metrics.register(Counter(
+    'forwarder_filter_rule_matches_total', 'Keyword rule matches by rule and result (sent or dropped)'))
+messages_filtered_total = metrics.register(Counter(
+    'forwarder_messages_filtered_total', 'Messages not sent to a target because of keyword rules'))
+digest_messages_total = metrics.register(Counter(
+    'forwarder_digest_messages_total', 'Source messages published inside a digest post'))
+startup_phase_seconds = metrics.register(Gauge(
+    'forwarder_startup_phase_seconds', 'Duration of each startup phase'))
+channel_polls_total = metrics.register(Counter(
+    'forwarder_channel_polls_total', 'Periodic channel polls by result (current, missed, error)'))
+media_cache_total = metrics.register(Counter(
+    'forwarder_media_cache_total', 'Media sends by reference source (hit, miss, refreshed, reuploaded)'))
+outbox_pending = metrics.register(Gauge(
+    'forwarder_outbox_pending', 'Messages waiting in the outbox', lambda: get_outbox().pending_count()))
+
+async def handle_metrics_request(reader, writer):
+    """پاسخ به یک درخواست HTTP برای /metrics"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # خواندن و نادیده گرفتن header ها
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/metrics', '/'):
+            body = metrics.render().encode('utf-8')
+            status = '200 OK'
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body = b'not found\n'
+            status = '404 Not Found'
+            content_type = 'text/plain; charset=utf-8'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """شروع endpoint متریک‌ها روی METRICS_HOST:METRICS_PORT (None اگر غیرفعال است یا پورت آزاد نیست)"""
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        logger.warning(f"⚠️ endpoint متریک‌ها روی {METRICS_HOST}:{METRICS_PORT} شروع نشد: {e}")
+        return None
+    logger.info(f"📊 متریک‌ها در http://{METRICS_HOST}:{METRICS_PORT}/metrics در دسترس است")
+    return server
+
+class CheckpointStore:
+    """نگهداری آخرین پیام دیده شده هر کانال در حافظه و ذخیره تدریجی آن در SQLite
+
+    هر کانال فقط یک بار با شناسه canonical خودش (peer id) ذخیره می‌شود و هر به‌روزرسانی
+    فقط یک سطر را در یک تراکنش اتمیک می‌نویسد، بنابراین crash نمی‌تواند فایل را ناقص کند.
+    """
+
+    def __init__(self, db_path, legacy_json_path=None):
+        self.db_path = db_path
+        # isolation_level=None: هر دستور به صورت جداگانه و اتمیک commit می‌شود
+        self.connection = sqlite3.connect(db_path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            'chat_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL, updated_at REAL NOT NULL)'
+        )
+        # کلیدهای قدیمی (username ها و id ها) که هنوز به شناسه canonical نگاشت نشده‌اند
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS legacy_checkpoints ('
+            'key TEXT PRIMARY KEY, message_id INTEGER NOT NULL)'
+        )
+        self._state = dict(self.connection.execute('SELECT chat_id, message_id FROM checkpoints'))
+        # تغییرات تراکنش جاری که فقط بعد از COMMIT در _state اعمال می‌شوند
+        self._pending = None
+        self._legacy = dict(self.connection.execute('SELECT key, message_id FROM legacy_checkpoints'))
+        
+        if legacy_json_path:
+            self._migrate_legacy_json(legacy_json_path)
+
+    def _migrate_legacy_json(self, json_path):
+        """انتقال یک‌باره فایل قدیمی last_messages.json (با کلیدهای تکراری) به پایگاه داده"""
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy_messages = json.load(f)
         except (json.JSONDecodeError, IOError, OSError) as e:
-            print(f"⚠️ خطا در خواندن فایل {LAST_MESSAGES_FILE}: {e}")
-            return {}
-    return {}
+            logger.warning(f"⚠️ خطا در خواندن فایل {json_path}: {e}")
+            return
+        
+        rows = []
+        for key, message_id in legacy_messages.items():
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                continue
+            if message_id > self._legacy.get(key, 0):
+                self._legacy[key] = message_id
+                rows.append((key, message_id))
+        
+        with self.transaction():
+            self.connection.executemany(
+                'INSERT INTO legacy_checkpoints (key, message_id) VALUES (?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET message_id = excluded.message_id',
+                rows
+            )
+        
+        # تغییر نام فایل قدیمی تا مهاجرت دوباره انجام نشود
+        os.replace(json_path, f"{json_path}.migrated")
+        logger.info(f"📦 {len(rows)} کلید از {json_path} به {self.db_path} منتقل شد")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """اجرای چند تغییر در یک تراکنش اتمیک (مثلاً به‌روزرسانی checkpoint و ثبت در outbox)
+
+        checkpoint های حافظه فقط بعد از COMMIT به‌روز می‌شوند تا بعد از ROLLBACK جلوتر از پایگاه داده نباشند.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        self._pending = {}
+        try:
+            yield
+        except BaseException:
+            self._pending = None
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        self._state.update(self._pending)
+        self._pending = None
+
+    def get(self, chat_id, legacy_keys=()):
+        """برگرداندن آخرین ID دیده شده برای کانال (0 اگر وجود نداشته باشد)"""
+        last_id = self._state.get(chat_id)
+        if last_id is not None:
+            return last_id
+        
+        # اگر کانال هنوز با شناسه canonical ذخیره نشده، از کلیدهای قدیمی استفاده می‌کنیم
+        legacy_ids = [self._legacy[key] for key in legacy_keys if key in self._legacy]
+        if legacy_ids:
+            last_id = max(legacy_ids)
+            self.advance(chat_id, last_id)
+            return last_id
+        return 0
+
+    def advance(self, chat_id, message_id):
+        """به‌روزرسانی آخرین ID دیده شده (فقط رو به جلو) و ذخیره اتمیک همان یک سطر"""
+        current = self._state.get(chat_id, 0)
+        if self._pending is not None:
+            current = max(current, self._pending.get(chat_id, 0))
+        if message_id <= current:
+            return False
+        self.connection.execute(
+            'INSERT INTO checkpoints (chat_id, message_id, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(chat_id) DO UPDATE SET '
+            'message_id = excluded.message_id, updated_at = excluded.updated_at',
+            (chat_id, message_id, time.time())
+        )
+        if self._pending is not None:
+            self._pending[chat_id] = message_id
+        else:
+            self._state[chat_id] = message_id
+        return True
+
+    def close(self):
+        """بستن اتصال پایگاه داده"""
+        self.connection.close()
+
+# نمونه سراسری CheckpointStore (در اولین استفاده ساخته می‌شود)
+checkpoint_store = None
+
+def get_checkpoint_store():
+    """برگرداندن CheckpointStore سراسری"""
+    global checkpoint_store
+    if checkpoint_store is None:
+        checkpoint_store = CheckpointStore(STATE_DB_FILE, legacy_json_path=LAST_MESSAGES_FILE)
+    return checkpoint_store
+
+class Outbox:
+    """صف پایدار ارسال (جدول outbox در همان پایگاه داده وضعیت)
+
+    هر پیام پذیرفته شده کانال منبع برای هر کانال هدف یک رکورد با وضعیتش (pending، sent،
+    duplicate یا failed) دارد و worker های ارسال آن را با تلاش مجدد و تأخیر نمایی ارسال می‌کنند.
+    پیام‌هایی که قبل از توقف برنامه ارسال نشده‌اند در اجرای بعدی دوباره ارسال می‌شوند.
+    """
+
+    COLUMNS = (
+        'chat_id, message_id, grouped_id, source_ref, source_username, state, attempts, '
+        'next_attempt_at, last_error, created_at, updated_at'
+    )
+
+    def __init__(self, store, legacy_target=''):
+        self.connection = store.connection
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(outbox)')]
+        if columns and 'target' not in columns:
+            # جدول قبل از پشتیبانی از چند کانال هدف ساخته شده است؛ رکوردها به کانال هدف اول تعلق دارند
+            with store.transaction():
+                self.connection.execute('ALTER TABLE outbox RENAME TO outbox_single_target')
+                self._create_table()
+                self.connection.execute(
+                    f'INSERT INTO outbox ({self.COLUMNS}, target) '
+                    f'SELECT {self.COLUMNS}, ? FROM outbox_single_target',
+                    (legacy_target,)
+                )
+                self.connection.execute('DROP TABLE outbox_single_target')
+        else:
+            self._create_table()
+        # پیام‌های دریافت شده در این اجرا تا نیازی به دریافت مجدد از تلگرام نباشد
+        self._messages = {}
+        # حسابی که هر پیام را دریافت کرده است (رسانه‌ها فقط برای همان حساب قابل ارسال هستند)
+        self._readers = {}
+        # متن بدون امضای هر پیام (بخش مشترک تبدیل متن برای همه کانال‌های هدف)
+        self._stripped_texts = {}
+        # قوانین کلمات کلیدی منطبق با هر پیام (تطبیق برای همه کانال‌های هدف مشترک است)
+        self._keyword_matches = {}
+
+    def _create_table(self):
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'chat_id INTEGER NOT NULL, '
+            'message_id INTEGER NOT NULL, '
+            "target TEXT NOT NULL DEFAULT '', "
+            'grouped_id INTEGER, '
+            'source_ref TEXT, '
+            'source_username TEXT, '
+            "state TEXT NOT NULL DEFAULT 'pending', "
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'next_attempt_at REAL NOT NULL DEFAULT 0, '
+            'last_error TEXT, '
+            'created_at REAL NOT NULL, '
+            'updated_at REAL NOT NULL, '
+            'UNIQUE (chat_id, message_id, target))'
+        )
+        self.connection.execute('DROP INDEX IF EXISTS outbox_pending')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS outbox_target_pending ON outbox (chat_id, target, state, id)'
+        )
+
+    def enqueue(self, chat_id, message, source_ref, source_username, targets, reader=None):
+        """ثبت یک پیام کانال منبع در صف همه کانال‌های هدف (باید داخل تراکنش checkpoint صدا زده شود)"""
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO outbox '
+            '(chat_id, message_id, target, grouped_id, source_ref, source_username, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (chat_id, message.id, target, message.grouped_id, source_ref, source_username, now, now)
+                for target in targets
+            ]
+        )
+        self._messages[(chat_id, message.id)] = message
+        self._readers[(chat_id, message.id)] = reader
+
+    def next_batch(self, chat_id, target):
+        """قدیمی‌ترین پیام در انتظار یک کانال برای یک هدف (و اگر بخشی از آلبوم است، بقیه بخش‌های همان آلبوم)"""
+        head = self.connection.execute(
+            'SELECT id, message_id, grouped_id, source_ref, source_username, attempts, next_attempt_at, created_at '
+            "FROM outbox WHERE chat_id = ? AND target = ? AND state = 'pending' ORDER BY id LIMIT 1",
+            (chat_id, target)
+        ).fetchone()
+        if head is None or head[2] is None:
+            return [head] if head else []
+        return self.connection.execute(
+            'SELECT id, message_id, grouped_id, source_ref, source_username, attempts, next_attempt_at, created_at '
+            "FROM outbox WHERE chat_id = ? AND target = ? AND state = 'pending' AND grouped_id = ? ORDER BY id LIMIT ?",
+            (chat_id, target, head[2], ALBUM_MAX_SIZE)
+        ).fetchall()
 
-def save_last_messages(messages):
-    """ذخیره آخرین پیام‌های دیده شده در فایل"""
-    with open(LAST_MESSAGES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(messages, f, ensure_ascii=False, indent=2)
+    def next_rows(self, chat_id, target, limit):
+        """قدیمی‌ترین پیام‌های در انتظار یک کانال برای یک هدف (برای جمع‌آوری پست خلاصه)"""
+        return self.connection.execute(
+            'SELECT id, message_id, grouped_id, source_ref, source_username, attempts, next_attempt_at, created_at '
+            "FROM outbox WHERE chat_id = ? AND target = ? AND state = 'pending' ORDER BY id LIMIT ?",
+            (chat_id, target, limit)
+        ).fetchall()
+
+    def pending_queues(self):
+        """(کانال منبع، کانال هدف) هایی که پیام ارسال نشده دارند"""
+        return self.connection.execute(
+            "SELECT DISTINCT chat_id, target FROM outbox WHERE state = 'pending'"
+        ).fetchall()
+
+    def pending_count(self):
+        """تعداد کل ارسال‌های در انتظار"""
+        return self.connection.execute("SELECT COUNT(*) FROM outbox WHERE state = 'pending'").fetchone()[0]
+
+    def get_message(self, chat_id, message_id, client=None):
+        """پیام نگه داشته شده در حافظه (None اگر برنامه بعد از ثبت دوباره اجرا شده باشد)
+
+        file reference و access_hash رسانه‌ها به حساب دریافت کننده تعلق دارند؛ اگر حساب ارسال کننده
+        حساب دیگری باشد، برای پیام رسانه‌دار None برگردانده می‌شود تا با همان حساب دوباره دریافت شود.
+        """
+        key = (chat_id, message_id)
+        message = self._messages.get(key)
+        reader = self._readers.get(key)
+        if (message is not None and client is not None and reader is not None and reader is not client
+                and get_media_type(message) not in ('text', 'webpage')):
+            return None
+        return message
+
+    def replace_message(self, chat_id, message):
+        """جایگزینی پیامی که هنوز ارسال نشده با نسخه ویرایش شده آن"""
+        key = (chat_id, message.id)
+        if key in self._messages:
+            self._messages[key] = message
+            self._stripped_texts.pop(key, None)
+            self._keyword_matches.pop(key, None)
+
+    def cancel(self, chat_id, message_ids):
+        """لغو ارسال پیام‌هایی که در کانال منبع حذف شده‌اند (تعداد رکوردهای لغو شده)"""
+        now = time.time()
+        cursor = self.connection.executemany(
+            "UPDATE outbox SET state = 'failed', last_error = ?, updated_at = ? "
+            "WHERE chat_id = ? AND message_id = ? AND state = 'pending'",
+            [('پیام در کانال منبع حذف شد', now, chat_id, message_id) for message_id in message_ids]
+        )
+        for message_id in message_ids:
+            self._messages.pop((chat_id, message_id), None)
+            self._readers.pop((chat_id, message_id), None)
+            self._stripped_texts.pop((chat_id, message_id), None)
+            self._keyword_matches.pop((chat_id, message_id), None)
+        return cursor.rowcount
+
+    def cancel_target(self, target):
+        """لغو ارسال‌های در انتظار کانال هدفی که از تنظیمات حذف شده است"""
+        cursor = self.connection.execute(
+            "UPDATE outbox SET state = 'failed', last_error = ?, updated_at = ? WHERE target = ? AND state = 'pending'",
+            ('کانال هدف از تنظیمات حذف شد', time.time(), target)
+        )
+        return cursor.rowcount
+
+    def get_stripped_text(self, chat_id, message, source_username):
+        """متن بدون امضای پیام؛ برای هر پیام فقط یک بار محاسبه می‌شود و بین کانال‌های هدف مشترک است"""
+        key = (chat_id, message.id)
+        text = self._stripped_texts.get(key)
+        if text is None:
+            text = get_transform_pipeline(source_username).strip_signatures(message.text or message.raw_text or '')
+            self._stripped_texts[key] = text
+        return text
+
+    def get_keyword_matches(self, chat_id, messages, source_username):
+        """شناسه قوانین کلمات کلیدی منطبق با متن بدون امضای پیام‌ها (برای هر پیام فقط یک بار تطبیق داده می‌شود)"""
+        matched = set()
+        for message in messages:
+            key = (chat_id, message.id)
+            message_matches = self._keyword_matches.get(key)
+            if message_matches is None:
+                message_matches = get_message_filter().match(self.get_stripped_text(chat_id, message, source_username))
+                self._keyword_matches[key] = message_matches
+            matched |= message_matches
+        return matched
+
+    def clear_text_cache(self):
+        """حذف متن‌های تبدیل شده و نتایج تطبیق بعد از تغییر قوانین"""
+        self._stripped_texts.clear()
+        self._keyword_matches.clear()
+
+    def _update(self, row_ids, state, error=None, attempts_delta=0, next_attempt_at=0):
+        now = time.time()
+        self.connection.executemany(
+            'UPDATE outbox SET state = ?, attempts = attempts + ?, next_attempt_at = ?, '
+            'last_error = ?, updated_at = ? WHERE id = ?',
+            [(state, attempts_delta, next_attempt_at, error, now, row_id) for row_id in row_ids]
+        )
+
+    def _forget(self, chat_id, rows):
+        """حذف پیام‌ها از حافظه وقتی هیچ کانال هدفی منتظر آن‌ها نیست"""
+        for row in rows:
+            still_pending = self.connection.execute(
+                "SELECT 1 FROM outbox WHERE chat_id = ? AND message_id = ? AND state = 'pending' LIMIT 1",
+                (chat_id, row[1])
+            ).fetchone()
+            if still_pending is None:
+                self._messages.pop((chat_id, row[1]), None)
+                self._readers.pop((chat_id, row[1]), None)
+                self._stripped_texts.pop((chat_id, row[1]), None)
+                self._keyword_matches.pop((chat_id, row[1]), None)
+
+    def mark_sent(self, chat_id, rows):
+        """علامت‌گذاری پیام‌ها به عنوان ارسال شده"""
+        self._update([row[0] for row in rows], 'sent')
+        self._forget(chat_id, rows)
+
+    def mark_retry(self, rows, error, delay):
+        """ثبت تلاش ناموفق و زمان تلاش بعدی"""
+        self._update([row[0] for row in rows], 'pending', error, 1, time.time() + delay)
+
+    def mark_duplicate(self, chat_id, rows):
+        """علامت‌گذاری پیام‌هایی که نسخه دیگری از آن‌ها قبلاً ارسال شده است"""
+        self._update([row[0] for row in rows], 'duplicate')
+        self._forget(chat_id, rows)
+
+    def mark_filtered(self, chat_id, rows, error):
+        """علامت‌گذاری پیام‌هایی که قوانین کلمات کلیدی ارسال آن‌ها به این کانال هدف را رد کرده‌اند"""
+        self._update([row[0] for row in rows], 'filtered', error)
+        self._forget(chat_id, rows)
+
+    def mark_failed(self, chat_id, rows, error):
+        """علامت‌گذاری پیام‌هایی که دیگر تلاش نمی‌شوند"""
+        self._update([row[0] for row in rows], 'failed', error, 1)
+        self._forget(chat_id, rows)
+
+    def prune(self, retention_seconds):
+        """حذف رکوردهای قدیمی ارسال شده یا ناموفق"""
+        self.connection.execute(
+            "DELETE FROM outbox WHERE state != 'pending' AND updated_at < ?",
+            (time.time() - retention_seconds,)
+        )
+
+# نمونه سراسری Outbox (در اولین استفاده ساخته می‌شود)
+outbox = None
+
+def get_outbox():
+    """برگرداندن Outbox سراسری (روی همان اتصال پایگاه داده checkpoint ها)"""
+    global outbox
+    if outbox is None:
+        outbox = Outbox(get_checkpoint_store(), legacy_target=TARGET_CHANNELS[0] if TARGET_CHANNELS else '')
+    return outbox
+
+class MessageMap:
+    """نگاشت پایدار پیام منبع به پیام‌های ارسال شده در کانال‌های هدف (جدول message_map)
+
+    هر پیام منبع در هر کانال هدف یک بخش اصلی (part 0: متن یا رسانه) و در صورت طولانی بودن
+    caption یک بخش ادامه متن (part 1) دارد. کلید اصلی (chat_id، message_id، target، part) است و
+    پیدا کردن نسخه‌های یک پیام برای ویرایش یا حذف بدون جستجو در تاریخچه کانال انجام می‌شود.
+    """
+
+    # هر چند ثبت یک بار رکوردهای قدیمی‌تر از retention حذف می‌شوند
+    PRUNE_EVERY = 1000
+
+    def __init__(self, store, retention_seconds):
+        self.connection = store.connection
+        self.retention_seconds = retention_seconds
+        self._records_since_prune = 0
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS message_map ('
+            'chat_id INTEGER NOT NULL, '
+            'message_id INTEGER NOT NULL, '
+            'target TEXT NOT NULL, '
+            'part INTEGER NOT NULL, '
+            'target_message_id INTEGER NOT NULL, '
+            'kind TEXT NOT NULL, '
+            'account TEXT, '
+            'created_at REAL NOT NULL, '
+            'PRIMARY KEY (chat_id, message_id, target, part)) WITHOUT ROWID'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS message_map_created ON message_map (created_at)')
+
+    def record(self, chat_id, target, account, sent_ids):
+        """ثبت پیام‌های ارسال شده: sent_ids لیست (شناسه پیام منبع، بخش، شناسه پیام هدف، نوع) است"""
+        if not sent_ids:
+            return
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO message_map '
+            '(chat_id, message_id, target, part, target_message_id, kind, account, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(chat_id, message_id, target, part, target_message_id, kind, account, now)
+             for message_id, part, target_message_id, kind in sent_ids]
+        )
+        self._records_since_prune += 1
+        if self._records_since_prune >= self.PRUNE_EVERY:
+            self.prune()
+
+    def sent_parts(self, chat_id, message_ids, target):
+        """بخش‌هایی از پیام‌ها که قبلاً در این کانال هدف ارسال شده‌اند: مجموعه (شناسه پیام منبع، بخش)"""
+        parts = set()
+        for message_id in message_ids:
+            parts.update(self.connection.execute(
+                'SELECT message_id, part FROM message_map WHERE chat_id = ? AND message_id = ? AND target = ?',
+                (chat_id, message_id, target)
+            ).fetchall())
+        return parts
+
+    def lookup(self, chat_id, message_id):
+        """نسخه‌های یک پیام منبع: لیست (target، part، target_message_id، kind، account)"""
+        return self.connection.execute(
+            'SELECT target, part, target_message_id, kind, account FROM message_map '
+            'WHERE chat_id = ? AND message_id = ? ORDER BY target, part',
+            (chat_id, message_id)
+        ).fetchall()
+
+    def add(self, chat_id, message_id, target, part, target_message_id, kind, account):
+        """ثبت یک بخش جدید (مثلاً ادامه متنی که بعد از ویرایش طولانی‌تر شده است)"""
+        self.record(chat_id, target, account, [(message_id, part, target_message_id, kind)])
+
+    def remove(self, chat_id, message_id, target=None, part=None):
+        """حذف نگاشت یک پیام منبع (یا فقط یک بخش آن)"""
+        if target is None:
+            self.connection.execute(
+                'DELETE FROM message_map WHERE chat_id = ? AND message_id = ?', (chat_id, message_id)
+            )
+        else:
+            self.connection.execute(
+                'DELETE FROM message_map WHERE chat_id = ? AND message_id = ? AND target = ? AND part = ?',
+                (chat_id, message_id, target, part)
+            )
+
+    def pop(self, chat_id, message_ids):
+        """برگرداندن و حذف نسخه‌های چند پیام منبع: لیست (target، target_message_id، account)
+
+        پست خلاصه (kind='digest') فقط وقتی برگردانده می‌شود که همه پیام‌های منبع آن حذف شده باشند؛
+        تا آن زمان فقط نگاشت پیام حذف شده پاک می‌شود و پست خلاصه در کانال هدف باقی می‌ماند.
+        """
+        rows = []
+        digests = set()
+        for message_id in message_ids:
+            for target, _, target_message_id, kind, account in self.lookup(chat_id, message_id):
+                if kind == 'digest':
+                    digests.add((target, target_message_id, account))
+                else:
+                    rows.append((target, target_message_id, account))
+            self.remove(chat_id, message_id)
+        for target, target_message_id, account in digests:
+            if self.connection.execute(
+                'SELECT 1 FROM message_map WHERE chat_id = ? AND target = ? AND target_message_id = ? LIMIT 1',
+                (chat_id, target, target_message_id)
+            ).fetchone() is None:
+                rows.append((target, target_message_id, account))
+        return rows
+
+    def prune(self):
+        """حذف نگاشت‌های قدیمی‌تر از retention"""
+        self._records_since_prune = 0
+        self.connection.execute(
+            'DELETE FROM message_map WHERE created_at < ?', (time.time() - self.retention_seconds,)
+        )
+
+# نمونه سراسری MessageMap (در اولین استفاده ساخته می‌شود)
+message_map = None
+
+def get_message_map():
+    """برگرداندن MessageMap سراسری (روی همان اتصال پایگاه داده checkpoint ها)"""
+    global message_map
+    if message_map is None:
+        message_map = MessageMap(get_checkpoint_store(), MESSAGE_MAP_RETENTION_SECONDS)
+    return message_map
+
+def get_canonical_chat_id(entity):
+    """شناسه canonical کانال (همان مقدار event.chat_id، مثلاً -100...)"""
+    if isinstance(entity, CachedEntity):
+        return entity.peer_id
+    try:
+        return utils.get_peer_id(entity)
+    except (TypeError, ValueError):
+        return None
+
+def write_json_atomic(file_path, data):
+    """نوشتن اتمیک فایل JSON (ابتدا در فایل موقت و سپس جایگزینی) تا crash فایل را ناقص نکند"""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+# یک thread برای نوشتن snapshot ها: fsync حلقه رویداد را متوقف نمی‌کند و نوشتن‌ها به ترتیب درخواست انجام می‌شوند
+snapshot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+
+class CachedEntity:
+    """نسخه سبک و قابل ذخیره از یک entity تلگرام (کانال، گروه یا کاربر)
+
+    ویژگی input_entity باعث می‌شود Telethon بتواند این شیء را مستقیماً
+    در درخواست‌ها (get_messages، send_message و ...) بدون resolve مجدد استفاده کند.
+    """
+
+    __slots__ = ('peer_id', 'id', 'access_hash', 'username', 'title', 'resolved_at')
+
+    def __init__(self, peer_id, access_hash=None, username=None, title=None, resolved_at=None):
+        self.peer_id = peer_id
+        self.id = utils.resolve_id(peer_id)[0]
+        self.access_hash = access_hash
+        self.username = username
+        self.title = title
+        self.resolved_at = resolved_at if resolved_at is not None else time.time()
+
+    @classmethod
+    def from_entity(cls, entity):
+        """ساخت CachedEntity از entity برگشتی Telethon"""
+        input_peer = utils.get_input_peer(entity)
+        title = getattr(entity, 'title', None) or getattr(entity, 'first_name', None)
+        return cls(
+            utils.get_peer_id(input_peer),
+            access_hash=getattr(input_peer, 'access_hash', None),
+            username=getattr(entity, 'username', None),
+            title=title
+        )
+
+    @property
+    def input_entity(self):
+        """InputPeer متناظر برای استفاده در درخواست‌های Telethon"""
+        real_id, peer_type = utils.resolve_id(self.peer_id)
+        if peer_type is types.PeerChannel:
+            return types.InputPeerChannel(real_id, self.access_hash or 0)
+        if peer_type is types.PeerChat:
+            return types.InputPeerChat(real_id)
+        return types.InputPeerUser(real_id, self.access_hash or 0)
+
+    def to_dict(self):
+        return {
+            'peer_id': self.peer_id,
+            'access_hash': self.access_hash,
+            'username': self.username,
+            'title': self.title,
+            'resolved_at': self.resolved_at,
+        }
+
+class EntityCache:
+    """کش entity های resolve شده با کلید username و id، همراه با TTL و snapshot روی دیسک
+
+    resolve کردن username در تلگرام محدودیت نرخ شدیدی دارد؛ با این کش، کانال‌هایی که
+    قبلاً شناخته شده‌اند در راه‌اندازی و هر دور بررسی بدون درخواست شبکه استفاده می‌شوند.
+    """
+
+    def __init__(self, snapshot_path, ttl):
+        self.snapshot_path = snapshot_path
+        self.ttl = ttl
+        self._entries = {}  # peer_id -> CachedEntity
+        self._keys = {}  # کلید نرمال شده (username یا peer_id) -> peer_id
+        self._dirty = False
+        self._write_future = None
+        self._load_snapshot()
+
+    @staticmethod
+    def normalize_key(key):
+        """نرمال‌سازی کلید: عدد برای id ها و username با حروف کوچک بدون @"""
+        if isinstance(key, int):
+            return str(key)
+        key = str(key).strip()
+        if key.lstrip('-').isdigit():
+            return str(int(key))
+        for prefix in ('https://t.me/', 'http://t.me/', 't.me/'):
+            if key.lower().startswith(prefix):
+                key = key[len(prefix):]
+        return key.lstrip('@').lower()
+
+    def _load_snapshot(self):
+        """بارگذاری snapshot کش از فایل"""
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            for item in snapshot.get('entities', []):
+                cached = CachedEntity(
+                    item['peer_id'],
+                    access_hash=item.get('access_hash'),
+                    username=item.get('username'),
+                    title=item.get('title'),
+                    resolved_at=item.get('resolved_at')
+                )
+                self._index(cached, item.get('aliases', []))
+        except (json.JSONDecodeError, IOError, OSError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ خطا در خواندن فایل {self.snapshot_path}: {e}")
+
+    def save(self, force=True):
+        """ذخیره اتمیک snapshot کش روی دیسک در snapshot_executor
+
+        put و invalidate (که در مسیر event handler هم اجرا می‌شوند) با force=False منتظر fsync
+        نمی‌مانند؛ با force (هنگام خروج) تا پایان نوشتن صبر می‌شود.
+        """
+        # تا پایان نوشتن قبلی کش dirty می‌ماند (مثل DedupIndex.save)
+        if self._dirty and (force or not self._writing()):
+            aliases = {}
+            for key, peer_id in self._keys.items():
+                aliases.setdefault(peer_id, []).append(key)
+            entities = []
+            for peer_id, cached in self._entries.items():
+                item = cached.to_dict()
+                item['aliases'] = aliases.get(peer_id, [])
+                entities.append(item)
+            self._dirty = False
+            self._write_future = snapshot_executor.submit(self._write_snapshot, {'entities': entities})
+        if force and self._write_future is not None:
+            self._write_future.result()
+
+    def _writing(self):
+        return self._write_future is not None and not self._write_future.done()
+
+    def _write_snapshot(self, snapshot):
+        try:
+            write_json_atomic(self.snapshot_path, snapshot)
+        except (IOError, OSError) as e:
+            self._dirty = True
+            logger.warning(f"⚠️ خطا در ذخیره فایل {self.snapshot_path}: {e}")
+
+    def _index(self, cached, aliases=()):
+        """ثبت entity با همه کلیدهایش (peer_id، username و نام‌های مستعار)"""
+        previous = self._entries.get(cached.peer_id)
+        if previous and previous.username and previous.username != cached.username:
+            # کانال تغییر نام داده است؛ username قبلی دیگر به این کانال اشاره نمی‌کند
+            self._keys.pop(self.normalize_key(previous.username), None)
+        self._entries[cached.peer_id] = cached
+        self._keys[str(cached.peer_id)] = cached.peer_id
+        if cached.username:
+            self._keys[self.normalize_key(cached.username)] = cached.peer_id
+        for alias in aliases:
+            self._keys[self.normalize_key(alias)] = cached.peer_id
+
+    def get(self, key):
+        """برگرداندن entity کش شده برای username یا id (None اگر وجود ندارد یا منقضی شده)"""
+        peer_id = self._keys.get(self.normalize_key(key))
+        if peer_id is None:
+            return None
+        cached = self._entries.get(peer_id)
+        if cached is None or time.time() - cached.resolved_at > self.ttl:
+            return None
+        return cached
+
+    def put(self, entity, aliases=()):
+        """اضافه کردن entity resolve شده به کش و ذخیره snapshot"""
+        cached = CachedEntity.from_entity(entity)
+        previous = self._entries.get(cached.peer_id)
+        self._index(cached, aliases)
+        if previous is None or previous.to_dict() != cached.to_dict() or aliases:
+            self._dirty = True
+            self.save(force=False)
+        return cached
+
+    def invalidate(self, key):
+        """حذف صریح یک entity از کش (مثلاً وقتی کانال تغییر نام داده است)"""
+        peer_id = self._keys.get(self.normalize_key(key))
+        if peer_id is None:
+            return False
+        self._entries.pop(peer_id, None)
+        self._keys = {k: v for k, v in self._keys.items() if v != peer_id}
+        self._dirty = True
+        self.save(force=False)
+        return True
+
+# نمونه سراسری EntityCache (در اولین استفاده ساخته می‌شود)
+entity_cache = None
+
+# کش entity حساب‌های دیگر در حالت چند حسابی (نام session: EntityCache)
+entity_caches = {}
+
+def get_entity_cache(client=None):
+    """برگرداندن EntityCache یک حساب (بدون client یا برای حساب اصلی، کش سراسری)
+
+    access_hash هر entity فقط برای حسابی که آن را resolve کرده معتبر است، بنابراین
+    هر حساب در حالت چند حسابی کش و فایل snapshot جداگانه دارد.
+    """
+    global entity_cache
+    session_name = client_pool.name_of(client) if client_pool is not None and client is not None else None
+    if session_name is None or session_name == SESSION_NAMES[0]:
+        if entity_cache is None:
+            entity_cache = EntityCache(ENTITY_CACHE_FILE, ENTITY_CACHE_TTL)
+        return entity_cache
+    cache = entity_caches.get(session_name)
+    if cache is None:
+        root, extension = os.path.splitext(ENTITY_CACHE_FILE)
+        cache = EntityCache(f'{root}.{session_name}{extension}', ENTITY_CACHE_TTL)
+        entity_caches[session_name] = cache
+    return cache
+
+# کلاینت‌ها با flood_sleep_threshold=0 ساخته می‌شوند تا هر FloodWait ارسال به SendScheduler برسد (توقف همان
+# کانال هدف، جابجایی حساب و متریک‌ها)؛ درخواست‌های خواندن FloodWait تا این مدت (ثانیه) را مثل Telethon صبر می‌کنند
+READ_FLOOD_SLEEP_THRESHOLD = 60
+
+async def call_with_flood_sleep(func, *args, **kwargs):
+    """اجرای یک درخواست خواندن (get_entity، get_messages و ...) با صبر و تلاش دوباره بعد از FloodWait کوتاه"""
+    while True:
+        try:
+            return await func(*args, **kwargs)
+        except FloodWaitError as e:
+            if e.seconds > READ_FLOOD_SLEEP_THRESHOLD:
+                raise
+            flood_waits_total.inc()
+            flood_wait_seconds_total.inc(e.seconds)
+            logger.warning(f"⏳ محدودیت نرخ درخواست {getattr(func, '__name__', func)}: {e.seconds} ثانیه صبر", extra=log_context(stage='read'))
+            await asyncio.sleep(e.seconds + 1)
+
+async def resolve_entity(client, key):
+    """resolve کردن کانال با استفاده از کش (فقط در صورت نبودن در کش درخواست شبکه ارسال می‌شود)"""
+    cache = get_entity_cache(client)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    entity = await call_with_flood_sleep(client.get_entity, key)
+    return cache.put(entity, aliases=(key,))
+
+async def get_event_entity(event):
+    """برگرداندن entity کانال یک event با استفاده از کش همان حسابی که event را دریافت کرده"""
+    cache = get_entity_cache(getattr(event, 'client', None))
+    cached = cache.get(event.chat_id)
+    # event.chat بدون درخواست شبکه در دسترس است؛ اگر username تغییر کرده باشد کش را به‌روز می‌کنیم
+    chat = event.chat
+    if cached is not None and (chat is None or getattr(chat, 'username', None) == cached.username):
+        return cached
+    if chat is None:
+        chat = await call_with_flood_sleep(event.get_chat)
+    try:
+        return cache.put(chat)
+    except TypeError:
+        # entity های min (بدون access_hash معتبر) قابل کش نیستند
+        return chat
 
 def get_channel_key(entity, fallback_id=None):
     """تابع مشترک برای ساخت channel_key از entity"""
@@ -59,7 +1198,7 @@ def get_channel_key(entity, fallback_id=None):
         return None
 
 def get_all_channel_keys(entity, channel_username=None, chat_id=None):
-    """برگرداندن همه کلیدهای ممکن برای یک کانال"""
+    """برگرداندن همه کلیدهای ممکن برای یک کانال (فقط برای مهاجرت از فایل قدیمی JSON)"""
     keys = set()  # زززززاستفاده از set برای جلوگیری از تکراری
     entity_username = getattr(entity, 'username', None)
     
@@ -109,31 +1248,9 @@ def truncate_caption(text, max_length=1024):
     # برش متن و اضافه کردن "..."
     return text[:max_length - 3] + "..."
 
-def remove_channel_signature(text):
-    """حذف متن 'کانال رسمی روزنامه دنیای اقتصاد' با آیکون‌های قبل و بعدش"""
-    if not text:
-        return text
-    
-    # الگو برای پیدا کردن آیکون‌ها (emoji) قبل و بعد از متن
-    # این الگو آیکون‌ها، فاصله‌ها و متن را پیدا می‌کند
-    patterns = [
-        # الگو برای آیکون‌ها + متن + آیکون‌ها
-        r'[^\w\s]*\s*کانال\s+رسمی\s+روزنامه\s+دنیای\s+اقتصاد\s*[^\w\s]*',
-        # الگو برای متن با تغییرات کوچک در فاصله‌گذاری
-        r'[^\w\s]*\s*کانال\s*رسمی\s*روزنامه\s*دنیای\s*اقتصاد\s*[^\w\s]*',
-        # الگو برای متن در ابتدا یا انتهای پیام
-        r'^[^\w\s]*\s*کانال\s+رسمی\s+روزنامه\s+دنیای\s+اقتصاد\s*[^\w\s]*\s*',
-        r'\s*[^\w\s]*\s*کانال\s+رسمی\s+روزنامه\s+دنیای\s+اقتصاد\s*[^\w\s]*$',
-    ]
-    
-    for pattern in patterns:
-        text = re.sub(pattern, '', text, flags=re.IGNORECASE | re.MULTILINE)
-    
-    # حذف خطوط خالی اضافی
-    text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
-    text = text.strip()
-    
-    return text
+def remove_channel_signature(text, source_username=None):
+    """حذف امضای کانال (مثل 'کانال رسمی روزنامه دنیای اقتصاد') با آیکون‌های قبل و بعدش"""
+    return get_transform_pipeline(source_username).strip_signatures(text)
 
 def add_username_to_long_text(text, username, min_length=200):
     """اضافه کردن username به انتهای متن‌های طولانی"""
@@ -159,6 +1276,890 @@ def add_username_to_long_text(text, username, min_length=200):
     
     return text
 
+# قوانین پیش‌فرض تبدیل متن (در صورت نبودن فایل TRANSFORM_RULES_FILE)
+DEFAULT_TRANSFORM_RULES = {
+    # امضاهایی که از متن حذف می‌شوند؛ کلید '*' برای همه کانال‌های منبع است
+    'signatures': {
+        '*': ['کانال رسمی روزنامه دنیای اقتصاد'],
+    },
+    # حداقل طول متن برای اضافه کردن username کانال ما به انتهای آن
+    'footer_min_length': 200,
+}
+
+# الگوی حذف خطوط خالی اضافی
+EXTRA_BLANK_LINES_PATTERN = re.compile(r'\n\s*\n\s*\n')
+
+def load_transform_rules(file_path):
+    """بارگذاری قوانین تبدیل متن از فایل JSON (یا قوانین پیش‌فرض)"""
+    if not os.path.exists(file_path):
+        return DEFAULT_TRANSFORM_RULES
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+    except (json.JSONDecodeError, IOError, OSError) as e:
+        logger.warning(f"⚠️ خطا در خواندن فایل {file_path}: {e} - از قوانین پیش‌فرض استفاده می‌شود")
+        return DEFAULT_TRANSFORM_RULES
+    return {**DEFAULT_TRANSFORM_RULES, **rules}
+
+def trie_pattern(sequences, separator=''):
+    """ساخت یک regex درخت‌مانند (trie) از چند دنباله توکن
+
+    پیشوندهای مشترک فقط یک بار بررسی می‌شوند، بنابراین هزینه تطبیق تقریباً مستقل از
+    تعداد قوانین است. separator بین توکن‌های متوالی قرار می‌گیرد (مثلاً \\s* بین کلمات).
+    """
+    trie = {}
+    for sequence in sequences:
+        node = trie
+        for token in sequence:
+            node = node.setdefault(token, {})
+        node[''] = {}
+
+    def build(node, is_root=False):
+        alternatives = [re.escape(token) + build(child) for token, child in sorted(node.items()) if token]
+        if not alternatives:
+            return ''
+        group = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+        if is_root:
+            return group
+        body = separator + group
+        # اگر دنباله‌ای در همین گره تمام شود، ادامه اختیاری است
+        if '' in node:
+            return f'(?:{body})?'
+        return f'(?:{body})' if separator else body
+
+    return build(trie, is_root=True)
+
+def signature_to_pattern(signature):
+    """تبدیل یک قانون امضا به regex
+
+    رشته ساده: کلمات با هر تعداد فاصله و آیکون‌های قبل و بعدش حذف می‌شوند.
+    {"regex": "..."}: الگوی regex به همان صورت استفاده می‌شود.
+    """
+    if isinstance(signature, dict):
+        return signature['regex']
+    words = [re.escape(word) for word in signature.split()]
+    return r'[^\w\s]*\s*' + r'\s*'.join(words) + r'\s*[^\w\s]*'
+
+class TransformPipeline:
+    """زنجیره تبدیل متن که فقط یک بار از روی قوانین compile می‌شود
+
+    همه امضاهای یک کانال منبع در یک regex و همه username های قابل جایگزینی در یک
+    alternation ترکیب می‌شوند، بنابراین با اضافه شدن قوانین فقط یک پیمایش متن انجام می‌شود.
+    """
+
+    def __init__(self, signatures, replace_usernames, new_username, footer_min_length):
+        self.new_username = new_username.lstrip('@') if new_username else ''
+        self.footer_min_length = footer_min_length
+        
+        # امضاهای متنی در یک trie از کلمات و امضاهای regex به صورت alternation ترکیب می‌شوند
+        phrases = [signature.split() for signature in signatures if isinstance(signature, str) and signature.split()]
+        patterns = [signature_to_pattern(signature) for signature in signatures if isinstance(signature, dict)]
+        if phrases:
+            patterns.insert(0, r'[^\w\s]*\s*' + trie_pattern(phrases, separator=r'\s*') + r'\s*[^\w\s]*')
+        self._signature_re = (
+            re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE | re.MULTILINE)
+            if patterns else None
+        )
+        
+        # همه username ها در یک پیمایش جایگزین می‌شوند
+        usernames = {u.lstrip('@').lower() for u in replace_usernames if u and u.lstrip('@')}
+        self._username_re = (
+            re.compile('@' + trie_pattern(usernames) + r'\b', re.IGNORECASE)
+            if usernames and self.new_username else None
+        )
+
+    def strip_signatures(self, text):
+        """حذف امضاهای کانال و خطوط خالی اضافی"""
+        if not text:
+            return text
+        if self._signature_re is not None:
+            text = self._signature_re.sub('', text)
+        # حذف خطوط خالی اضافی
+        text = EXTRA_BLANK_LINES_PATTERN.sub('\n\n', text)
+        return text.strip()
+
+    def rewrite(self, text, footer=True):
+        """جایگزینی username ها و اضافه کردن username به انتهای متن‌های طولانی (اگر footer_min_length None نباشد)"""
+        if not text or not self.new_username:
+            return text
+        if self._username_re is not None:
+            text = self._username_re.sub(f'@{self.new_username}', text)
+        return self.add_footer(text) if footer else text
+
+    def add_footer(self, text):
+        """اضافه کردن username کانال هدف به انتهای متن طولانی (مثلاً یک بار برای کل پست خلاصه)"""
+        if not text or not self.new_username or self.footer_min_length is None:
+            return text
+        return add_username_to_long_text(text, self.new_username, min_length=self.footer_min_length)
+
+    @property
+    def footer_length(self):
+        """حداکثر طولی که add_footer به متن اضافه می‌کند"""
+        return len(self.new_username) + 3 if self.new_username and self.footer_min_length is not None else 0
+
+    def apply(self, text):
+        """اجرای کامل زنجیره تبدیل روی متن"""
+        return self.rewrite(self.strip_signatures(text))
+
+# قوانین تبدیل متن که یک بار در راه‌اندازی بارگذاری می‌شوند
+TRANSFORM_RULES = load_transform_rules(TRANSFORM_RULES_FILE)
+
+# زنجیره‌های compile شده برای هر (کانال منبع، کانال هدف)
+transform_pipelines = {}
+
+def get_target_rules(target):
+    """username جدید و حداقل طول متن برای footer یک کانال هدف
+
+    از بخش targets فایل قوانین خوانده می‌شود؛ مقدار footer_min_length برابر null یعنی footer اضافه نشود.
+    کانال‌هایی که قانون ندارند از NEW_USERNAME و footer_min_length کلی استفاده می‌کنند.
+    """
+    rules = {}
+    if target:
+        target_key = EntityCache.normalize_key(target)
+        for name, target_rules in TRANSFORM_RULES.get('targets', {}).items():
+            if EntityCache.normalize_key(name) == target_key:
+                rules = target_rules
+                break
+    return (
+        rules.get('new_username', NEW_USERNAME),
+        rules.get('footer_min_length', TRANSFORM_RULES.get('footer_min_length', 200))
+    )
+
+def get_transform_pipeline(source_username=None, target=None):
+    """برگرداندن زنجیره تبدیل compile شده برای یک کانال منبع و یک کانال هدف (هر ترکیب فقط یک بار compile می‌شود)"""
+    source_key = EntityCache.normalize_key(source_username) if source_username else ''
+    target_key = EntityCache.normalize_key(target) if target else ''
+    cache_key = (source_key, target_key)
+    pipeline = transform_pipelines.get(cache_key)
+    if pipeline is None:
+        signature_rules = TRANSFORM_RULES.get('signatures', {})
+        signatures = list(signature_rules.get('*', []))
+        for channel, channel_signatures in signature_rules.items():
+            if channel != '*' and EntityCache.normalize_key(channel) == source_key:
+                signatures.extend(channel_signatures)
+        # اگر REPLACE_USERNAME مشخص شده باشد، همه آن‌ها جایگزین می‌شوند؛
+        # در غیر این صورت، username کانال منبع جایگزین می‌شود
+        replace_usernames = REPLACE_USERNAME or ([source_username] if source_username else [])
+        new_username, footer_min_length = get_target_rules(target)
+        pipeline = TransformPipeline(signatures, replace_usernames, new_username, footer_min_length)
+        transform_pipelines[cache_key] = pipeline
+    return pipeline
+
+# کاراکترهای نامرئی که در متن‌های کپی شده بین کانال‌ها متفاوت هستند
+INVISIBLE_CHARS_PATTERN = re.compile('[\u200b-\u200f\u202a-\u202e\u2066-\u2069\ufeff]')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_for_dedup(text):
+    """نرمال‌سازی متن تبدیل شده برای مقایسه: حذف کاراکترهای نامرئی، یکسان‌سازی فاصله‌ها و حروف کوچک"""
+    if not text:
+        return ''
+    text = INVISIBLE_CHARS_PATTERN.sub('', text)
+    return WHITESPACE_PATTERN.sub(' ', text).strip().lower()
+
+def normalize_for_keywords(text):
+    """نرمال‌سازی متن و کلمات کلیدی برای تطبیق: حروف کوچک، یکسان‌سازی حروف عربی و فارسی، حذف نیم‌فاصله و یکسان‌سازی فاصله‌ها"""
+    if not text:
+        return ''
+    text = INVISIBLE_CHARS_PATTERN.sub('', text.lower().translate(PERSIAN_NORMALIZATION_TABLE))
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+class KeywordMatcher:
+    """تطبیق همزمان همه کلمات کلیدی با automaton Aho-Corasick
+
+    همه کلمات کلیدی یک بار در یک trie با پیوندهای شکست (failure link) compile می‌شوند و متن فقط
+    یک بار پیمایش می‌شود، بنابراین زمان تطبیق به طول متن بستگی دارد و نه به تعداد کلمات کلیدی.
+    تطبیق روی زیررشته است («بورس» با «بورسی» هم منطبق می‌شود).
+    """
+
+    def __init__(self, keywords):
+        # keywords: (کلمه کلیدی، شناسه قانون)
+        self._goto = [{}]
+        outputs = [set()]
+        for keyword, rule_id in keywords:
+            keyword = normalize_for_keywords(keyword)
+            if not keyword:
+                continue
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    outputs.append(set())
+                state = next_state
+            outputs[state].add(rule_id)
+        
+        # پیوند شکست هر حالت طولانی‌ترین پسوند آن است که در trie وجود دارد (پیمایش سطح به سطح)؛
+        # خروجی آن پسوند به خروجی حالت اضافه می‌شود تا کلمات کلیدی داخل هم هم پیدا شوند
+        self._fail = [0] * len(self._goto)
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, child in self._goto[state].items():
+                pending.append(child)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0) if state else 0
+                outputs[child] |= outputs[self._fail[child]]
+        self._output = [frozenset(output) for output in outputs]
+
+    def __len__(self):
+        """تعداد حالت‌های automaton"""
+        return len(self._goto)
+
+    def match(self, text):
+        """شناسه قوانینی که حداقل یکی از کلمات کلیدی آن‌ها در متن وجود دارد"""
+        goto, fail, output = self._goto, self._fail, self._output
+        matched = set()
+        state = 0
+        for char in normalize_for_keywords(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                matched |= output[state]
+        return matched
+
+class MessageFilter:
+    """قوانین فیلتر و مسیریابی با کلمات کلیدی (بخش filters فایل قوانین تبدیل متن)
+
+    هر قانون شامل name، keywords و action است: drop پیام شامل هر یک از کلمات را ارسال نمی‌کند و
+    require فقط پیام‌های شامل حداقل یکی از کلمات را ارسال می‌کند. sources و targets (اختیاری) قانون
+    را به کانال‌های منبع و هدف مشخص محدود می‌کنند. اگر برای یک کانال منبع و هدف چند قانون require
+    وجود داشته باشد، منطبق شدن یکی از آن‌ها کافی است و drop همیشه مقدم است.
+    digest پیام‌های متنی منطبق را در پست خلاصه ارسال می‌کند و priority پیام منطبق را هیچ‌وقت در
+    خلاصه قرار نمی‌دهد (فوراً ارسال می‌شود).
+    کلمات کلیدی همه قوانین در یک KeywordMatcher ترکیب می‌شوند، بنابراین هر پیام فقط یک بار تطبیق
+    داده می‌شود و نتیجه بین همه کانال‌های هدف مشترک است.
+    """
+
+    ACTIONS = ('drop', 'require', 'digest', 'priority')
+
+    def __init__(self, rules):
+        self.rules = []  # (نام، action، کانال‌های منبع یا None، کانال‌های هدف یا None)
+        keywords = []
+        for index, rule in enumerate(rules):
+            action = rule.get('action', 'drop')
+            if action not in self.ACTIONS:
+                logger.warning(f"⚠️ قانون فیلتر {rule.get('name', index)} با action نامعتبر {action} نادیده گرفته شد")
+                continue
+            rule_id = len(self.rules)
+            self.rules.append((
+                str(rule.get('name') or f'rule_{index}'),
+                action,
+                {EntityCache.normalize_key(channel) for channel in rule['sources']} if rule.get('sources') else None,
+                {EntityCache.normalize_key(channel) for channel in rule['targets']} if rule.get('targets') else None,
+            ))
+            keywords.extend((keyword, rule_id) for keyword in rule.get('keywords', []))
+        self._matcher = KeywordMatcher(keywords)
+        self.actions = {action for _, action, _, _ in self.rules}
+        # (کانال منبع، کانال هدف) -> action -> شناسه قوانین
+        self._applicable = {}
+
+    def match(self, text):
+        """شناسه قوانین منطبق با متن (یک پیمایش برای همه قوانین)"""
+        return self._matcher.match(text) if self.rules else set()
+
+    def applicable_rules(self, source_username, target):
+        """شناسه قوانین هر action برای یک کانال منبع و یک کانال هدف"""
+        source_key = EntityCache.normalize_key(source_username) if source_username else ''
+        target_key = EntityCache.normalize_key(target) if target else ''
+        cache_key = (source_key, target_key)
+        applicable = self._applicable.get(cache_key)
+        if applicable is None:
+            ids = {action: set() for action in self.ACTIONS}
+            for rule_id, (_, action, sources, targets) in enumerate(self.rules):
+                if (sources is None or source_key in sources) and (targets is None or target_key in targets):
+                    ids[action].add(rule_id)
+            applicable = {action: frozenset(rule_ids) for action, rule_ids in ids.items()}
+            self._applicable[cache_key] = applicable
+        return applicable
+
+    def matched_rules(self, matched, source_username, target, action):
+        """نام قوانین یک action که برای این کانال منبع و هدف منطبق شده‌اند"""
+        rule_ids = self.applicable_rules(source_username, target)[action]
+        return [self.rules[rule_id][0] for rule_id in sorted(rule_ids & matched)]
+
+    def check(self, matched, source_username, target):
+        """(ارسال شود یا نه، نام قوانین منطبق) برای یک کانال هدف با شناسه قوانین منطبق match"""
+        dropped = self.matched_rules(matched, source_username, target, 'drop')
+        if dropped:
+            return False, dropped
+        required = self.matched_rules(matched, source_username, target, 'require')
+        if self.applicable_rules(source_username, target)['require'] and not required:
+            return False, []
+        return True, required
+
+# نمونه سراسری MessageFilter (با تغییر قوانین دوباره ساخته می‌شود)
+message_filter = None
+
+def get_message_filter():
+    """برگرداندن MessageFilter سراسری از قوانین فعلی"""
+    global message_filter
+    if message_filter is None:
+        message_filter = MessageFilter(TRANSFORM_RULES.get('filters', []))
+    return message_filter
+
+def get_media_key(media):
+    """شناسه پایدار رسانه (id عکس یا سند)؛ برای WebPage و رسانه‌های دیگر None"""
+    if isinstance(media, MessageMediaPhoto) and media.photo is not None:
+        return f'photo:{media.photo.id}'
+    if isinstance(media, MessageMediaDocument) and media.document is not None:
+        return f'document:{media.document.id}'
+    return None
+
+def message_fingerprint(messages, texts):
+    """اثرانگشت یک پیام (یا همه بخش‌های یک آلبوم) از متن تبدیل شده و شناسه رسانه‌ها
+
+    متن بعد از حذف امضا و جایگزینی username مقایسه می‌شود، بنابراین یک خبر که در چند
+    کانال منبع با امضاهای متفاوت منتشر شده است اثرانگشت یکسانی دارد.
+    برای پیامی که نه متن دارد و نه رسانه قابل شناسایی، None برگردانده می‌شود.
+    """
+    parts = []
+    for message, text in zip(messages, texts):
+        media_key = get_media_key(message.media)
+        normalized = normalize_for_dedup(text)
+        if media_key:
+            parts.append(media_key)
+        if normalized:
+            parts.append(normalized)
+    if not parts:
+        return None
+    return hashlib.blake2b('\x1f'.join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+class DedupIndex:
+    """شاخص اثرانگشت خبرهای ارسال شده برای جلوگیری از ارسال نسخه‌های تکراری از کانال‌های مختلف
+
+    اثرانگشت‌ها به ترتیب زمان در یک OrderedDict نگه داشته می‌شوند؛ بررسی تکراری بودن O(1) است و
+    اثرانگشت‌های قدیمی‌تر از ttl یا بیشتر از max_entries از ابتدای آن حذف می‌شوند.
+    هر اثرانگشت صاحب خودش (chat_id و message_id) را دارد تا تلاش مجدد ارسال همان پیام تکراری حساب نشود.
+    اثرانگشت‌ها برای هر کانال هدف جداگانه ثبت می‌شوند؛ خبری که برای یک کانال هدف فیلتر یا ناموفق شده
+    مانع ارسال نسخه دیگر همان خبر به آن کانال نمی‌شود.
+    """
+
+    def __init__(self, snapshot_path, ttl, max_entries, save_interval=0):
+        self.snapshot_path = snapshot_path
+        self.ttl = ttl
+        self.max_entries = max(max_entries, 1)
+        self.save_interval = save_interval
+        self._entries = OrderedDict()  # (target، fingerprint) -> (seen_at, chat_id, message_id)
+        self._dirty = False
+        self._saved_at = 0.0
+        self._write_future = None
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        """بارگذاری snapshot شاخص از فایل"""
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            # snapshot های قدیمی کانال هدف ندارند
+            for fingerprint, seen_at, chat_id, message_id, *target in sorted(snapshot.get('entries', []), key=lambda item: item[1]):
+                self._entries[(target[0] if target else '', fingerprint)] = (seen_at, chat_id, message_id)
+        except (json.JSONDecodeError, IOError, OSError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ خطا در خواندن فایل {self.snapshot_path}: {e}")
+        self._evict(time.time())
+
+    def save(self, force=True):
+        """ذخیره اتمیک snapshot
+
+        بدون force حداکثر یک بار در هر save_interval و در snapshot_executor (بدون صبر برای پایان نوشتن)
+        ذخیره می‌شود تا ثبت اثرانگشت در مسیر ارسال منتظر fsync نماند؛ با force (هنگام خروج) تا پایان
+        نوشتن صبر می‌شود.
+        """
+        now = time.time()
+        # تا پایان نوشتن قبلی snapshot دیگری در صف قرار نمی‌گیرد (dirty می‌ماند) تا نوشتن‌ها روی هم جمع نشوند
+        if self._dirty and (force or (not self._writing() and now - self._saved_at >= self.save_interval)):
+            self._evict(now)
+            # کپی entries در همین thread گرفته می‌شود تا تغییرات بعدی روی فایل در حال نوشتن اثر نگذارد
+            self._dirty = False
+            self._saved_at = now
+            self._write_future = snapshot_executor.submit(self._write_snapshot, list(self._entries.items()))
+        if force and self._write_future is not None:
+            self._write_future.result()
+
+    def _writing(self):
+        return self._write_future is not None and not self._write_future.done()
+
+    def _write_snapshot(self, items):
+        entries = [[fingerprint, *entry, target] for (target, fingerprint), entry in items]
+        try:
+            write_json_atomic(self.snapshot_path, {'entries': entries})
+        except (IOError, OSError) as e:
+            self._dirty = True
+            logger.warning(f"⚠️ خطا در ذخیره فایل {self.snapshot_path}: {e}")
+
+    def _evict(self, now):
+        """حذف اثرانگشت‌های منقضی شده و اضافی از ابتدای صف"""
+        while self._entries:
+            _, (seen_at, _, _) = next(iter(self._entries.items()))
+            if now - seen_at <= self.ttl and len(self._entries) <= self.max_entries:
+                break
+            self._entries.popitem(last=False)
+            self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def claim(self, fingerprint, chat_id, message_id, target=''):
+        """ثبت اثرانگشت برای یک پیام در یک کانال هدف؛ اگر پیام دیگری قبلاً آن را ثبت کرده باشد False برمی‌گرداند
+
+        ثبت قبل از ارسال انجام می‌شود تا دو کانال که همزمان همان خبر را دارند هر دو ارسال نکنند.
+        """
+        now = time.time()
+        self._evict(now)
+        key = (target, fingerprint)
+        entry = self._entries.get(key)
+        if entry is not None and (entry[1], entry[2]) != (chat_id, message_id):
+            return False
+        if entry is None:
+            self._entries[key] = (now, chat_id, message_id)
+            self._dirty = True
+            self._evict(now)
+            self.save(force=False)
+        return True
+
+    def release(self, fingerprint, chat_id, message_id, target=''):
+        """آزاد کردن اثرانگشت پیامی که ارسالش به یک کانال هدف نهایتاً ناموفق بود تا نسخه دیگر آن ارسال شود"""
+        key = (target, fingerprint)
+        entry = self._entries.get(key)
+        if entry is not None and (entry[1], entry[2]) == (chat_id, message_id):
+            del self._entries[key]
+            self._dirty = True
+
+# نمونه سراسری DedupIndex (در اولین استفاده ساخته می‌شود)
+dedup_index = None
+
+def get_dedup_index():
+    """برگرداندن DedupIndex سراسری"""
+    global dedup_index
+    if dedup_index is None:
+        dedup_index = DedupIndex(
+            DEDUP_SNAPSHOT_FILE,
+            DEDUP_WINDOW_SECONDS,
+            DEDUP_MAX_ENTRIES,
+            save_interval=DEDUP_SNAPSHOT_INTERVAL
+        )
+    return dedup_index
+
+# یکسان‌سازی حروف عربی و فارسی، ارقام و حذف اعراب و کشیده برای مقایسه متن‌های فارسی
+PERSIAN_NORMALIZATION_TABLE = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'ۀ': 'ه',
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ؤ': 'و',
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(code): None for code in range(0x064B, 0x0660)},
+    '\u0670': None, 'ـ': None,
+})
+# لینک‌ها و username ها در بازنویسی‌های مختلف یک خبر متفاوت هستند و در مقایسه شرکت نمی‌کنند
+LINKS_AND_MENTIONS_PATTERN = re.compile(r'https?://\S+|t\.me/\S+|@\w+')
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize_persian(text):
+    """کلمات نرمال شده یک متن فارسی
+
+    نیم‌فاصله (ZWNJ) حذف می‌شود تا «می‌شود» و «میشود» یک کلمه باشند و
+    حروف عربی (ي، ك و ...) به معادل فارسی تبدیل می‌شوند.
+    """
+    if not text:
+        return []
+    text = INVISIBLE_CHARS_PATTERN.sub('', text).lower()
+    text = LINKS_AND_MENTIONS_PATTERN.sub(' ', text.translate(PERSIAN_NORMALIZATION_TABLE))
+    return TOKEN_PATTERN.findall(text)
+
+# تقسیم امضای MinHash به باندهای LSH (باندها × سطرها = تعداد hash)؛ دو خبر با شباهت s با احتمال
+# 1 - (1 - s^سطرها)^باندها کاندیدا می‌شوند و نقطه عطف این منحنی (1/21)^(1/6) ≈ 0.6 همان
+# NEAR_DUP_THRESHOLD پیش‌فرض است، بنابراین خبرهای کم‌شباهت پنجره به ندرت کاندیدا می‌شوند
+MINHASH_BANDS = 21
+MINHASH_ROWS = 6
+MINHASH_PERMUTATIONS = MINHASH_BANDS * MINHASH_ROWS
+
+def minhash(tokens):
+    """امضای MinHash مجموعه کلمات و جفت کلمات پشت سر هم یک متن
+
+    نسبت مقادیر برابر در امضای دو متن تخمینی از شباهت Jaccard آن دو است. خروجی shake_128 هر
+    feature به MINHASH_PERMUTATIONS عدد 64 بیتی مستقل تقسیم می‌شود (یک تابع hash برای هر
+    جایگشت) و کمینه هر ستون در C محاسبه می‌شود.
+    """
+    features = set(tokens)
+    features.update(f'{a} {b}' for a, b in zip(tokens, tokens[1:]))
+    hashes = [
+        array('Q', hashlib.shake_128(feature.encode('utf-8')).digest(MINHASH_PERMUTATIONS * 8))
+        for feature in features
+    ]
+    return array('Q', map(min, zip(*hashes)))
+
+def minhash_similarity(a, b):
+    """تخمین شباهت Jaccard از روی دو امضای MinHash"""
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+class NearDupIndex:
+    """شاخص LSH از امضای MinHash خبرهای ارسال شده برای تشخیص نسخه‌های بازنویسی شده یک خبر
+
+    امضا به باندهای چند سطری تقسیم می‌شود و هر باند کلید یک bucket است؛ متن‌های مشابه
+    با احتمال زیاد حداقل در یک باند یکسان هستند. جستجو فقط همان bucket ها را بررسی می‌کند؛
+    هزینه آن با تعداد کاندیداها (خبرهای پنجره با شباهت نزدیک به threshold) رشد می‌کند که با
+    تنظیم MINHASH_BANDS و MINHASH_ROWS درصد کوچکی از پنجره است.
+    کلید خبرهای ربات (chat_id، message_id، target) است و هر کانال هدف فقط با خبرهای همان کانال مقایسه می‌شود.
+    برای کم کردن حافظه، کلید bucket ها hash بایت‌های باند است (برخورد hash فقط یک کاندیدای اضافه
+    می‌سازد که با مقایسه امضا رد می‌شود) و bucket تک عضوی خود کلید خبر را بدون list نگه می‌دارد.
+    """
+
+    def __init__(self, window_seconds, threshold, max_entries=100000, bands=MINHASH_BANDS):
+        self.window_seconds = window_seconds
+        self.threshold = threshold
+        self.max_entries = max(max_entries, 1)
+        self.rows = MINHASH_PERMUTATIONS // bands
+        self._buckets = [{} for _ in range(bands)]  # hash باند -> key یا list(key)
+        self._entries = OrderedDict()  # (chat_id, message_id, target) -> (signature, seen_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _band_keys(self, signature):
+        width = self.rows * signature.itemsize
+        raw = signature.tobytes()
+        return [hash(raw[index * width:(index + 1) * width]) for index in range(len(self._buckets))]
+
+    def _candidates(self, signature):
+        """کلید خبرهایی که حداقل در یک باند با signature یکسان هستند"""
+        candidates = set()
+        for buckets, band_key in zip(self._buckets, self._band_keys(signature)):
+            bucket = buckets.get(band_key)
+            if isinstance(bucket, list):
+                candidates.update(bucket)
+            elif bucket is not None:
+                candidates.add(bucket)
+        return candidates
+
+    def _evict(self, now):
+        """حذف امضاهای خارج از پنجره زمانی و اضافی از ابتدای صف"""
+        while self._entries:
+            key, (signature, seen_at) = next(iter(self._entries.items()))
+            if now - seen_at <= self.window_seconds and len(self._entries) <= self.max_entries:
+                break
+            self._remove(key)
+
+    def _remove(self, key):
+        signature, _ = self._entries.pop(key)
+        for buckets, band_key in zip(self._buckets, self._band_keys(signature)):
+            bucket = buckets.get(band_key)
+            if isinstance(bucket, list):
+                if key in bucket:
+                    bucket.remove(key)
+                if len(bucket) == 1:
+                    buckets[band_key] = bucket[0]
+            elif bucket == key:
+                del buckets[band_key]
+
+    def find(self, signature, exclude=None, target=None, exclude_chat=None):
+        """کلید شبیه‌ترین خبر با شباهت حداقل threshold یا None
+
+        اگر target داده شود فقط خبرهای همان کانال هدف و اگر exclude_chat داده شود فقط خبرهای
+        کانال‌های منبع دیگر بررسی می‌شوند.
+        """
+        self._evict(time.time())
+        candidates = self._candidates(signature)
+        candidates.discard(exclude)
+        if target is not None or exclude_chat is not None:
+            candidates = {
+                key for key in candidates
+                if (target is None or key[-1] == target) and (exclude_chat is None or key[0] != exclude_chat)
+            }
+        best_key, best_similarity = None, self.threshold
+        for key in candidates:
+            similarity = minhash_similarity(signature, self._entries[key][0])
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+    def add(self, signature, key):
+        """ثبت امضای یک خبر"""
+        if key in self._entries:
+            return
+        self._entries[key] = (signature, time.time())
+        for buckets, band_key in zip(self._buckets, self._band_keys(signature)):
+            bucket = buckets.get(band_key)
+            if bucket is None:
+                buckets[band_key] = key
+            elif isinstance(bucket, list):
+                bucket.append(key)
+            else:
+                buckets[band_key] = [bucket, key]
+        self._evict(time.time())
+
+    def claim(self, signature, chat_id, message_id, target=''):
+        """ثبت امضا برای یک پیام در یک کانال هدف؛ اگر خبر مشابهی از کانال منبع دیگری ثبت شده باشد False برمی‌گرداند
+
+        پیام‌های همان کانال منبع با هم مقایسه نمی‌شوند: به‌روزرسانی یک خبر (مثلاً نرخ جدید دلار) توسط
+        همان کانال نسخه بازنویسی شده حساب نمی‌شود.
+        """
+        key = (chat_id, message_id, target)
+        if self.find(signature, exclude=key, target=target, exclude_chat=chat_id) is not None:
+            return False
+        self.add(signature, key)
+        return True
+
+    def release(self, chat_id, message_id, target=''):
+        """آزاد کردن امضای پیامی که ارسالش به یک کانال هدف نهایتاً ناموفق بود"""
+        key = (chat_id, message_id, target)
+        if key in self._entries:
+            self._remove(key)
+
+# نمونه سراسری NearDupIndex (در اولین استفاده ساخته می‌شود)
+near_dup_index = None
+
+def get_near_dup_index():
+    """برگرداندن NearDupIndex سراسری"""
+    global near_dup_index
+    if near_dup_index is None:
+        near_dup_index = NearDupIndex(NEAR_DUP_WINDOW_SECONDS, NEAR_DUP_THRESHOLD, NEAR_DUP_MAX_ENTRIES)
+    return near_dup_index
+
+def text_signature(texts):
+    """امضای MinHash متن (یا متن همه بخش‌های آلبوم)؛ None برای متن‌های کوتاه یا وقتی بررسی غیرفعال است"""
+    if NEAR_DUP_THRESHOLD <= 0:
+        return None
+    tokens = tokenize_persian('\n'.join(text for text in texts if text))
+    if len(tokens) < NEAR_DUP_MIN_TOKENS:
+        return None
+    return minhash(tokens)
+
+class TokenBucket:
+    """Token bucket ساده برای محدود کردن نرخ ارسال، با امکان توقف موقت (بعد از FloodWait)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        # صف منتظرها به ترتیب ورود سرویس می‌گیرند
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def pause(self, seconds):
+        """توقف ارسال تا seconds ثانیه بعد (زمان اعلام شده توسط سرور)"""
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated_at = max(self.updated_at, self.paused_until)
+
+    async def acquire(self):
+        """صبر تا زمانی که یک token آزاد شود"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class SendScheduler:
+    """زمان‌بندی مرکزی همه ارسال‌ها (send_message و send_file) به کانال‌های هدف
+
+    هر (حساب، کانال هدف) token bucket خودش را دارد و یک token bucket کلی هم برای هر حساب وجود دارد.
+    کلاینت‌ها با flood_sleep_threshold=0 ساخته می‌شوند، بنابراین هر FloodWait ارسال (حتی کوتاه) اینجا
+    گرفته می‌شود: فقط همان کانال هدف به اندازه زمان اعلام شده توسط سرور متوقف می‌شود و ارسال دوباره
+    تلاش می‌شود، بنابراین پیامی از دست نمی‌رود. در حالت چند حسابی اگر حساب دیگری آزاد باشد، خطا
+    فوراً برگردانده می‌شود تا ارسال با آن حساب انجام شود.
+    """
+
+    def __init__(self, rate_per_chat, burst_per_chat, rate_global, burst_global, max_retries):
+        self.rate_per_chat = rate_per_chat
+        self.burst_per_chat = burst_per_chat
+        self.rate_global = rate_global
+        self.burst_global = burst_global
+        self.max_retries = max_retries
+        self._account_buckets = {}
+        self._chat_buckets = {}
+
+    @staticmethod
+    def target_key(target):
+        """کلید یکتا برای کانال هدف (username، id یا entity)"""
+        if isinstance(target, (str, int)):
+            return EntityCache.normalize_key(target)
+        chat_id = get_canonical_chat_id(target)
+        return str(chat_id) if chat_id is not None else str(target)
+
+    def _bucket(self, target, account=''):
+        key = (account, self.target_key(target))
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate_per_chat, self.burst_per_chat)
+            self._chat_buckets[key] = bucket
+        return bucket
+
+    def _account_bucket(self, account=''):
+        bucket = self._account_buckets.get(account)
+        if bucket is None:
+            bucket = TokenBucket(self.rate_global, self.burst_global)
+            self._account_buckets[account] = bucket
+        return bucket
+
+    async def send(self, target, send_func, *args, **kwargs):
+        """اجرای send_func(*args, **kwargs) با رعایت محدودیت نرخ و تلاش مجدد بعد از FloodWait
+
+        send_func متد کلاینت حسابی است که ارسال را انجام می‌دهد (مثلاً client.send_message).
+        """
+        client = getattr(send_func, '__self__', None)
+        account = (client_pool.name_of(client) if client_pool is not None else None) or ''
+        bucket = self._bucket(target, account)
+        account_bucket = self._account_bucket(account)
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await account_bucket.acquire()
+            try:
+                return await send_func(*args, **kwargs)
+            except (FloodWaitError, SlowModeWaitError) as e:
+                flood_waits_total.inc()
+                flood_wait_seconds_total.inc(e.seconds)
+                if client_pool is not None and client is not None and isinstance(e, FloodWaitError):
+                    # محدودیت FloodWait مربوط به کل حساب است
+                    client_pool.pause(client, e.seconds)
+                    if client_pool.has_alternative(client, target):
+                        raise
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning(f"⏳ محدودیت نرخ ارسال برای {self.target_key(target)}: {e.seconds} ثانیه توقف (تلاش {attempt}/{self.max_retries})", extra=log_context(self.target_key(target), stage='send'))
+                bucket.pause(e.seconds + 1)
+
+# زمان‌بندی سراسری ارسال پیام‌ها
+send_scheduler = SendScheduler(
+    SEND_RATE_PER_CHAT,
+    SEND_BURST_PER_CHAT,
+    SEND_RATE_GLOBAL,
+    SEND_BURST_GLOBAL,
+    SEND_MAX_RETRIES
+)
+
+class HashRing:
+    """consistent hashing برای تقسیم کانال‌های منبع بین حساب‌ها
+
+    با اضافه یا حذف شدن یک حساب فقط کانال‌های همان حساب جابجا می‌شوند.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self._ring = sorted((self._hash(f'{node}#{i}'), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [item[0] for item in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def nodes_for(self, key):
+        """همه node ها به ترتیب اولویت برای یک کلید (اولی صاحب کلید است و بقیه جایگزین‌ها)"""
+        start = bisect.bisect(self._hashes, self._hash(key))
+        ordered = []
+        for index in range(len(self._ring)):
+            node = self._ring[(start + index) % len(self._ring)][1]
+            if node not in ordered:
+                ordered.append(node)
+                if len(ordered) == len(self.nodes):
+                    break
+        return ordered
+
+class ClientPool:
+    """مجموعه حساب‌های تلگرام در حالت چند حسابی
+
+    هر کانال منبع با consistent hashing به یک حساب خواننده عضو آن کانال سپرده می‌شود و ارسال‌های
+    هر کانال هدف به نوبت بین حساب‌هایی که در آن حق ارسال دارند پخش می‌شوند (verify_pool_access).
+    حسابی که FloodWait گرفته یا قطع شده تا پایان محدودیت کنار گذاشته می‌شود و کانال‌ها و
+    ارسال‌هایش به حساب بعدی منتقل می‌شوند.
+    """
+
+    def __init__(self, clients):
+        self.clients = dict(clients)  # نام session -> TelegramClient
+        self._names = {id(client): name for name, client in self.clients.items()}
+        self._ring = HashRing(self.clients)
+        self._paused_until = {}
+        self._next_sender = 0
+        self._senders = {}  # کانال هدف -> حساب‌هایی که حق ارسال دارند
+        self._members = {}  # کانال منبع -> حساب‌هایی که عضو کانال هستند
+
+    def name_of(self, client):
+        return self._names.get(id(client))
+
+    def is_available(self, name):
+        """حساب متصل است و محدودیت FloodWait ندارد"""
+        is_connected = getattr(self.clients[name], 'is_connected', None)
+        if is_connected is not None and not is_connected():
+            return False
+        return self._paused_until.get(name, 0) <= time.time()
+
+    def pause(self, client, seconds):
+        """کنار گذاشتن یک حساب تا پایان FloodWait"""
+        name = self.name_of(client)
+        if name is not None:
+            self._paused_until[name] = max(self._paused_until.get(name, 0), time.time() + seconds)
+            logger.warning(f"🔀 حساب {name} به مدت {seconds} ثانیه کنار گذاشته شد", extra=log_context(stage='pool'))
+
+    def set_senders(self, target, names):
+        """محدود کردن ارسال به یک کانال هدف به حساب‌های names (لیست خالی: همه حساب‌ها)"""
+        self._senders[SendScheduler.target_key(target)] = [name for name in self.clients if name in names]
+
+    def set_members(self, channels, names):
+        """ثبت حساب‌های عضو یک کانال منبع برای همه کلیدهای آن (لیست خالی: همه حساب‌ها)"""
+        for channel in channels:
+            self._members[EntityCache.normalize_key(channel)] = [name for name in self.clients if name in names]
+
+    def senders_for(self, target=None):
+        """حساب‌هایی که می‌توانند به کانال هدف ارسال کنند"""
+        names = self._senders.get(SendScheduler.target_key(target)) if target is not None else None
+        return names or list(self.clients)
+
+    def has_alternative(self, client, target=None):
+        """آیا حساب آزاد دیگری (با حق ارسال در کانال هدف) وجود دارد"""
+        name = self.name_of(client)
+        return any(self.is_available(other) for other in self.senders_for(target) if other != name)
+
+    def _first_available(self, names):
+        for name in names:
+            if self.is_available(name):
+                return self.clients[name]
+        # همه حساب‌ها محدود هستند؛ حسابی که زودتر آزاد می‌شود
+        return self.clients[min(names, key=lambda name: self._paused_until.get(name, 0))]
+
+    def reader_for(self, channel):
+        """حساب خواننده یک کانال منبع (event پیام‌های جدید فقط به حساب‌های عضو کانال می‌رسد)"""
+        key = EntityCache.normalize_key(channel)
+        names = self._ring.nodes_for(key)
+        members = self._members.get(key)
+        if members:
+            names = [name for name in names if name in members]
+        return self._first_available(names)
+
+    def sender(self, target=None):
+        """حساب ارسال کننده بعدی (به نوبت بین حساب‌های آزاد با حق ارسال در کانال هدف)"""
+        names = self.senders_for(target)
+        self._next_sender = (self._next_sender + 1) % len(names)
+        return self._first_available(names[self._next_sender:] + names[:self._next_sender])
+
+# مجموعه حساب‌ها در حالت چند حسابی (None در حالت تک حسابی)
+client_pool = None
+
+def get_reader_client(client, channel):
+    """حساب خواننده یک کانال منبع (در حالت تک حسابی همان client)"""
+    return client_pool.reader_for(channel) if client_pool is not None else client
+
+def get_sender_client(client, target=None):
+    """حساب ارسال کننده به کانال هدف (در حالت تک حسابی همان client)"""
+    return client_pool.sender(target) if client_pool is not None else client
+
 def clear_session_files(session_name):
     """پاک کردن فایل‌های session"""
     session_file = f"{session_name}.session"
@@ -169,70 +2170,422 @@ def clear_session_files(session_name):
         if os.path.exists(file_path):
             try:
                 os.remove(file_path)
-                print(f"🗑️ فایل {file_path} پاک شد")
+                logger.info(f"🗑️ فایل {file_path} پاک شد")
                 cleared = True
             except Exception as remove_error:
-                print(f"⚠️ خطا در پاک کردن {file_path}: {remove_error}")
+                logger.warning(f"⚠️ خطا در پاک کردن {file_path}: {remove_error}")
     
     return cleared
 
+async def has_write_permission(client, entity):
+    """بررسی حق ارسال پیام در کانال هدف از روی مجوزهای حساب (بدون ارسال پیام)"""
+    input_peer = entity.input_entity if isinstance(entity, CachedEntity) else utils.get_input_peer(entity)
+    if not isinstance(input_peer, types.InputPeerChannel):
+        # گروه معمولی: فقط عضویت و محدود نبودن حساب بررسی می‌شود
+        permissions = await call_with_flood_sleep(client.get_permissions, input_peer, 'me')
+        return not permissions.is_banned and not permissions.has_left
+    result = await call_with_flood_sleep(client, functions.channels.GetParticipantRequest(input_peer, types.InputPeerSelf()))
+    permissions = ParticipantPermissions(result.participant, False)
+    channel = next((chat for chat in result.chats if chat.id == input_peer.channel_id), None)
+    if getattr(channel, 'broadcast', True):
+        # در کانال فقط سازنده و ادمین‌های دارای دسترسی Post Messages می‌توانند پست بگذارند
+        return permissions.is_creator or permissions.post_messages
+    # در سوپرگروه اعضا هم می‌توانند پیام بفرستند مگر محدود شده باشند
+    return not permissions.is_banned
+
 async def check_channel_access(client, target_channel):
-    """بررسی دسترسی نوشتن در کانال هدف"""
+    """بررسی دسترسی نوشتن در کانال هدف
+
+    در حالت پیش‌فرض (ACCESS_CHECK_MODE=permissions) دسترسی از مجوزهای حساب در کانال خوانده می‌شود
+    و پیامی در کانال ارسال نمی‌شود؛ در حالت post یک پیام تست ارسال و فوراً حذف می‌شود.
+    """
+    if ACCESS_CHECK_MODE == 'off':
+        return True
     try:
-        entity = await client.get_entity(target_channel)
+        entity = await resolve_entity(client, target_channel)
         channel_title = getattr(entity, 'title', target_channel)
         
-        # بررسی دسترسی نوشتن با ارسال یک پیام تست خالی (که فوراً حذف می‌شود)
         try:
-            test_message = await client.send_message(target_channel, "🔍")
-            await client.delete_messages(target_channel, test_message)
-            print(f"✅ دسترسی نوشتن در کانال '{channel_title}' تأیید شد")
+            if ACCESS_CHECK_MODE == 'post':
+                # بررسی دسترسی نوشتن با ارسال یک پیام تست خالی (که فوراً حذف می‌شود)
+                test_message = await send_scheduler.send(target_channel, client.send_message, target_channel, "🔍")
+                await client.delete_messages(target_channel, test_message)
+            elif not await has_write_permission(client, entity):
+                raise ChatWriteForbiddenError(request=None)
+            logger.info(f"✅ دسترسی نوشتن در کانال '{channel_title}' تأیید شد")
             return True
         except (ChatWriteForbiddenError, UserBannedInChannelError) as e:
-            print(f"❌ خطا: دسترسی نوشتن در کانال '{channel_title}' وجود ندارد")
-            print(f"   💡 راهنمایی: مطمئن شوید که:")
-            print(f"      - حساب شما به عنوان ادمین در کانال هدف تنظیم شده است")
-            print(f"      - دسترسی 'Post Messages' برای حساب شما فعال است")
+            logger.error(
+                f"❌ خطا: دسترسی نوشتن در کانال '{channel_title}' وجود ندارد"
+                "\n   💡 راهنمایی: مطمئن شوید که:"
+                "\n      - حساب شما به عنوان ادمین در کانال هدف تنظیم شده است"
+                "\n      - دسترسی 'Post Messages' برای حساب شما فعال است"
+            )
             return False
-        except ChannelPrivateError:
-            print(f"❌ خطا: کانال '{channel_title}' خصوصی است و دسترسی ندارید")
-            print(f"   💡 راهنمایی: مطمئن شوید که حساب شما عضو کانال است")
+        except (ChannelPrivateError, UserNotParticipantError):
+            logger.error(
+                f"❌ خطا: کانال '{channel_title}' خصوصی است یا عضو آن نیستید"
+                "\n   💡 راهنمایی: مطمئن شوید که حساب شما عضو کانال است"
+            )
             return False
         except Exception as e:
             error_msg = str(e).lower()
             if "can't write" in error_msg or "write in this chat" in error_msg:
-                print(f"❌ خطا: دسترسی نوشتن در کانال '{channel_title}' وجود ندارد")
-                print(f"   💡 راهنمایی: مطمئن شوید که:")
-                print(f"      - حساب شما به عنوان ادمین در کانال هدف تنظیم شده است")
-                print(f"      - دسترسی 'Post Messages' برای حساب شما فعال است")
+                logger.error(
+                    f"❌ خطا: دسترسی نوشتن در کانال '{channel_title}' وجود ندارد"
+                    "\n   💡 راهنمایی: مطمئن شوید که:"
+                    "\n      - حساب شما به عنوان ادمین در کانال هدف تنظیم شده است"
+                    "\n      - دسترسی 'Post Messages' برای حساب شما فعال است"
+                )
             else:
-                print(f"⚠️ هشدار: مشکل در بررسی دسترسی به کانال '{channel_title}': {str(e)}")
+                logger.warning(f"⚠️ هشدار: مشکل در بررسی دسترسی به کانال '{channel_title}': {str(e)}")
             return False
     except Exception as e:
-        print(f"⚠️ هشدار: مشکل در دسترسی به کانال هدف: {str(e)}")
+        logger.warning(f"⚠️ هشدار: مشکل در دسترسی به کانال هدف: {str(e)}")
         return False
 
-async def forward_message(client, message, target_channel, old_username, new_username):
-    """ارسال پیام به کانال هدف با جایگزینی username"""
+async def is_channel_member(client, entity):
+    """آیا حساب عضو کانال منبع است (event پیام‌های جدید فقط به حساب‌های عضو می‌رسد)"""
+    input_peer = entity.input_entity if isinstance(entity, CachedEntity) else utils.get_input_peer(entity)
+    try:
+        permissions = await call_with_flood_sleep(client.get_permissions, input_peer, 'me')
+    except (UserNotParticipantError, ChannelPrivateError):
+        return False
+    return not permissions.has_left
+
+async def verify_pool_access(targets, sources):
+    """بررسی دسترسی همه حساب‌ها به کانال‌های هدف و عضویت آن‌ها در کانال‌های منبع (حالت چند حسابی)
+
+    حسابی که در یک کانال هدف حق ارسال ندارد از ارسال کنندگان همان کانال کنار گذاشته می‌شود و هر
+    کانال منبع فقط به حساب‌های عضو آن سپرده می‌شود. اگر هیچ حسابی بررسی را رد نکند همه حساب‌ها
+    استفاده می‌شوند تا خطای ارسال یا خواندن مثل حالت تک حسابی گزارش شود.
+    """
+    names = list(client_pool.clients)
+    
+    async def verify_target(target):
+        results = await asyncio.gather(*(check_channel_access(client_pool.clients[name], target) for name in names))
+        allowed = [name for name, allowed in zip(names, results) if allowed]
+        if not allowed:
+            logger.error(f"❌ هیچ حسابی در کانال هدف {target} حق ارسال ندارد", extra=log_context(target, stage='pool'))
+        elif len(allowed) < len(names):
+            excluded = ', '.join(name for name in names if name not in allowed)
+            logger.warning(f"🔀 حساب‌های {excluded} برای ارسال به {target} استفاده نمی‌شوند", extra=log_context(target, stage='pool'))
+        client_pool.set_senders(target, allowed)
+    
+    async def verify_source(channel):
+        async def check(name):
+            try:
+                entity = await resolve_entity(client_pool.clients[name], channel)
+                return await is_channel_member(client_pool.clients[name], entity), entity
+            except Exception as e:
+                logger.warning(f"⚠️ بررسی عضویت حساب {name} در {channel} ناموفق بود: {str(e)}", extra=log_context(channel, stage='pool'))
+                return False, None
+        results = await asyncio.gather(*(check(name) for name in names))
+        members = [name for name, (is_member, _) in zip(names, results) if is_member]
+        # handler ها کانال را با get_channel_key پیدا می‌کنند که ممکن است با کلید تنظیمات فرق داشته باشد
+        keys = {channel}
+        keys.update(get_channel_key(entity) for _, entity in results if entity is not None)
+        if not members:
+            logger.error(f"❌ هیچ حسابی عضو کانال منبع {channel} نیست", extra=log_context(channel, stage='pool'))
+        elif len(members) < len(names):
+            excluded = ', '.join(name for name in names if name not in members)
+            logger.warning(f"🔀 حساب‌های {excluded} عضو {channel} نیستند و آن را نمی‌خوانند", extra=log_context(channel, stage='pool'))
+        client_pool.set_members(keys, members)
+    
+    await asyncio.gather(*map(verify_target, targets), *map(verify_source, sources))
+
+class MediaCache:
+    """کش محدود و ماندگار ارجاع رسانه‌ها: شناسه رسانه منبع -> InputPhoto یا InputDocument
+
+    بعد از هر ارسال موفق، رسانه پیام ارسال شده (با file_reference تازه) برای همان حساب ذخیره می‌شود
+    تا ارسال همان رسانه به کانال‌های هدف دیگر یا در تلاش‌های بعدی بدون دانلود و آپلود دوباره انجام شود.
+    access_hash و file_reference به حساب تعلق دارند، بنابراین کلید شامل نام حساب هم هست.
+    """
+
+    def __init__(self, snapshot_path, max_entries, save_interval=0):
+        self.snapshot_path = snapshot_path
+        self.max_entries = max(max_entries, 1)
+        self.save_interval = save_interval
+        self._entries = OrderedDict()  # "حساب|شناسه رسانه" -> [نوع، id، access_hash، file_reference (hex)]
+        self._dirty = False
+        self._saved_at = 0.0
+        self._write_future = None
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        """بارگذاری snapshot کش از فایل"""
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            for key, entry in snapshot.get('entries', []):
+                self._entries[key] = entry
+        except (json.JSONDecodeError, IOError, OSError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ خطا در خواندن فایل {self.snapshot_path}: {e}")
+        self._evict()
+
+    def save(self, force=True):
+        """ذخیره اتمیک snapshot مثل DedupIndex.save (بدون force در snapshot_executor و بدون صبر)"""
+        now = time.time()
+        if self._dirty and (force or (not self._writing() and now - self._saved_at >= self.save_interval)):
+            self._dirty = False
+            self._saved_at = now
+            self._write_future = snapshot_executor.submit(self._write_snapshot, list(self._entries.items()))
+        if force and self._write_future is not None:
+            self._write_future.result()
+
+    def _writing(self):
+        return self._write_future is not None and not self._write_future.done()
+
+    def _write_snapshot(self, items):
+        try:
+            write_json_atomic(self.snapshot_path, {'entries': items})
+        except (IOError, OSError) as e:
+            self._dirty = True
+            logger.warning(f"⚠️ خطا در ذخیره فایل {self.snapshot_path}: {e}")
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, account, media):
+        """ارجاع ذخیره شده برای رسانه یک پیام منبع (None اگر در کش نیست)"""
+        media_key = get_media_key(media)
+        entry = self._entries.get(f'{account}|{media_key}') if media_key else None
+        if entry is None:
+            return None
+        self._entries.move_to_end(f'{account}|{media_key}')
+        kind, media_id, access_hash, file_reference = entry
+        input_type = types.InputPhoto if kind == 'photo' else types.InputDocument
+        return input_type(id=media_id, access_hash=access_hash, file_reference=bytes.fromhex(file_reference))
+
+    def put(self, account, source_media, sent_media):
+        """ذخیره رسانه پیام ارسال شده برای رسانه پیام منبع"""
+        media_key = get_media_key(source_media)
+        if not media_key:
+            return
+        if isinstance(sent_media, MessageMediaPhoto) and isinstance(sent_media.photo, types.Photo):
+            item, kind = sent_media.photo, 'photo'
+        elif isinstance(sent_media, MessageMediaDocument) and isinstance(sent_media.document, types.Document):
+            item, kind = sent_media.document, 'document'
+        else:
+            return
+        key = f'{account}|{media_key}'
+        self._entries[key] = [kind, item.id, item.access_hash, item.file_reference.hex()]
+        self._entries.move_to_end(key)
+        self._dirty = True
+        self._evict()
+        self.save(force=False)
+
+    def invalidate(self, account, media):
+        """حذف ارجاعی که file_reference آن منقضی شده است"""
+        media_key = get_media_key(media)
+        if media_key and self._entries.pop(f'{account}|{media_key}', None) is not None:
+            self._dirty = True
+
+# نمونه سراسری MediaCache (در اولین استفاده ساخته می‌شود)
+media_cache = None
+
+def get_media_cache():
+    """برگرداندن MediaCache سراسری"""
+    global media_cache
+    if media_cache is None:
+        # ذخیره snapshot با همان فاصله snapshot شاخص تکراری‌ها
+        media_cache = MediaCache(MEDIA_CACHE_FILE, MEDIA_CACHE_MAX_ENTRIES, save_interval=DEDUP_SNAPSHOT_INTERVAL)
+    return media_cache
+
+def get_account_name(client):
+    """نام حساب یک client (در حالت تک حسابی نام session اصلی)"""
+    name = client_pool.name_of(client) if client_pool is not None else None
+    return name or SESSION_NAMES[0]
+
+async def refetch_media_messages(client, parts):
+    """دریافت دوباره فقط همین پیام‌ها از کانال منبع برای گرفتن file_reference تازه"""
+    refreshed = await call_with_flood_sleep(client.get_messages, parts[0].peer_id, ids=[part.id for part in parts])
+    if any(message is None or message.media is None for message in refreshed):
+        raise MediaEmptyError(request=None)
+    return refreshed
+
+async def reupload_media(client, target_channel, parts, caption):
+    """دانلود جریانی رسانه‌ها در فایل موقت و آپلود دوباره آن‌ها (وقتی ارجاع رسانه قابل استفاده نیست)
+
+    فایل‌ها به صورت تکه تکه روی دیسک نوشته می‌شوند و ویدیوهای بزرگ کامل در حافظه نگه داشته نمی‌شوند.
+    """
+    download_dir = tempfile.mkdtemp(prefix='forwarder-media-', dir=MEDIA_DOWNLOAD_DIR)
+    try:
+        paths = [await client.download_media(part, file=download_dir + os.sep) for part in parts]
+        kwargs = {}
+        if len(parts) == 1 and isinstance(parts[0].media, MessageMediaDocument):
+            # حفظ مشخصات ویدیو/فایل (مدت، ابعاد، نام فایل) در آپلود دوباره
+            kwargs['attributes'] = parts[0].media.document.attributes
+        return await send_scheduler.send(
+            target_channel,
+            client.send_file,
+            target_channel,
+            paths if isinstance(caption, list) else paths[0],
+            caption=caption,
+            parse_mode='html',
+            **kwargs
+        )
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+async def send_media(client, target_channel, parts, caption):
+    """ارسال رسانه یک پیام (یا همه بخش‌های یک آلبوم اگر caption لیست باشد) با send_file
+
+    ارجاع رسانه‌ها از MediaCache (یا خود پیام) استفاده می‌شود. اگر file_reference منقضی شده باشد
+    فقط همین پیام‌ها دوباره دریافت می‌شوند و اگر رسانه باز هم قابل ارسال نباشد، دانلود و دوباره آپلود می‌شود.
+    """
+    cache = get_media_cache()
+    account = get_account_name(client)
+    is_album = isinstance(caption, list)
+    
+    async def send(files):
+        return await send_scheduler.send(
+            target_channel,
+            client.send_file,
+            target_channel,
+            files if is_album else files[0],
+            caption=caption,
+            parse_mode='html'
+        )
+    
+    cached = [cache.get(account, part.media) for part in parts]
+    media_cache_total.inc(len(parts) - cached.count(None), result='hit')
+    media_cache_total.inc(cached.count(None), result='miss')
+    try:
+        sent = await send([reference or part.media for reference, part in zip(cached, parts)])
+    except (FileReferenceExpiredError, FileReferenceInvalidError):
+        logger.info(f"♻️ file reference رسانه پیام {parts[0].id} منقضی شده است؛ دریافت دوباره پیام...", extra=log_context(stage='send'))
+        for part in parts:
+            cache.invalidate(account, part.media)
+        try:
+            parts = await refetch_media_messages(client, parts)
+            sent = await send([part.media for part in parts])
+            media_cache_total.inc(len(parts), result='refreshed')
+        except (FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError):
+            sent = await reupload_media(client, target_channel, parts, caption)
+            media_cache_total.inc(len(parts), result='reuploaded')
+    except (MediaEmptyError, ChatForwardsRestrictedError):
+        # ارسال مستقیم رسانه از این کانال ممکن نیست
+        sent = await reupload_media(client, target_channel, parts, caption)
+        media_cache_total.inc(len(parts), result='reuploaded')
+    
+    sent_messages = sent if isinstance(sent, list) else [sent]
+    for part, sent_message in zip(parts, sent_messages):
+        if sent_message is not None:
+            cache.put(account, part.media, sent_message.media)
+    return sent
+
+def get_media_type(message):
+    """نوع رسانه پیام برای متریک‌ها: text، photo، document، webpage، album یا other"""
+    if isinstance(message, list):
+        return 'album'
+    media = message.media
+    if media is None:
+        return 'text'
+    if isinstance(media, MessageMediaPhoto):
+        return 'photo'
+    if isinstance(media, MessageMediaDocument):
+        return 'document'
+    if isinstance(media, MessageMediaWebPage):
+        return 'webpage'
+    return 'other'
+
+def prepare_message_text(message, old_username, target_channel):
+    """آماده‌سازی متن پیام برای ارسال: حذف امضای کانال و جایگزینی username طبق قوانین کانال هدف"""
+    # دریافت متن پیام
+    text = message.text or message.raw_text or ''
+    return get_transform_pipeline(old_username, target_channel).apply(text)
+
+def prepare_target_texts(chat_id, messages, source_username, target_channel, footer=True):
+    """متن پیام‌ها برای یک کانال هدف
+
+    حذف امضا برای هر پیام فقط یک بار انجام می‌شود و برای هر کانال هدف فقط
+    جایگزینی username و footer همان کانال روی آن اعمال می‌شود (footer=False: بدون footer).
+    """
+    box = get_outbox()
+    pipeline = get_transform_pipeline(source_username, target_channel)
+    return [pipeline.rewrite(box.get_stripped_text(chat_id, message, source_username), footer) for message in messages]
+
+class PermanentSendError(Exception):
+    """خطای ارسالی که با تلاش دوباره برطرف نمی‌شود (دسترسی نوشتن، مسدودیت، کانال خصوصی یا متن خیلی طولانی)"""
+
+def add_sent_id(sent_ids, message_id, part, sent_message, kind):
+    """افزودن (شناسه پیام منبع، بخش، شناسه پیام هدف، نوع) به sent_ids برای MessageMap"""
+    if sent_ids is not None and sent_message is not None:
+        sent_ids.append((message_id, part, sent_message.id, kind))
+
+async def send_album(client, album, target_channel, old_username, captions=None, sent_ids=None, sent_parts=frozenset()):
+    """ارسال همه بخش‌های یک آلبوم (پیام‌های با grouped_id یکسان) با یک فراخوانی send_file
+
+    بخش‌هایی که در sent_parts هستند (ارسال شده در تلاش قبلی) دوباره ارسال نمی‌شوند.
+    """
+    if captions is None:
+        captions = [prepare_message_text(part, old_username, target_channel) for part in album]
+    captions = list(captions)
+    
+    # متن‌های بیشتر از 1024 کاراکتر مثل forward_message در یک پیام جداگانه ارسال می‌شوند
+    remaining_texts = []
+    for index, caption in enumerate(captions):
+        if caption and len(caption) > 1024:
+            remaining_text = caption[1024:].strip()
+            if remaining_text:
+                remaining_texts.append((album[index], remaining_text))
+            caption = caption[:1024]
+        captions[index] = caption or ''
+    
+    if not all((part.id, 0) in sent_parts for part in album):
+        sent = await send_media(client, target_channel, album, captions)
+        for part, sent_message in zip(album, sent if isinstance(sent, list) else [sent]):
+            add_sent_id(sent_ids, part.id, 0, sent_message, 'media')
+    for part, remaining_text in remaining_texts:
+        if (part.id, 1) in sent_parts:
+            continue
+        sent_message = await send_scheduler.send(
+            target_channel,
+            client.send_message,
+            target_channel,
+            remaining_text,
+            parse_mode='html'
+        )
+        add_sent_id(sent_ids, part.id, 1, sent_message, 'overflow')
+
+async def forward_message(client, message, target_channel, old_username, texts=None, sent_ids=None,
+                          sent_parts=frozenset()):
+    """ارسال پیام به کانال هدف با جایگزینی username
+
+    message می‌تواند یک لیست از پیام‌های یک آلبوم هم باشد که در این صورت یکجا ارسال می‌شوند.
+    اگر texts (متن آماده شده هر پیام به همان ترتیب) داده شود، تبدیل متن دوباره انجام نمی‌شود.
+    اگر sent_ids (لیست) داده شود، شناسه پیام‌های ارسال شده در کانال هدف به آن اضافه می‌شود.
+    بخش‌های موجود در sent_parts (شناسه پیام، بخش) در تلاش قبلی ارسال شده‌اند و دوباره ارسال نمی‌شوند.
+    خطای موقت (مثلاً Flood Wait) False برمی‌گرداند و خطایی که با تلاش دوباره برطرف نمی‌شود
+    PermanentSendError می‌دهد.
+    """
+    album = None
+    media_type = get_media_type(message)
+    if isinstance(message, list):
+        if texts is not None:
+            texts = [text for _, text in sorted(zip(message, texts), key=lambda pair: pair[0].id)]
+        album = sorted(message, key=lambda part: part.id)
+        message = album[0]
+    started = time.perf_counter()
+    context = log_context(old_username, message.id, 'send')
+    
     try:
-        # دریافت متن پیام
-        text = message.text or message.raw_text or ''
-        
-        # حذف متن 'کانال رسمی روزنامه دنیای اقتصاد' با آیکون‌هایش
-        text = remove_channel_signature(text)
-        
-        # جایگزینی username در متن
-        if new_username:
-            # اگر REPLACE_USERNAME مشخص شده باشد، همه آن‌ها را جایگزین می‌کنیم
-            if REPLACE_USERNAME:
-                for old_usr in REPLACE_USERNAME:
-                    text = replace_username_in_text(text, old_usr, new_username)
-            # در غیر این صورت، username کانال منبع را جایگزین می‌کنیم
-            elif old_username:
-                text = replace_username_in_text(text, old_username, new_username)
-            
-            # اضافه کردن username به انتهای متن‌های طولانی
-            text = add_username_to_long_text(text, new_username, min_length=200)
+        if album is not None:
+            await send_album(client, album, target_channel, old_username, texts, sent_ids, sent_parts)
+            send_seconds.observe(time.perf_counter() - started, media_type=media_type)
+            messages_sent_total.inc(media_type=media_type, target=target_channel)
+            logger.info(f"✅ آلبوم با ID {message.id} ({len(album)} فایل) با موفقیت ارسال شد", extra=context)
+            return True
+        
+        text = texts[0] if texts is not None else prepare_message_text(message, old_username, target_channel)
         
         # بررسی اینکه آیا پیام دارای رسانه است
         has_media = message.media is not None
@@ -247,54 +2600,74 @@ async def forward_message(client, message, target_channel, old_username, new_use
             if text and len(text) > 1024:
                 # اگر متن بیشتر از 1024 کاراکتر است، ابتدا 1024 کاراکتر اول را به عنوان caption ارسال می‌کنیم
                 caption = text[:1024]
-                await client.send_file(
-                    target_channel,
-                    message.media,
-                    caption=caption,
-                    parse_mode='html'
-                )
+                if (message.id, 0) not in sent_parts:
+                    sent_message = await send_media(client, target_channel, [message], caption)
+                    add_sent_id(sent_ids, message.id, 0, sent_message, 'media')
                 # سپس باقی متن را به عنوان پیام جداگانه ارسال می‌کنیم
                 remaining_text = text[1024:].strip()
-                if remaining_text:
-                    await client.send_message(
+                if remaining_text and (message.id, 1) not in sent_parts:
+                    sent_message = await send_scheduler.send(
+                        target_channel,
+                        client.send_message,
                         target_channel,
                         remaining_text,
                         parse_mode='html'
                     )
-            else:
+                    add_sent_id(sent_ids, message.id, 1, sent_message, 'overflow')
+            elif (message.id, 0) not in sent_parts:
                 # اگر متن کوتاه است یا خالی است، همانطور که هست ارسال می‌کنیم
                 caption = text if text else None
-                await client.send_file(
-                    target_channel,
-                    message.media,
-                    caption=caption,
-                    parse_mode='html'
-                )
+                sent_message = await send_media(client, target_channel, [message], caption)
+                add_sent_id(sent_ids, message.id, 0, sent_message, 'media')
         else:
             # اگر فقط متن است یا رسانه از نوع WebPage است
-            if text:
-                await client.send_message(
+            if text and (message.id, 0) not in sent_parts:
+                sent_message = await send_scheduler.send(
+                    target_channel,
+                    client.send_message,
                     target_channel,
                     text,
                     parse_mode='html'
                 )
+                add_sent_id(sent_ids, message.id, 0, sent_message, 'text')
         
-        print(f"✅ پیام با ID {message.id} با موفقیت ارسال شد")
+        send_seconds.observe(time.perf_counter() - started, media_type=media_type)
+        messages_sent_total.inc(media_type=media_type, target=target_channel)
+        logger.info(f"✅ پیام با ID {message.id} با موفقیت ارسال شد", extra=context)
         return True
     except ChatWriteForbiddenError:
-        print(f"❌ خطا در ارسال پیام {message.id}: دسترسی نوشتن در کانال هدف وجود ندارد")
-        print(f"   💡 راهنمایی: مطمئن شوید که:")
-        print(f"      - حساب شما به عنوان ادمین در کانال هدف تنظیم شده است")
-        print(f"      - دسترسی 'Post Messages' برای حساب شما فعال است")
+        logger.error(
+            f"❌ خطا در ارسال پیام {message.id}: دسترسی نوشتن در کانال هدف وجود ندارد"
+            "\n   💡 راهنمایی: مطمئن شوید که:"
+            "\n      - حساب شما به عنوان ادمین در کانال هدف تنظیم شده است"
+            "\n      - دسترسی 'Post Messages' برای حساب شما فعال است",
+            extra=context
+        )
+        raise PermanentSendError('دسترسی نوشتن در کانال هدف وجود ندارد')
+    except (FloodWaitError, SlowModeWaitError) as e:
+        logger.warning(f"⚠️ خطا در ارسال پیام {message.id}: محدودیت نرخ ارسال (Flood Wait {e.seconds} ثانیه) بعد از {SEND_MAX_RETRIES} تلاش", extra=context)
         return False
     except UserBannedInChannelError:
-        print(f"❌ خطا در ارسال پیام {message.id}: حساب شما در کانال هدف مسدود شده است")
-        print(f"   💡 راهنمایی: با ادمین کانال تماس بگیرید تا مسدودیت را برطرف کند")
-        return False
+        logger.error(
+            f"❌ خطا در ارسال پیام {message.id}: حساب شما در کانال هدف مسدود شده است"
+            "\n   💡 راهنمایی: با ادمین کانال تماس بگیرید تا مسدودیت را برطرف کند",
+            extra=context
+        )
+        raise PermanentSendError('حساب در کانال هدف مسدود شده است')
     except ChannelPrivateError:
-        print(f"❌ خطا در ارسال پیام {message.id}: کانال هدف خصوصی است و دسترسی ندارید")
-        print(f"   💡 راهنمایی: مطمئن شوید که حساب شما عضو کانال است")
-        return False
+        logger.error(
+            f"❌ خطا در ارسال پیام {message.id}: کانال هدف خصوصی است و دسترسی ندارید"
+            "\n   💡 راهنمایی: مطمئن شوید که حساب شما عضو کانال است",
+            extra=context
+        )
+        raise PermanentSendError('کانال هدف خصوصی است')
+    except MessageTooLongError:
+        logger.error(
+            f"❌ خطا در ارسال پیام {message.id}: پیام خیلی طولانی است"
+            "\n   💡 راهنمایی: طول پیام باید کمتر از محدودیت تلگرام باشد",
+            extra=context
+        )
+        raise PermanentSendError('پیام خیلی طولانی است')
     except Exception as e:
         error_msg = str(e)
         error_lower = error_msg.lower()
@@ -303,163 +2676,1248 @@ async def forward_message(client, message, target_channel, old_username, new_use
             "can't write", "write in this chat", "chat_write_forbidden",
             "you can't write in this chat", "not enough rights"
         ]):
-            print(f"❌ خطا در ارسال پیام {message.id}: دسترسی نوشتن در کانال هدف وجود ندارد")
-            print(f"   💡 راهنمایی: مطمئن شوید که:")
-            print(f"      - حساب شما به عنوان ادمین در کانال هدف تنظیم شده است")
-            print(f"      - اگر کانال عمومی است، حساب شما عضو آن است")
-            print(f"      - دسترسی 'Post Messages' برای حساب شما فعال است")
+            logger.error(
+                f"❌ خطا در ارسال پیام {message.id}: دسترسی نوشتن در کانال هدف وجود ندارد"
+                "\n   💡 راهنمایی: مطمئن شوید که:"
+                "\n      - حساب شما به عنوان ادمین در کانال هدف تنظیم شده است"
+                "\n      - اگر کانال عمومی است، حساب شما عضو آن است"
+                "\n      - دسترسی 'Post Messages' برای حساب شما فعال است",
+                extra=context
+            )
+            raise PermanentSendError('دسترسی نوشتن در کانال هدف وجود ندارد') from e
         elif "flood" in error_lower or "too many requests" in error_lower:
-            print(f"⚠️ خطا در ارسال پیام {message.id}: محدودیت نرخ ارسال (Flood Wait)")
-            print(f"   💡 راهنمایی: کمی صبر کنید و دوباره تلاش کنید")
+            logger.warning(
+                f"⚠️ خطا در ارسال پیام {message.id}: محدودیت نرخ ارسال (Flood Wait)"
+                "\n   💡 راهنمایی: کمی صبر کنید و دوباره تلاش کنید",
+                extra=context
+            )
         elif "message too long" in error_lower or "message is too long" in error_lower:
-            print(f"❌ خطا در ارسال پیام {message.id}: پیام خیلی طولانی است")
-            print(f"   💡 راهنمایی: طول پیام باید کمتر از محدودیت تلگرام باشد")
+            logger.error(
+                f"❌ خطا در ارسال پیام {message.id}: پیام خیلی طولانی است"
+                "\n   💡 راهنمایی: طول پیام باید کمتر از محدودیت تلگرام باشد",
+                extra=context
+            )
+            raise PermanentSendError('پیام خیلی طولانی است') from e
         else:
-            print(f"❌ خطا در ارسال پیام {message.id}: {error_msg}")
+            logger.error(f"❌ خطا در ارسال پیام {message.id}: {error_msg}", extra=context)
+        return False
+
+# worker ارسال outbox برای هر (کانال منبع، کانال هدف): Task و رویداد بیدار کردن آن: Event
+outbox_workers = {}
+# هنگام توقف worker ها بعد از ارسال پیام‌های آماده خارج می‌شوند و worker جدیدی ساخته نمی‌شود
+outbox_stopping = False
+outbox_wakeups = {}
+
+def notify_outbox_worker(client, chat_id, target=None):
+    """بیدار کردن (یا شروع) worker ارسال یک کانال منبع برای یک کانال هدف (یا همه کانال‌های هدف)"""
+    for target_channel in ([target] if target is not None else TARGET_CHANNELS):
+        key = (chat_id, target_channel)
+        wakeup = outbox_wakeups.get(key)
+        if wakeup is None:
+            wakeup = asyncio.Event()
+            outbox_wakeups[key] = wakeup
+        wakeup.set()
+        if outbox_stopping:
+            # پیام در outbox ثبت شده است و در اجرای بعدی ارسال می‌شود
+            continue
+        task = outbox_workers.get(key)
+        if task is None or task.done():
+            outbox_workers[key] = asyncio.create_task(outbox_worker(client, chat_id, target_channel))
+
+async def load_outbox_messages(client, chat_id, rows):
+    """پیام‌های یک batch از حافظه، یا با یک درخواست از تلگرام اگر برنامه دوباره اجرا شده باشد"""
+    box = get_outbox()
+    messages = [box.get_message(chat_id, row[1], client) for row in rows]
+    missing_ids = [row[1] for row, message in zip(rows, messages) if message is None]
+    if missing_ids:
+        entity = get_entity_cache(client).get(chat_id) or await resolve_entity(client, rows[0][3])
+        fetched = await call_with_flood_sleep(client.get_messages, entity, ids=missing_ids)
+        fetched_by_id = {message.id: message for message in fetched if message is not None}
+        messages = [message or fetched_by_id.get(row[1]) for row, message in zip(rows, messages)]
+    return messages
+
+# جداکننده پیام‌ها در پست خلاصه و حداکثر طول پیام متنی تلگرام
+DIGEST_SEPARATOR = '\n\n➖➖➖\n\n'
+DIGEST_MAX_LENGTH = 4096
+# تنظیمات پیش‌فرض بخش digest فایل قوانین تبدیل متن
+DEFAULT_DIGEST_SETTINGS = {'sources': [], 'window_seconds': 300, 'max_messages': 20}
+
+def get_digest_settings():
+    """(کانال‌های منبع نرمال شده، مدت پنجره، حداکثر تعداد پیام) حالت خلاصه؛ '*' یعنی همه کانال‌های منبع"""
+    settings = {**DEFAULT_DIGEST_SETTINGS, **TRANSFORM_RULES.get('digest', {})}
+    sources = {
+        channel if channel == '*' else EntityCache.normalize_key(channel)
+        for channel in settings['sources']
+    }
+    return sources, float(settings['window_seconds']), max(1, int(settings['max_messages']))
+
+def is_digest_candidate(chat_id, message, source_username, target, digest_sources):
+    """آیا یک پیام در پست خلاصه این کانال هدف قرار می‌گیرد
+
+    فقط پیام‌های متنی (با یا بدون پیش‌نمایش لینک) کانال‌های منبع حالت خلاصه یا پیام‌های منطبق با
+    قانون digest؛ پیام منطبق با قانون priority همیشه جداگانه ارسال می‌شود.
+    """
+    if message.grouped_id is not None or get_media_type(message) not in ('text', 'webpage'):
         return False
+    message_filter = get_message_filter()
+    matched = (
+        get_outbox().get_keyword_matches(chat_id, [message], source_username) if message_filter.rules else set()
+    )
+    if matched and message_filter.matched_rules(matched, source_username, target, 'priority'):
+        return False
+    source_key = EntityCache.normalize_key(source_username) if source_username else ''
+    if '*' in digest_sources or source_key in digest_sources:
+        return True
+    return bool(matched) and bool(message_filter.matched_rules(matched, source_username, target, 'digest'))
+
+def collect_digest(chat_id, target, rows, digest_sources, max_messages):
+    """بخش ابتدایی rows که در یک پست خلاصه قرار می‌گیرد و اینکه خلاصه باید همین حالا ارسال شود
+
+    جمع‌آوری در اولین پیامی که در خلاصه قرار نمی‌گیرد (رسانه، آلبوم یا پیام فوری) متوقف می‌شود و
+    خلاصه فوراً ارسال می‌شود تا ترتیب پیام‌ها حفظ شود و پیام فوری منتظر پنجره نماند. پیامی که متن
+    خلاصه را از DIGEST_MAX_LENGTH بیشتر کند در خلاصه بعدی قرار می‌گیرد. پیام‌هایی که در حافظه
+    نیستند (بعد از اجرای دوباره) جداگانه ارسال می‌شوند.
+    """
+    box = get_outbox()
+    collected = []
+    # جای footer پست خلاصه از ابتدا کنار گذاشته می‌شود
+    length = get_transform_pipeline(rows[0][4], target).footer_length if rows else 0
+    for row in rows:
+        message = box.get_message(chat_id, row[1])
+        if message is None or not is_digest_candidate(chat_id, message, row[4], target, digest_sources):
+            return collected, True
+        text = prepare_target_texts(chat_id, [message], row[4], target, footer=False)[0]
+        added = len(text) + (len(DIGEST_SEPARATOR) if collected and text else 0)
+        if length + added > DIGEST_MAX_LENGTH:
+            return collected, True
+        collected.append(row)
+        length += added
+    return collected, len(collected) >= max_messages
+
+def screen_outbox_batch(chat_id, target, rows, messages):
+    """قوانین کلمات کلیدی و تشخیص تکراری برای یک پیام (یا همه بخش‌های یک آلبوم)
+
+    خروجی (متن‌های آماده کانال هدف، اثرانگشت) است؛ اگر پیام فیلتر شود یا تکراری باشد وضعیت آن در
+    outbox ثبت و None برگردانده می‌شود.
+    """
+    box = get_outbox()
+    # قوانین فیلتر و مسیریابی کلمات کلیدی این کانال منبع و هدف
+    if get_message_filter().rules:
+        allowed, matched_rules = get_message_filter().check(
+            box.get_keyword_matches(chat_id, messages, rows[0][4]), rows[0][4], target
+        )
+        for rule_name in matched_rules:
+            filter_rule_matches_total.inc(rule=rule_name, result='sent' if allowed else 'dropped')
+        message_ids = ', '.join(str(row[1]) for row in rows)
+        if not allowed:
+            reason = '، '.join(matched_rules) if matched_rules else 'هیچ قانون require منطبق نشد'
+            box.mark_filtered(chat_id, rows, reason)
+            messages_filtered_total.inc(target=target)
+            logger.info(f"🚫 پیام {message_ids} از {rows[0][3]} به {target} ارسال نشد ({reason})", extra=log_context(rows[0][3], rows[0][1], 'filter'))
+            return None
+        if matched_rules:
+            logger.debug(f"🏷️ پیام {message_ids} از {rows[0][3]} با قوانین {'، '.join(matched_rules)} منطبق شد", extra=log_context(rows[0][3], rows[0][1], 'filter'))
+    
+    # خبری که همین حالا از کانال دیگری ارسال شده است دوباره ارسال نمی‌شود
+    texts = prepare_target_texts(chat_id, messages, rows[0][4], target)
+    fingerprint = message_fingerprint(messages, texts)
+    if fingerprint is not None and not get_dedup_index().claim(fingerprint, chat_id, rows[0][1], target):
+        box.mark_duplicate(chat_id, rows)
+        duplicates_skipped_total.inc(kind='exact')
+        message_ids = ', '.join(str(row[1]) for row in rows)
+        logger.info(f"♻️ پیام {message_ids} از {rows[0][3]} تکراری است و ارسال نشد", extra=log_context(rows[0][3], rows[0][1], 'dedup'))
+        return None
+    # نسخه بازنویسی شده خبری که قبلاً ارسال شده است هم ارسال نمی‌شود
+    signature = text_signature(texts)
+    if signature is not None and not get_near_dup_index().claim(signature, chat_id, rows[0][1], target):
+        if fingerprint is not None:
+            get_dedup_index().release(fingerprint, chat_id, rows[0][1], target)
+        box.mark_duplicate(chat_id, rows)
+        duplicates_skipped_total.inc(kind='near')
+        message_ids = ', '.join(str(row[1]) for row in rows)
+        logger.info(f"♻️ پیام {message_ids} از {rows[0][3]} مشابه خبری است که قبلاً ارسال شده و ارسال نشد", extra=log_context(rows[0][3], rows[0][1], 'dedup'))
+        return None
+    return texts, fingerprint
+
+def release_dedup_claims(chat_id, target, claims):
+    """آزاد کردن ثبت پیام‌هایی که به یک کانال هدف ارسال نشدند در شاخص‌های تکراری: لیست (شناسه پیام، اثرانگشت)"""
+    for message_id, fingerprint in claims:
+        if fingerprint is not None:
+            get_dedup_index().release(fingerprint, chat_id, message_id, target)
+        get_near_dup_index().release(chat_id, message_id, target)
 
-async def check_new_messages(client):
-    """بررسی پیام‌های جدید از کانال‌های منبع"""
-    last_messages = load_last_messages()
-    source_channels = [ch.strip() for ch in SOURCE_CHANNELS if ch.strip()]
+async def send_outbox_batch(client, chat_id, target, rows, digest=False):
+    """ارسال یک پیام (یا همه بخش‌های یک آلبوم) از outbox به یک کانال هدف و ثبت نتیجه
+
+    با digest=True پیام‌های متنی rows (هر کدام جداگانه فیلتر و با شاخص تکراری مقایسه می‌شوند)
+    بدون footer کنار هم و با یک footer برای کل متن در یک پست خلاصه ارسال می‌شوند. پست خلاصه برای
+    هر پیام منبع با نوع 'digest' در MessageMap ثبت می‌شود (handle_edited_message و MessageMap.pop).
+    """
+    box = get_outbox()
+    client = get_sender_client(client, target)
+    attempts = max(row[5] for row in rows)
+    claims = []
+    permanent = False
+    try:
+        messages = await load_outbox_messages(client, chat_id, rows)
+    except Exception as e:
+        success = False
+        error = str(e)
+    else:
+        # پیام‌هایی که در کانال منبع حذف شده‌اند دیگر ارسال نمی‌شوند
+        deleted_rows = [row for row, message in zip(rows, messages) if message is None]
+        if deleted_rows:
+            box.mark_failed(chat_id, deleted_rows, 'پیام در کانال منبع وجود ندارد')
+        rows = [row for row, message in zip(rows, messages) if message is not None]
+        messages = [message for message in messages if message is not None]
+        if not rows:
+            return
+        
+        if digest:
+            # هر خبر خلاصه جداگانه فیلتر و با خبرهای ارسال شده مقایسه می‌شود
+            batch = []
+            for row, message in zip(rows, messages):
+                screened = screen_outbox_batch(chat_id, target, [row], [message])
+                if screened is not None:
+                    batch.append((row, message, screened[0][0]))
+                    claims.append((row[1], screened[1]))
+            if not batch:
+                return
+            rows = [row for row, _, _ in batch]
+            messages = [message for _, message, _ in batch]
+            digest = len(batch) > 1
+            if digest:
+                # footer فقط یک بار به انتهای کل خلاصه اضافه می‌شود
+                items = prepare_target_texts(chat_id, messages, rows[0][4], target, footer=False)
+                texts = [get_transform_pipeline(rows[0][4], target).add_footer(DIGEST_SEPARATOR.join(text for text in items if text))]
+            else:
+                texts = [batch[0][2]]
+        else:
+            screened = screen_outbox_batch(chat_id, target, rows, messages)
+            if screened is None:
+                return
+            texts, fingerprint = screened
+            claims.append((rows[0][1], fingerprint))
+        
+        # بخش‌های آلبوم با یک فراخوانی send_file و پست خلاصه به عنوان یک پیام متنی ارسال می‌شوند؛
+        # بخش‌هایی که در تلاش قبلی ارسال شده‌اند (مثلاً رسانه‌ای که ادامه caption آن ارسال نشد) تکرار نمی‌شوند
+        is_album = rows[0][2] is not None
+        sent_ids = []
+        error = 'ارسال ناموفق'
+        try:
+            success = await forward_message(
+                client,
+                messages if is_album else messages[0],
+                target,
+                rows[0][4],
+                texts,
+                sent_ids,
+                get_message_map().sent_parts(chat_id, [row[1] for row in rows], target)
+            )
+        except PermanentSendError as e:
+            success = False
+            error = str(e)
+            # تلاش دوباره فایده‌ای ندارد و پیام‌های بعدی این کانال نباید منتظر بمانند
+            permanent = True
+        if not success and not digest:
+            get_message_map().record(chat_id, target, get_account_name(client), sent_ids)
+    
+    if success:
+        box.mark_sent(chat_id, rows)
+        if digest:
+            # همه پیام‌های منبع خلاصه به همان پست نگاشت می‌شوند
+            get_message_map().record(chat_id, target, get_account_name(client), [
+                (row[1], part, target_message_id, 'digest')
+                for row in rows for _, part, target_message_id, _ in sent_ids
+            ])
+            digest_messages_total.inc(len(rows), target=target)
+            logger.info(f"📰 خلاصه {len(rows)} پیام از {rows[0][3]} در {target} ارسال شد", extra=log_context(rows[0][3], rows[0][1], 'digest'))
+        else:
+            # برای اعمال ویرایش و حذف پیام منبع روی همین نسخه‌ها
+            get_message_map().record(chat_id, target, get_account_name(client), sent_ids)
+        # زمان از انتشار در کانال منبع تا انتشار در کانال هدف
+        source_date = getattr(messages[0], 'date', None)
+        if source_date is not None:
+            source_to_publish_seconds.observe(max(0.0, time.time() - source_date.timestamp()))
+        return
+    
+    send_failures_total.inc()
     
-    for channel_username in source_channels:
+    message_ids = ', '.join(str(row[1]) for row in rows)
+    if permanent or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+        box.mark_failed(chat_id, rows, error)
+        release_dedup_claims(chat_id, target, claims)
+        logger.error(f"❌ ارسال پیام {message_ids} از {rows[0][3]} بعد از {attempts + 1} تلاش متوقف شد: {error}", extra=log_context(rows[0][3], rows[0][1], 'outbox'))
+    else:
+        # تأخیر نمایی بین تلاش‌ها؛ اگر حساب ارسال کننده محدود شده و حساب دیگری آزاد است، فوراً با آن
+        delay = min(OUTBOX_RETRY_MAX_SECONDS, OUTBOX_RETRY_BASE_SECONDS * (2 ** attempts))
+        if (client_pool is not None and not client_pool.is_available(client_pool.name_of(client))
+                and client_pool.has_alternative(client, target)):
+            delay = 0
+        box.mark_retry(rows, error, delay)
+        logger.info(f"🔁 پیام {message_ids} از {rows[0][3]} {delay:.0f} ثانیه دیگر دوباره ارسال می‌شود (تلاش {attempts + 1}/{OUTBOX_MAX_ATTEMPTS})", extra=log_context(rows[0][3], rows[0][1], 'outbox'))
+
+async def outbox_worker(client, chat_id, target):
+    """ارسال پیام‌های outbox یک کانال منبع به یک کانال هدف به ترتیب ID
+
+    هر (کانال منبع، کانال هدف) worker خودش را دارد، بنابراین ترتیب پیام‌های هر کانال حفظ می‌شود و
+    کانال‌های منبع و هدف مختلف همزمان (در محدوده SendScheduler هر هدف) ارسال می‌شوند.
+    """
+    box = get_outbox()
+    wakeup = outbox_wakeups[(chat_id, target)]
+    while True:
+        wakeup.clear()
+        rows = box.next_batch(chat_id, target)
+        if not rows:
+            if outbox_stopping:
+                return
+            await wakeup.wait()
+            continue
+        
+        head = rows[0]
+        ready_at = head[6]
+        digest = False
+        if head[2] is not None and len(rows) < ALBUM_MAX_SIZE:
+            # بخش‌های آلبوم تا پایان ALBUM_WINDOW_SECONDS جمع‌آوری و سپس یکجا ارسال می‌شوند
+            ready_at = max(ready_at, head[7] + ALBUM_WINDOW_SECONDS)
+        elif head[2] is None:
+            # پیام‌های متنی حالت خلاصه تا پایان پنجره یا پر شدن خلاصه جمع‌آوری می‌شوند
+            digest_sources, window_seconds, max_messages = get_digest_settings()
+            if digest_sources or 'digest' in get_message_filter().actions:
+                digest_rows, digest_ready = collect_digest(
+                    chat_id, target, box.next_rows(chat_id, target, max_messages), digest_sources, max_messages
+                )
+                if digest_rows:
+                    rows = digest_rows
+                    digest = True
+                    # هنگام توقف خلاصه فوراً ارسال می‌شود
+                    if not digest_ready and not outbox_stopping:
+                        ready_at = max(ready_at, head[7] + window_seconds)
+        delay = ready_at - time.time()
+        if delay > 0:
+            if outbox_stopping:
+                # تلاش مجدد و آلبوم ناقص در اجرای بعدی ارسال می‌شوند
+                return
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
         try:
-            # دریافت اطلاعات کانال
-            entity = await client.get_entity(channel_username)
-            
-            # استفاده از تابع مشترک برای ساخت channel_key
-            channel_key = get_channel_key(entity, channel_username)
-            if not channel_key:
-                print(f"⚠️ نتوانست channel_key را برای {channel_username} بسازد")
+            await send_outbox_batch(client, chat_id, target, rows, digest)
+        except Exception as e:
+            logger.error(f"❌ خطا در worker ارسال کانال {chat_id} به {target}: {str(e)}", extra=log_context(chat_id, stage='outbox'))
+            get_outbox().mark_retry(rows, str(e), OUTBOX_RETRY_BASE_SECONDS)
+
+def start_outbox_workers(client):
+    """شروع worker ها برای پیام‌هایی که در اجرای قبلی ارسال نشده‌اند"""
+    box = get_outbox()
+    box.prune(OUTBOX_RETENTION_SECONDS)
+    get_message_map().prune()
+    pending_count = box.pending_count()
+    if pending_count:
+        logger.info(f"📤 {pending_count} پیام ارسال نشده از اجرای قبلی دوباره ارسال می‌شود")
+    for chat_id, target in box.pending_queues():
+        notify_outbox_worker(client, chat_id, target)
+
+async def drain_outbox(timeout):
+    """توقف worker های ارسال بعد از ارسال پیام‌های آماده (حداکثر timeout ثانیه)
+
+    پیامی که در این مدت ارسال نشود در outbox باقی می‌ماند و start_outbox_workers آن را در اجرای
+    بعدی ارسال می‌کند؛ ارسالی که وسط کار لغو شود هم چون هنوز mark_sent نشده دوباره ارسال می‌شود.
+    خروجی تعداد پیام‌های باقی مانده در outbox است.
+    """
+    global outbox_stopping
+    outbox_stopping = True
+    # worker هایی که منتظر پیام جدید یا زمان تلاش مجدد هستند بیدار می‌شوند تا خارج شوند
+    for wakeup in outbox_wakeups.values():
+        wakeup.set()
+    tasks = [task for task in outbox_workers.values() if not task.done()]
+    if tasks:
+        logger.info(f"📤 در حال ارسال پیام‌های در صف ({len(tasks)} worker، حداکثر {timeout:.0f} ثانیه)...")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending, timeout=1.0)
+    outbox_workers.clear()
+    return get_outbox().pending_count()
+
+class PollScheduler:
+    """زمان‌بندی تطبیقی بررسی دوره‌ای هر کانال منبع
+
+    بررسی‌ای که پیام جا افتاده‌ای پیدا نکند یعنی event handler checkpoint را به‌روز نگه داشته است؛
+    در این حالت فاصله بررسی بعدی آن کانال POLL_BACKOFF_FACTOR برابر (تا max_interval) می‌شود.
+    خطا، پیدا شدن پیام جا افتاده یا فاصله در شناسه‌ها فاصله را به min_interval برمی‌گرداند و
+    بعد از اتصال مجدد همه کانال‌ها فوراً بررسی می‌شوند.
+    """
+
+    def __init__(self, channels, min_interval, max_interval, factor):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.factor = factor
+        self._channels = {}  # کلید نرمال شده -> نام کانال در SOURCE_CHANNELS
+        self._intervals = {}
+        self._due = {}
+        self._wakeup = asyncio.Event()
+        now = time.monotonic()
+        for channel in channels:
+            key = EntityCache.normalize_key(channel)
+            self._channels[key] = channel
+            self._intervals[key] = min_interval
+            self._due[key] = now + min_interval
+
+    def set_channels(self, channels):
+        """به‌روزرسانی کانال‌ها: کانال‌های جدید فوراً بررسی می‌شوند و کانال‌های حذف شده دیگر بررسی نمی‌شوند"""
+        channels = {EntityCache.normalize_key(channel): channel for channel in channels}
+        for key in list(self._channels):
+            if key not in channels:
+                del self._channels[key]
+                self._intervals.pop(key, None)
+                self._due.pop(key, None)
+        for key, channel in channels.items():
+            if key not in self._channels:
+                self._schedule(key, self.min_interval, delay=0)
+                self._wakeup.set()
+            self._channels[key] = channel
+
+    def due_channels(self):
+        """کانال‌هایی که زمان بررسی آن‌ها رسیده است"""
+        now = time.monotonic()
+        return [self._channels[key] for key, due in self._due.items() if due <= now]
+
+    def seconds_until_next(self):
+        """زمان باقی‌مانده تا نزدیک‌ترین بررسی"""
+        if not self._due:
+            return self.max_interval
+        return max(0.0, min(self._due.values()) - time.monotonic())
+
+    def interval(self, channel):
+        return self._intervals.get(EntityCache.normalize_key(channel))
+
+    def _schedule(self, key, interval, delay=None):
+        self._intervals[key] = interval
+        self._due[key] = time.monotonic() + (interval if delay is None else delay)
+
+    def record_poll(self, channel, missed, complete=True):
+        """ثبت نتیجه یک بررسی: missed تعداد پیام‌هایی است که event handler دریافت نکرده بود"""
+        key = EntityCache.normalize_key(channel)
+        if key not in self._channels:
+            return
+        if not complete:
+            # هنوز پیام‌های بیشتری باقی مانده است
+            self._schedule(key, self.min_interval, delay=0)
+            self._wakeup.set()
+        elif missed:
+            self._schedule(key, self.min_interval)
+        else:
+            self._schedule(key, min(self.max_interval, self._intervals[key] * self.factor))
+        channel_polls_total.inc(result='missed' if missed else 'current')
+
+    def record_error(self, channel):
+        """بعد از خطا در دریافت کانال، بررسی بعدی با کمترین فاصله"""
+        key = EntityCache.normalize_key(channel)
+        if key in self._channels:
+            self._schedule(key, self.min_interval)
+        channel_polls_total.inc(result='error')
+
+    def shorten(self, *channels):
+        """کوتاه کردن فاصله بررسی (مثلاً بعد از دیدن فاصله در شناسه پیام‌ها در event handler)"""
+        for channel in channels:
+            key = EntityCache.normalize_key(channel)
+            if key in self._channels and self._intervals[key] > self.min_interval:
+                self._schedule(key, self.min_interval)
+
+    def poll_all_now(self):
+        """بررسی فوری همه کانال‌ها (بعد از اتصال مجدد)"""
+        for key in self._channels:
+            self._schedule(key, self.min_interval, delay=0)
+        self._wakeup.set()
+
+    async def wait(self, timeout):
+        """صبر تا زمان بررسی بعدی، حداکثر timeout ثانیه یا تا درخواست بررسی فوری"""
+        delay = min(timeout, self.seconds_until_next())
+        if delay <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+# زمان‌بند بررسی دوره‌ای (در اولین استفاده ساخته می‌شود)
+poll_scheduler = None
+
+def get_source_channels():
+    """کانال‌های منبع فعلی (بدون فاصله و مقدارهای خالی)"""
+    return [ch.strip() for ch in SOURCE_CHANNELS if ch.strip()]
+
+def get_poll_scheduler():
+    """برگرداندن PollScheduler سراسری"""
+    global poll_scheduler
+    if poll_scheduler is None:
+        poll_scheduler = PollScheduler(
+            get_source_channels(),
+            POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_BACKOFF_FACTOR
+        )
+    return poll_scheduler
+
+# Semaphore سراسری برای محدود کردن دریافت همزمان از کانال‌ها (در اولین استفاده ساخته می‌شود)
+fetch_semaphore = None
+
+def get_fetch_semaphore():
+    """برگرداندن Semaphore سراسری دریافت پیام‌ها"""
+    global fetch_semaphore
+    if fetch_semaphore is None:
+        fetch_semaphore = asyncio.Semaphore(max(1, POLL_CONCURRENCY))
+    return fetch_semaphore
+
+async def fetch_with_limit(coro):
+    """اجرای دریافت کامل یک کانال (resolve و همه صفحه‌های catch-up) با محدودیت همزمانی و یک timeout
+
+    POLL_CHANNEL_TIMEOUT برای کل کانال است نه هر درخواست، بنابراین کانال کند حداکثر همین مدت یک
+    جایگاه همزمانی را نگه می‌دارد. coro نباید خودش دوباره fetch_with_limit را صدا بزند.
+    """
+    async with get_fetch_semaphore():
+        return await asyncio.wait_for(coro, timeout=POLL_CHANNEL_TIMEOUT)
+
+async def stream_channel_messages(client, entity, min_id, max_id=0):
+    """دریافت جریانی پیام‌های بعد از min_id (قدیمی‌ترین اول) با صفحه‌بندی min_id
+
+    پیام‌ها به محض رسیدن هر صفحه برگردانده می‌شوند و کل نتیجه در حافظه جمع نمی‌شود.
+    تعداد پیام‌ها در هر دور به CATCHUP_MAX_MESSAGES محدود است؛ باقی در دور بعد دریافت می‌شوند.
+    """
+    async for message in client.iter_messages(
+        entity,
+        limit=CATCHUP_MAX_MESSAGES,
+        min_id=min_id,
+        max_id=max_id,
+        reverse=True,
+        wait_time=0
+    ):
+        yield message
+
+def get_channel_lock(chat_id):
+    """برگرداندن Lock مخصوص یک کانال منبع"""
+    lock = channel_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        channel_locks[chat_id] = lock
+    return lock
+
+def get_catch_up_lock(chat_id):
+    """برگرداندن Lock مخصوص catch-up یک کانال منبع"""
+    lock = catch_up_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        catch_up_locks[chat_id] = lock
+    return lock
+
+async def process_source_message(client, entity, chat_id, channel_key, message):
+    """بررسی تکراری نبودن، به‌روزرسانی checkpoint و ثبت یک پیام کانال منبع در outbox
+
+    checkpoint و outbox در یک تراکنش به‌روز می‌شوند، بنابراین پیامی که دیده شده حتماً در صف
+    ارسال هست. ارسال توسط worker همان کانال و به ترتیب ID انجام می‌شود.
+    خروجی None یعنی پیام قبلاً پردازش شده است و True یعنی پیام در صف ارسال قرار گرفت.
+    """
+    checkpoints = get_checkpoint_store()
+    
+    lock_started = time.perf_counter()
+    async with get_channel_lock(chat_id):
+        lock_wait_seconds.observe(time.perf_counter() - lock_started, lock='channel')
+        # بررسی مجدد برای جلوگیری از پردازش تکراری (در صورت پردازش همزمان توسط مسیر دیگر)
+        with checkpoint_io_seconds.time(operation='read'):
+            last_seen_id = checkpoints.get(chat_id)
+        
+        # اگر پیام قبلاً پردازش شده، از پردازش مجدد جلوگیری می‌کنیم
+        if message.id <= last_seen_id:
+            logger.debug(f"⏭️ پیام {message.id} از {channel_key} قبلاً پردازش شده است (آخرین: {last_seen_id})", extra=log_context(channel_key, message.id, 'ingest'))
+            return None
+        
+        with checkpoint_io_seconds.time(operation='commit'), checkpoints.transaction():
+            checkpoints.advance(chat_id, message.id)
+            get_outbox().enqueue(
+                chat_id, message, channel_key, getattr(entity, 'username', None), TARGET_CHANNELS, reader=client
+            )
+    
+    notify_outbox_worker(client, chat_id)
+    return True
+
+async def catch_up_channel(client, entity, channel_ref, max_id=0):
+    """ارسال همه پیام‌های بعد از checkpoint یک کانال بدون جا انداختن (gap-free)
+
+    اگر max_id داده شود فقط پیام‌های قبل از آن دریافت می‌شوند (برای پر کردن فاصله در event handler).
+    خروجی False یعنی به سقف CATCHUP_MAX_MESSAGES رسیدیم و هنوز پیام‌های بیشتری باقی مانده است.
+    """
+    checkpoints = get_checkpoint_store()
+    
+    # استفاده از تابع مشترک برای ساخت channel_key
+    channel_key = get_channel_key(entity, channel_ref)
+    if not channel_key:
+        logger.warning(f"⚠️ نتوانست channel_key را برای {channel_ref} بسازد", extra=log_context(channel_ref, stage='catch_up'))
+        return True
+    
+    # شناسه canonical کانال که باید با event.chat_id در event handler یکسان باشد
+    chat_id = get_canonical_chat_id(entity)
+    if chat_id is None:
+        logger.error(f"❌ خطا: شناسه کانال برای {channel_ref} موجود نیست", extra=log_context(channel_ref, stage='catch_up'))
+        return True
+    
+    # کلیدهای قدیمی فقط برای مهاجرت از last_messages.json استفاده می‌شوند
+    legacy_keys = get_all_channel_keys(entity, channel_ref, chat_id=chat_id)
+    
+    # در هر لحظه فقط یک catch-up برای هر کانال اجرا می‌شود؛ بقیه بعد از آن فقط باقی‌مانده را دریافت می‌کنند
+    lock_started = time.perf_counter()
+    async with get_catch_up_lock(chat_id):
+        lock_wait_seconds.observe(time.perf_counter() - lock_started, lock='catch_up')
+        min_id = checkpoints.get(chat_id, legacy_keys)
+        
+        # فاصله در این مدت توسط مسیر دیگری پر شده است
+        if max_id and min_id >= max_id - 1:
+            return True
+        
+        if not min_id:
+            # کانال جدید: فقط CATCHUP_INITIAL_WINDOW پیام آخر ارسال می‌شود نه کل تاریخچه
+            latest = await client.get_messages(entity, limit=1)
+            if not latest:
+                return True
+            min_id = max(0, latest[0].id - CATCHUP_INITIAL_WINDOW)
+        
+        # تعداد پیام‌هایی که در صف ارسال قرار گرفتند
+        queued_count = 0
+        max_queued_id = 0
+        fetched_count = 0
+        
+        async for message in stream_channel_messages(client, entity, min_id, max_id):
+            fetched_count += 1
+            # جلوگیری از پردازش پیام‌های خود ربات؛ checkpoint از آن‌ها عبور می‌کند تا صفحه‌ای که فقط پیام
+            # خود حساب دارد در دور بعد دوباره دریافت نشود
+            if message.out:
+                async with get_channel_lock(chat_id):
+                    checkpoints.advance(chat_id, message.id)
                 continue
             
-            # دریافت آخرین پیام‌های کانال
-            messages = await client.get_messages(entity, limit=10)
-            
-            # دریافت همه کلیدهای ممکن برای این کانال
-            all_keys = get_all_channel_keys(entity, channel_username)
-            
-            # بررسی پیام‌های جدید - بررسی با همه کلیدهای ممکن
-            last_seen_id = max([last_messages.get(key, 0) for key in all_keys], default=0)
-            
-            new_messages = [msg for msg in messages if msg.id > last_seen_id and not msg.out]
-            
-            if new_messages:
-                # مرتب‌سازی بر اساس ID (قدیمی‌ترین اول)
-                new_messages.sort(key=lambda x: x.id)
-                
-                # لیست پیام‌هایی که واقعاً ارسال شدند
-                sent_messages = []
-                
-                # ارسال پیام‌های جدید
-                for message in new_messages:
-                    # استخراج username کانال از entity
-                    old_username = getattr(entity, 'username', None)
-                    # استفاده از entity.id برای message_key برای سازگاری بین event handler و periodic check
-                    # entity.id همیشه برای کانال‌ها موجود است و باید با event.chat_id یکسان باشد
-                    if not hasattr(entity, 'id') or entity.id is None:
-                        print(f"❌ خطا: entity.id برای {channel_username} موجود نیست")
-                        continue
-                    chat_id = entity.id
-                    # استفاده از chat_id برای message_key که باید با event.chat_id در event handler یکسان باشد
-                    message_key = f"{chat_id}:{message.id}"
-                    
-                    # استفاده از lock برای جلوگیری از پردازش همزمان - نگه داشتن lock تا پایان ارسال
-                    async with message_processing_lock:
-                        # بررسی مجدد برای جلوگیری از پردازش تکراری (در صورت پردازش همزمان توسط event handler)
-                        current_last_messages = load_last_messages()
-                        # بررسی با همه کلیدهای ممکن برای اطمینان کامل
-                        current_last_seen_id = max([current_last_messages.get(key, 0) for key in all_keys], default=0)
-                        
-                        # اگر پیام قبلاً پردازش شده، از پردازش مجدد جلوگیری می‌کنیم
-                        if message.id <= current_last_seen_id:
-                            print(f"⏭️ پیام {message.id} از {channel_key} قبلاً پردازش شده است (آخرین: {current_last_seen_id})")
-                            continue
-                        
-                        # بررسی اینکه آیا این پیام در حال پردازش است
-                        if message_key in processing_messages:
-                            print(f"⏭️ پیام {message.id} از {channel_key} در حال پردازش است")
-                            continue
-                        
-                        # اضافه کردن به لیست پیام‌های در حال پردازش
-                        processing_messages.add(message_key)
-                        
-                        # به‌روزرسانی فوری قبل از ارسال برای جلوگیری از race condition
-                        # ذخیره با همه کلیدهای ممکن برای اطمینان
-                        for key in all_keys:
-                            current_last_messages[key] = message.id
-                        save_last_messages(current_last_messages)
-                    
-                    # ارسال پیام خارج از lock برای جلوگیری از blocking طولانی
-                    try:
-                        success = await forward_message(
-                            client,
-                            message,
-                            TARGET_CHANNEL,
-                            old_username,
-                            NEW_USERNAME
-                        )
-                        
-                        # اگر پیام با موفقیت ارسال شد، آن را به لیست اضافه می‌کنیم
-                        if success:
-                            sent_messages.append(message)
-                    finally:
-                        # حذف از لیست پیام‌های در حال پردازش
-                        async with message_processing_lock:
-                            processing_messages.discard(message_key)
-                    
-                    await asyncio.sleep(2)  # تاخیر بین ارسال پیام‌ها
-                
-                # لاگ آخرین پیام‌های ارسال شده
-                if sent_messages:
-                    max_sent_id = max(msg.id for msg in sent_messages)
-                    print(f"📝 {len(sent_messages)} پیام جدید از {channel_key} ارسال شد. آخرین ID: {max_sent_id}")
-            
+            if await process_source_message(client, entity, chat_id, channel_key, message):
+                queued_count += 1
+                max_queued_id = message.id
+    
+    # لاگ آخرین پیام‌های پذیرفته شده
+    if queued_count:
+        logger.info(f"📝 {queued_count} پیام جدید از {channel_key} در صف ارسال قرار گرفت. آخرین ID: {max_queued_id}", extra=log_context(channel_key, max_queued_id, 'catch_up'))
+    complete = fetched_count < CATCHUP_MAX_MESSAGES
+    if not max_id:
+        # بررسی دوره‌ای: هر پیامی که اینجا در صف قرار گرفته توسط event handler دریافت نشده بود
+        get_poll_scheduler().record_poll(channel_ref, queued_count, complete)
+    return complete
+
+async def check_channel_messages(client, channel_username):
+    """بررسی و ارسال پیام‌های جدید یک کانال منبع"""
+    # در حالت چند حسابی هر کانال توسط حساب خواننده خودش دریافت می‌شود
+    client = get_reader_client(client, channel_username)
+    
+    async def fetch_channel():
+        # دریافت اطلاعات کانال (از کش در صورت وجود)
+        entity = await resolve_entity(client, channel_username)
+        await catch_up_channel(client, entity, channel_username)
+    
+    try:
+        await fetch_with_limit(fetch_channel())
+    except FloodWaitError as e:
+        # در حالت چند حسابی دور بعد این کانال توسط حساب دیگری دریافت می‌شود
+        if client_pool is not None:
+            client_pool.pause(client, e.seconds)
+        get_poll_scheduler().record_error(channel_username)
+        logger.warning(f"⏳ محدودیت نرخ در دریافت کانال {channel_username}: {e.seconds} ثانیه", extra=log_context(channel_username, stage='poll'))
+    except (ChannelInvalidError, ChannelPrivateError, UsernameNotOccupiedError) as e:
+        # کانال تغییر کرده یا دسترسی از دست رفته است؛ در دور بعد دوباره resolve می‌شود
+        get_entity_cache(client).invalidate(channel_username)
+        get_poll_scheduler().record_error(channel_username)
+        logger.error(f"❌ خطا در بررسی کانال {channel_username}: {str(e)}", extra=log_context(channel_username, stage='poll'))
+    except asyncio.TimeoutError:
+        get_poll_scheduler().record_error(channel_username)
+        logger.info(f"⏱️ دریافت پیام‌های کانال {channel_username} بیش از {POLL_CHANNEL_TIMEOUT} ثانیه طول کشید و رد شد", extra=log_context(channel_username, stage='poll'))
+    except Exception as e:
+        get_poll_scheduler().record_error(channel_username)
+        logger.error(f"❌ خطا در بررسی کانال {channel_username}: {str(e)}", extra=log_context(channel_username, stage='poll'))
+
+async def check_new_messages(client, source_channels=None):
+    """بررسی همزمان پیام‌های جدید از کانال‌های منبع (پیش‌فرض: همه کانال‌ها)"""
+    if source_channels is None:
+        source_channels = get_source_channels()
+    
+    # هر کانال مستقل بررسی می‌شود؛ خطا یا کندی یک کانال روی بقیه اثر نمی‌گذارد
+    with poll_seconds.time():
+        await asyncio.gather(*(
+            check_channel_messages(client, channel_username)
+            for channel_username in source_channels
+        ))
+
+async def handle_new_message(client, event):
+    """پردازش پیام جدید دریافت شده از event handler"""
+    message = event.message
+    
+    # جلوگیری از پردازش پیام‌های خود ربات
+    if message.out:
+        return
+    
+    # استخراج username کانال (از کش در صورت وجود)
+    entity = await get_event_entity(event)
+    # استفاده از تابع مشترک برای ساخت channel_key
+    channel_key = get_channel_key(entity, event.chat_id)
+    if not channel_key:
+        logger.warning(f"⚠️ نتوانست channel_key را برای chat_id {event.chat_id} بسازد", extra=log_context(event.chat_id, message.id, 'handler'))
+        return
+    
+    # در حالت چند حسابی فقط حساب خواننده این کانال event را پردازش می‌کند
+    if client_pool is not None and client_pool.reader_for(channel_key) is not client:
+        return
+    
+    # event.chat_id همان شناسه canonical است که periodic check استفاده می‌کند
+    chat_id = event.chat_id
+    # کلیدهای قدیمی فقط برای مهاجرت از last_messages.json استفاده می‌شوند
+    legacy_keys = get_all_channel_keys(entity, chat_id=chat_id)
+    last_seen_id = get_checkpoint_store().get(chat_id, legacy_keys)
+    
+    # اگر بین checkpoint و این پیام فاصله وجود دارد (مثلاً بعد از قطع اتصال)،
+    # ابتدا پیام‌های جا افتاده به ترتیب ارسال می‌شوند
+    if 0 < last_seen_id < message.id - 1:
+        # ممکن است پیام‌های دیگری هم از stream جا افتاده باشند؛ بررسی دوره‌ای این کانال زودتر انجام می‌شود
+        get_poll_scheduler().shorten(channel_key, chat_id)
+        now = time.monotonic()
+        if now - gap_catch_up_times.get(chat_id, float('-inf')) < GAP_CATCHUP_MIN_INTERVAL:
+            # این پیام هم ارسال نمی‌شود تا فاصله باقی نماند؛ بررسی دوره‌ای همه را یک‌جا به ترتیب ارسال می‌کند
+            logger.info(f"⏳ فاصله بین پیام {last_seen_id} و {message.id} در {channel_key}؛ دریافت پیام‌های جا افتاده کمتر از {GAP_CATCHUP_MIN_INTERVAL:g} ثانیه پیش انجام شده - به بررسی دوره‌ای سپرده شد", extra=log_context(channel_key, message.id, 'handler'))
+            return
+        gap_catch_up_times[chat_id] = now
+        logger.info(f"🧩 فاصله بین پیام {last_seen_id} و {message.id} در {channel_key}؛ در حال دریافت پیام‌های جا افتاده...", extra=log_context(channel_key, message.id, 'handler'))
+        try:
+            # تا زمانی که کل فاصله پر نشده (سقف هر دور CATCHUP_MAX_MESSAGES است) ادامه می‌دهیم
+            while not await fetch_with_limit(catch_up_channel(client, entity, channel_key, max_id=message.id)):
+                caught_up_id = get_checkpoint_store().get(chat_id)
+                if caught_up_id <= last_seen_id:
+                    raise RuntimeError(f'دریافت پیام‌های جا افتاده بعد از پیام {last_seen_id} پیش نرفت')
+                last_seen_id = caught_up_id
+        except Exception as e:
+            # این پیام هم ارسال نمی‌شود تا فاصله باقی نماند؛ بررسی دوره‌ای همه را به ترتیب ارسال می‌کند
+            logger.error(f"❌ خطا در دریافت پیام‌های جا افتاده {channel_key}: {str(e)} - به بررسی دوره‌ای سپرده شد", extra=log_context(channel_key, message.id, 'handler'))
+            return
+    
+    logger.info(f"📨 پیام جدید دریافت شد از {event.chat_id}", extra=log_context(channel_key, message.id, 'handler'))
+    await process_source_message(client, entity, chat_id, channel_key, message)
+
+def get_account_client(client, account):
+    """client حسابی که یک پیام کانال هدف را ارسال کرده است (اگر هنوز در مجموعه حساب‌ها باشد)"""
+    if client_pool is not None and account in client_pool.clients:
+        return client_pool.clients[account]
+    return client
+
+async def handle_edited_message(client, event):
+    """اعمال ویرایش پیام کانال منبع روی نسخه‌های ارسال شده آن در کانال‌های هدف"""
+    message = event.message
+    if message.out:
+        return
+    entity = await get_event_entity(event)
+    channel_key = get_channel_key(entity, event.chat_id)
+    if not channel_key:
+        return
+    if client_pool is not None and client_pool.reader_for(channel_key) is not client:
+        return
+    chat_id = event.chat_id
+    context = log_context(channel_key, message.id, 'edit')
+    
+    # پیامی که هنوز ارسال نشده با همین نسخه ویرایش شده ارسال می‌شود
+    get_outbox().replace_message(chat_id, message)
+    
+    # پست خلاصه شامل پیام‌های دیگر هم هست و با ویرایش یک پیام منبع بازنویسی نمی‌شود
+    copies = [copy for copy in get_message_map().lookup(chat_id, message.id) if copy[3] != 'digest']
+    if not copies:
+        return
+    source_username = getattr(entity, 'username', None)
+    by_target = {}
+    for target, part, target_message_id, kind, account in copies:
+        by_target.setdefault(target, {})[part] = (target_message_id, kind, account)
+    
+    for target, parts in by_target.items():
+        text = prepare_message_text(message, source_username, target)
+        target_message_id, kind, account = parts[0]
+        sender = get_account_client(client, account)
+        if kind == 'text':
+            edits = [(0, text)]
+        else:
+            # caption حداکثر 1024 کاراکتر است و باقی متن در پیام ادامه (part 1) قرار دارد
+            edits = [(0, text[:1024]), (1, text[1024:].strip())]
+        try:
+            for part, part_text in edits:
+                if part in parts:
+                    part_message_id = parts[part][0]
+                    if part_text or part == 0:
+                        try:
+                            await send_scheduler.send(
+                                target, sender.edit_message, target, part_message_id, part_text, parse_mode='html'
+                            )
+                        except MessageNotModifiedError:
+                            pass
+                    else:
+                        # متن کوتاه‌تر شده و دیگر به پیام ادامه نیازی نیست
+                        await send_scheduler.send(target, sender.delete_messages, target, [part_message_id])
+                        get_message_map().remove(chat_id, message.id, target, part)
+                elif part_text:
+                    sent_message = await send_scheduler.send(
+                        target, sender.send_message, target, part_text, parse_mode='html'
+                    )
+                    if sent_message is not None:
+                        get_message_map().add(chat_id, message.id, target, part, sent_message.id, 'overflow', account)
+            logger.info(f"✏️ ویرایش پیام {message.id} در {target} اعمال شد", extra=context)
+        except MessageIdInvalidError:
+            # همین بخش در همین کانال هدف دستی حذف شده است؛ نسخه‌های کانال‌های هدف دیگر دست نمی‌خورند
+            get_message_map().remove(chat_id, message.id, target, part)
+            logger.warning(f"⚠️ بخش {part} پیام {message.id} در {target} وجود ندارد و نگاشت آن حذف شد", extra=context)
+        except Exception as e:
+            logger.error(f"❌ خطا در اعمال ویرایش پیام {message.id} در {target}: {str(e)}", extra=context)
+
+async def handle_deleted_messages(client, event):
+    """حذف نسخه‌های کانال هدف پیام‌هایی که در کانال منبع حذف شده‌اند"""
+    # Telegram فقط برای کانال‌ها شناسه کانال را همراه حذف ارسال می‌کند
+    chat_id = event.chat_id
+    if chat_id is None:
+        return
+    message_ids = list(event.deleted_ids)
+    
+    # پیام‌هایی که هنوز ارسال نشده‌اند دیگر ارسال نمی‌شوند
+    cancelled = get_outbox().cancel(chat_id, message_ids)
+    if cancelled:
+        logger.info(f"🗑️ ارسال {cancelled} پیام حذف شده از کانال {chat_id} لغو شد", extra=log_context(chat_id, stage='delete'))
+    
+    # نگاشت قبل از اولین await حذف می‌شود تا حساب‌های دیگر همان حذف را تکرار نکنند
+    by_sender = {}
+    for target, target_message_id, account in get_message_map().pop(chat_id, message_ids):
+        by_sender.setdefault((target, account), []).append(target_message_id)
+    for (target, account), target_message_ids in by_sender.items():
+        sender = get_account_client(client, account)
+        try:
+            await send_scheduler.send(target, sender.delete_messages, target, target_message_ids)
+            logger.info(f"🗑️ {len(target_message_ids)} پیام حذف شده از کانال {chat_id} در {target} هم حذف شد", extra=log_context(chat_id, stage='delete'))
+        except Exception as e:
+            logger.error(f"❌ خطا در حذف پیام‌های {target_message_ids} از {target}: {str(e)}", extra=log_context(chat_id, stage='delete'))
+
+def make_message_handler(client, handle=handle_new_message):
+    """handler یک رویداد (پیش‌فرض NewMessage) برای یک حساب"""
+    async def handler(event):
+        with handler_seconds.time():
+            await handle(client, event)
+    return handler
+
+# handler های ثبت شده (client، callback) تا با تغییر کانال‌های منبع دوباره ثبت شوند
+event_handlers = []
+
+def remove_event_handlers():
+    """حذف همه handler ها تا هنگام توقف پیام جدیدی دریافت نشود"""
+    for listening_client, callback in event_handlers:
+        listening_client.remove_event_handler(callback)
+    event_handlers.clear()
+
+def register_event_handlers(clients):
+    """ثبت handler ها روی همه حساب‌ها؛ هر event فقط توسط حساب خواننده کانالش پردازش می‌شود
+
+    handler های قبلی (اگر وجود داشته باشند) حذف می‌شوند تا فیلتر کانال‌ها با SOURCE_CHANNELS فعلی
+    ساخته شود؛ اتصال حساب‌ها قطع نمی‌شود.
+    """
+    remove_event_handlers()
+    source_channels = get_source_channels()
+    for listening_client in clients:
+        for handle, event_type in (
+            (handle_new_message, events.NewMessage),
+            # اعمال ویرایش و حذف پیام‌های منبع روی نسخه‌های کانال هدف
+            (handle_edited_message, events.MessageEdited),
+            (handle_deleted_messages, events.MessageDeleted),
+        ):
+            callback = make_message_handler(listening_client, handle)
+            listening_client.add_event_handler(callback, event_type(chats=source_channels))
+            event_handlers.append((listening_client, callback))
+
+async def reload_config(client, clients):
+    """بارگذاری دوباره تنظیمات کانال‌ها و قوانین تبدیل متن بدون قطع اتصال
+
+    کانال‌های منبع جدید قبل از اضافه شدن resolve می‌شوند تا یک username اشتباه فیلتر event ها را خراب نکند.
+    """
+    global SOURCE_CHANNELS, TARGET_CHANNEL, TARGET_CHANNELS, REPLACE_USERNAME, NEW_USERNAME, TRANSFORM_RULES, message_filter
+    context = log_context(stage='config')
+    # مقدار فایل بر متغیر محیطی مقدم است؛ کلیدی که از فایل حذف شده به مقدار محیط process برمی‌گردد
+    # (os.environ تغییر نمی‌کند، بنابراین مقدار قدیمی فایل باقی نمی‌ماند)
+    settings = dict(PROCESS_ENVIRONMENT)
+    if os.path.exists(CONFIG_FILE):
+        settings.update((key, value) for key, value in dotenv_values(CONFIG_FILE).items() if value is not None)
+    source_channels, target_channel, target_channels, replace_username, new_username = read_channel_settings(settings)
+    
+    old_sources = {EntityCache.normalize_key(channel) for channel in get_source_channels()}
+    accepted_sources = []
+    for channel in (ch.strip() for ch in source_channels if ch.strip()):
+        if EntityCache.normalize_key(channel) not in old_sources:
+            try:
+                await resolve_entity(get_reader_client(client, channel), channel)
+            except Exception as e:
+                logger.error(f"❌ کانال منبع جدید {channel} اضافه نشد: {str(e)}", extra=context)
+                continue
+        accepted_sources.append(channel)
+    new_sources = {EntityCache.normalize_key(channel) for channel in accepted_sources}
+    
+    # قوانین تبدیل متن و زنجیره‌های compile شده
+    previous_filters = TRANSFORM_RULES.get('filters', [])
+    TRANSFORM_RULES = load_transform_rules(TRANSFORM_RULES_FILE)
+    REPLACE_USERNAME, NEW_USERNAME = replace_username, new_username
+    transform_pipelines.clear()
+    # automaton کلمات کلیدی فقط با تغییر قوانین دوباره ساخته می‌شود
+    if TRANSFORM_RULES.get('filters', []) != previous_filters:
+        message_filter = None
+    get_outbox().clear_text_cache()
+    
+    # کانال‌های هدف: پیام‌های جدید به فهرست جدید ارسال می‌شوند و صف کانال‌های حذف شده لغو می‌شود
+    removed_targets = [target for target in TARGET_CHANNELS if target not in target_channels]
+    added_targets = [target for target in target_channels if target not in TARGET_CHANNELS]
+    TARGET_CHANNEL, TARGET_CHANNELS = target_channel, target_channels
+    for target in removed_targets:
+        cancelled = get_outbox().cancel_target(target)
+        logger.info(f"🗑️ کانال هدف {target} حذف شد ({cancelled} ارسال در انتظار لغو شد)", extra=context)
+    if client_pool is not None:
+        added_sources = [channel for channel in accepted_sources if EntityCache.normalize_key(channel) not in old_sources]
+        await verify_pool_access(added_targets, added_sources)
+    else:
+        for target in added_targets:
+            await check_channel_access(client, target)
+    
+    # کانال‌های منبع: فیلتر handler ها و مجموعه کانال‌های بررسی دوره‌ای
+    if new_sources != old_sources:
+        SOURCE_CHANNELS = accepted_sources
+        register_event_handlers(clients)
+        get_poll_scheduler().set_channels(accepted_sources)
+    
+    logger.info(
+        f"🔁 تنظیمات دوباره بارگذاری شد: {len(new_sources - old_sources)} کانال منبع اضافه و "
+        f"{len(old_sources - new_sources)} کانال حذف شد، {len(added_targets)} کانال هدف اضافه و "
+        f"{len(removed_targets)} کانال حذف شد",
+        extra=context
+    )
+
+def get_config_mtimes():
+    """زمان آخرین تغییر فایل تنظیمات و فایل قوانین تبدیل متن"""
+    return tuple(
+        os.path.getmtime(path) if os.path.exists(path) else None
+        for path in (CONFIG_FILE, TRANSFORM_RULES_FILE)
+    )
+
+async def watch_config(client, clients, reload_requested):
+    """بارگذاری دوباره تنظیمات با تغییر فایل‌ها (هر CONFIG_WATCH_INTERVAL ثانیه) یا با SIGHUP"""
+    mtimes = get_config_mtimes()
+    while True:
+        try:
+            if CONFIG_WATCH_INTERVAL > 0:
+                await asyncio.wait_for(reload_requested.wait(), timeout=CONFIG_WATCH_INTERVAL)
+            else:
+                await reload_requested.wait()
+        except asyncio.TimeoutError:
+            pass
+        current_mtimes = get_config_mtimes()
+        if not reload_requested.is_set() and current_mtimes == mtimes:
+            continue
+        reload_requested.clear()
+        mtimes = current_mtimes
+        try:
+            await reload_config(client, clients)
         except Exception as e:
-            print(f"❌ خطا در بررسی کانال {channel_username}: {str(e)}")
+            logger.exception(f"❌ خطا در بارگذاری دوباره تنظیمات: {str(e)}", extra=log_context(stage='config'))
+
+def get_connection_states(client):
+    """وضعیت اتصال همه حساب‌ها (نام -> متصل بودن)"""
+    clients = client_pool.clients if client_pool is not None else {SESSION_NAMES[0]: client}
+    states = {}
+    for name, account in clients.items():
+        is_connected = getattr(account, 'is_connected', None)
+        states[name] = is_connected() if is_connected is not None else True
+    return states
 
-async def periodic_check(client, interval_seconds=30):
-    """بررسی دوره‌ای پیام‌های جدید هر X ثانیه"""
-    print(f"⏰ بررسی دوره‌ای هر {interval_seconds} ثانیه شروع شد. اولین بررسی بعد از {interval_seconds} ثانیه...")
-    print(f"📅 زمان فعلی: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+async def periodic_check(client, tick_seconds=5):
+    """بررسی دوره‌ای تطبیقی پیام‌های جدید
+
+    هر کانال با فاصله مخصوص خودش (بین POLL_MIN_INTERVAL و POLL_MAX_INTERVAL) بررسی می‌شود.
+    وضعیت اتصال هر tick_seconds بررسی می‌شود و بعد از اتصال مجدد همه کانال‌ها فوراً دریافت می‌شوند.
+    """
+    scheduler = get_poll_scheduler()
+    logger.info(f"⏰ بررسی دوره‌ای تطبیقی شروع شد (فاصله هر کانال بین {POLL_MIN_INTERVAL:.0f} و {POLL_MAX_INTERVAL:.0f} ثانیه)")
+    logger.info(f"📅 زمان فعلی: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     iteration = 0
+    connection_states = get_connection_states(client)
     while True:
         try:
+            await scheduler.wait(tick_seconds)
+            
+            # تشخیص قطع و اتصال مجدد
+            previous_states, connection_states = connection_states, get_connection_states(client)
+            for name, connected in connection_states.items():
+                if connected and not previous_states.get(name, True):
+                    logger.info(f"🔌 اتصال حساب {name} برقرار شد؛ بررسی فوری همه کانال‌ها...", extra=log_context(stage='poll'))
+                    scheduler.poll_all_now()
+                elif not connected and previous_states.get(name, True):
+                    logger.warning(f"🔌 اتصال حساب {name} قطع شد", extra=log_context(stage='poll'))
+            
+            due_channels = scheduler.due_channels()
+            if not due_channels or not any(connection_states.values()):
+                continue
             iteration += 1
-            await asyncio.sleep(interval_seconds)
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            print(f"🔄 بررسی دوره‌ای #{iteration} - پیام‌های جدید ({current_time})...")
-            await check_new_messages(client)
-            print(f"✅ بررسی دوره‌ای #{iteration} انجام شد. بررسی بعدی در {interval_seconds} ثانیه...")
+            logger.info(f"🔄 بررسی دوره‌ای #{iteration} - {len(due_channels)} کانال ({current_time})...")
+            await check_new_messages(client, due_channels)
+            logger.info(f"✅ بررسی دوره‌ای #{iteration} انجام شد. بررسی بعدی در {scheduler.seconds_until_next():.0f} ثانیه...")
         except asyncio.CancelledError:
-            print("⏹️ بررسی دوره‌ای متوقف شد")
+            logger.info("⏹️ بررسی دوره‌ای متوقف شد")
             break
         except KeyboardInterrupt:
             # اگر KeyboardInterrupt در task رخ دهد، آن را دوباره raise می‌کنیم
-            print("⏹️ بررسی دوره‌ای به دلیل توقف برنامه متوقف شد")
+            logger.info("⏹️ بررسی دوره‌ای به دلیل توقف برنامه متوقف شد")
             raise
         except Exception as e:
-            print(f"❌ خطا در بررسی دوره‌ای: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"❌ خطا در بررسی دوره‌ای: {str(e)}", extra=log_context(stage='poll'))
             try:
                 await asyncio.sleep(60)  # در صورت خطا، یک دقیقه صبر می‌کند
             except (asyncio.CancelledError, KeyboardInterrupt):
                 raise
 
+# فاصله (ثانیه) بین گزارش‌های پیشرفت replay
+REPLAY_REPORT_INTERVAL = 10
+
+def parse_replay_date(value):
+    """تاریخ ورودی replay (YYYY-MM-DD یا ISO 8601؛ بدون منطقه زمانی UTC در نظر گرفته می‌شود)"""
+    date = datetime.fromisoformat(value)
+    return date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)
+
+def format_duration(seconds):
+    """نمایش مدت به صورت ساعت:دقیقه:ثانیه"""
+    seconds = int(max(0, seconds))
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+async def replay_channel(client, source, target, progress_file, min_id=0, max_id=0, since=None, until=None):
+    """ارسال دوباره تاریخچه یک کانال منبع (بازه id یا تاریخ) در یک کانال هدف
+
+    پیام‌ها به صورت جریانی با iter_messages (قدیمی‌ترین اول) دریافت و با همان مسیر forward_message
+    (تبدیل متن کانال هدف، آلبوم‌ها، ادامه caption و محدودیت نرخ SendScheduler) ارسال می‌شوند.
+    دریافت صفحه بعد همزمان با ارسال پیام‌های قبلی انجام می‌شود. پیشرفت بعد از هر ارسال در
+    progress_file ذخیره می‌شود و اجرای دوباره همان دستور از آخرین پیام ارسال شده ادامه می‌دهد.
+    بعد از FloodWait دریافت تاریخچه، صبر و از همان پیام ادامه داده می‌شود؛ خطاهای دیگر دریافت
+    (بعد از ذخیره پیشرفت) دوباره raise می‌شوند.
+    """
+    entity = await resolve_entity(client, source)
+    chat_id = get_canonical_chat_id(entity)
+    source_username = getattr(entity, 'username', None)
+    context = log_context(source, stage='replay')
+    
+    progress = {'source': source, 'target': target, 'last_id': 0, 'sent': 0, 'filtered': 0, 'failed': []}
+    if os.path.exists(progress_file):
+        with open(progress_file, 'r', encoding='utf-8') as f:
+            progress.update(json.load(f))
+        logger.info(f"📼 ادامه replay از پیام {progress['last_id']} ({progress['sent']} پیام قبلاً ارسال شده)", extra=context)
+    start_after = max(min_id, progress['last_id'])
+    
+    # تخمین تعداد پیام‌های باقی‌مانده از فاصله شناسه‌ها (برای ETA)
+    end_id = max_id
+    if not end_id:
+        latest = await call_with_flood_sleep(client.get_messages, entity, limit=1)
+        end_id = latest[0].id + 1 if latest else start_after + 1
+    
+    # پیام‌ها در صف محدود قرار می‌گیرند تا دریافت و ارسال همزمان پیش بروند
+    pending = asyncio.Queue(maxsize=CATCHUP_MAX_MESSAGES)
+    
+    async def produce():
+        resume_after = start_after
+        try:
+            while True:
+                try:
+                    async for message in client.iter_messages(
+                        entity, min_id=resume_after, max_id=max_id,
+                        offset_date=since if resume_after == min_id else None, reverse=True, wait_time=0
+                    ):
+                        if until is not None and message.date > until:
+                            return
+                        resume_after = message.id
+                        if isinstance(message, types.MessageService) or (since is not None and message.date < since):
+                            continue
+                        await pending.put(message)
+                    return
+                except (FloodWaitError, SlowModeWaitError) as e:
+                    logger.warning(f"⏳ محدودیت نرخ دریافت تاریخچه؛ {e.seconds} ثانیه صبر و ادامه از پیام {resume_after}", extra=context)
+                    await asyncio.sleep(e.seconds)
+        finally:
+            # پایان صف؛ خطای دریافت بعد از پایان حلقه از producer خوانده می‌شود
+            await pending.put(None)
+    
+    def save_progress():
+        write_json_atomic(progress_file, progress)
+    
+    async def send(messages):
+        # همان قوانین فیلتر کلمات کلیدی ارسال عادی
+        keyword_filter = get_message_filter()
+        if keyword_filter.rules:
+            pipeline = get_transform_pipeline(source_username)
+            matched = set()
+            for message in messages:
+                matched |= keyword_filter.match(pipeline.strip_signatures(message.text or message.raw_text or ''))
+            if not keyword_filter.check(matched, source_username, target)[0]:
+                progress['filtered'] += len(messages)
+                progress['last_id'] = max(message.id for message in messages)
+                save_progress()
+                return
+        sent_ids = []
+        is_album = messages[0].grouped_id is not None
+        try:
+            success = await forward_message(
+                client, messages if is_album else messages[0], target, source_username, sent_ids=sent_ids
+            )
+        except PermanentSendError:
+            success = False
+        if success:
+            get_message_map().record(chat_id, target, get_account_name(client), sent_ids)
+            progress['sent'] += len(messages)
+        else:
+            progress['failed'].extend(message.id for message in messages)
+        progress['last_id'] = max(message.id for message in messages)
+        save_progress()
+    
+    producer = asyncio.ensure_future(produce())
+    started = time.monotonic()
+    first_id = None
+    processed = 0
+    reported_at = started
+    album = []
+    try:
+        while True:
+            message = await pending.get()
+            # بخش‌های یک آلبوم پشت سر هم هستند و با هم ارسال می‌شوند
+            if album and (message is None or message.grouped_id != album[0].grouped_id):
+                await send(album)
+                processed += len(album)
+                album = []
+            if message is None:
+                break
+            if first_id is None:
+                first_id = message.id
+            if message.grouped_id is not None:
+                album.append(message)
+                continue
+            await send([message])
+            processed += 1
+            
+            now = time.monotonic()
+            if now - reported_at >= REPLAY_REPORT_INTERVAL:
+                reported_at = now
+                rate = processed / (now - started)
+                done_fraction = (message.id - first_id + 1) / max(1, end_id - first_id)
+                eta = (now - started) * (1 - done_fraction) / done_fraction if done_fraction > 0 else 0
+                logger.info(
+                    f"📼 {processed} پیام ({done_fraction:.1%})، {rate:.1f} پیام در ثانیه، زمان باقی‌مانده: {format_duration(eta)}",
+                    extra=log_context(source, message.id, 'replay')
+                )
+        # خطای دریافت تاریخچه (بعد از ارسال پیام‌های دریافت شده) به عنوان پایان عادی گزارش نمی‌شود
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+        save_progress()
+    
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"✅ replay {source} به {target} تمام شد: {processed} پیام در {format_duration(elapsed)} "
+        f"({processed / elapsed if elapsed else 0:.1f} پیام در ثانیه)، {progress['filtered']} فیلتر شده، {len(progress['failed'])} ناموفق",
+        extra=context
+    )
+    return progress
+
+async def replay_main(args):
+    """اجرای حالت replay از خط فرمان (خروجی exit code: 0 موفق و 1 اگر replay ناتمام ماند)"""
+    client = TelegramClient(SESSION_NAMES[0], API_ID, API_HASH, flood_sleep_threshold=0)
+    progress_file = args.progress_file or 'replay_{}_{}.json'.format(
+        EntityCache.normalize_key(args.source), EntityCache.normalize_key(args.target)
+    )
+    try:
+        await client.start()
+        await replay_channel(
+            client, args.source, args.target, progress_file,
+            min_id=args.min_id, max_id=args.max_id,
+            since=parse_replay_date(args.since) if args.since else None,
+            until=parse_replay_date(args.until) if args.until else None
+        )
+        return 0
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info(f"⏹️ replay متوقف شد؛ اجرای دوباره همین دستور از {progress_file} ادامه می‌دهد")
+        return 1
+    except Exception as e:
+        logger.error(f"❌ replay ناتمام ماند: {str(e)} - اجرای دوباره همین دستور از {progress_file} ادامه می‌دهد")
+        return 1
+    finally:
+        await client.disconnect()
+        if entity_cache is not None:
+            entity_cache.save()
+        if media_cache is not None:
+            media_cache.save()
+        if checkpoint_store is not None:
+            checkpoint_store.close()
+
+def parse_replay_args(argv):
+    parser = argparse.ArgumentParser(prog='app.py replay', description='ارسال دوباره تاریخچه یک کانال منبع در یک کانال هدف')
+    parser.add_argument('--source', required=True, help='کانال منبع (@username یا id)')
+    parser.add_argument('--target', required=True, help='کانال هدف')
+    parser.add_argument('--min-id', type=int, default=0, help='فقط پیام‌های بعد از این شناسه')
+    parser.add_argument('--max-id', type=int, default=0, help='فقط پیام‌های قبل از این شناسه')
+    parser.add_argument('--since', help='فقط پیام‌های بعد از این تاریخ (YYYY-MM-DD)')
+    parser.add_argument('--until', help='فقط پیام‌های قبل از این تاریخ (YYYY-MM-DD)')
+    parser.add_argument('--progress-file', help='فایل پیشرفت (پیش‌فرض: replay_<source>_<target>.json)')
+    return parser.parse_args(argv)
+
+def report_startup_phase(name, started):
+    """گزارش زمان یک مرحله راه‌اندازی که از started (time.perf_counter) شروع شده است"""
+    elapsed = time.perf_counter() - started
+    startup_phase_seconds.set(elapsed, phase=name)
+    logger.info(f"⏱️ مرحله راه‌اندازی {name}: {elapsed:.2f} ثانیه", extra=log_context(stage='startup'))
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """اندازه‌گیری و گزارش زمان یک مرحله راه‌اندازی"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        report_startup_phase(name, started)
+
+async def run_startup_catch_up(client):
+    """دریافت پیام‌های منتشر شده در زمان خاموش بودن ربات (در background، بعد از ثبت handler ها)"""
+    try:
+        with startup_phase('catch_up'):
+            await check_new_messages(client)
+    except Exception as e:
+        logger.exception(f"❌ خطا در بررسی اولیه پیام‌ها: {str(e)} - به بررسی دوره‌ای سپرده شد", extra=log_context(stage='startup'))
+
 async def main():
     """تابع اصلی"""
-    print("🚀 در حال راه‌اندازی ربات...")
+    logger.info("🚀 در حال راه‌اندازی ربات...")
     
     # ایجاد کلاینت تلگرام
-    client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+    client = TelegramClient(SESSION_NAMES[0], API_ID, API_HASH, flood_sleep_threshold=0)
+    extra_clients = []
+    metrics_server = None
+    startup_started = time.perf_counter()
+    # SIGTERM (مثلاً هنگام راه‌اندازی مجدد روزانه dyno) و Ctrl+C توقف منظم را شروع می‌کنند
+    shutdown_requested = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signal_name in ('SIGTERM', 'SIGINT'):
+        if hasattr(signal, signal_name):
+            try:
+                loop.add_signal_handler(getattr(signal, signal_name), shutdown_requested.set)
+            except (NotImplementedError, RuntimeError):
+                pass
     
     try:
         # تلاش برای اتصال با مدیریت خطا
         try:
             await client.start()
-            print("✅ اتصال به تلگرام برقرار شد")
+            logger.info("✅ اتصال به تلگرام برقرار شد")
         except (ValueError, ConnectionError, OSError) as e:
             error_msg = str(e).lower()
             # بررسی خطاهای مربوط به احراز هویت
@@ -467,8 +3925,8 @@ async def main():
                 "phone_code_hash", "server closed", "invalid code",
                 "connection", "0 bytes read"
             ]):
-                print("⚠️ خطا در احراز هویت: session نامعتبر یا کد تأیید نامعتبر است")
-                print("💡 در حال پاک کردن session و شروع مجدد احراز هویت...")
+                logger.warning("⚠️ خطا در احراز هویت: session نامعتبر یا کد تأیید نامعتبر است")
+                logger.info("💡 در حال پاک کردن session و شروع مجدد احراز هویت...")
                 
                 # قطع اتصال اگر متصل است
                 try:
@@ -477,15 +3935,15 @@ async def main():
                     pass
                 
                 # پاک کردن session فایل‌ها
-                if clear_session_files(SESSION_NAME):
-                    print("✅ فایل‌های session پاک شدند")
+                if clear_session_files(SESSION_NAMES[0]):
+                    logger.info("✅ فایل‌های session پاک شدند")
                 
                 # ایجاد کلاینت جدید و تلاش مجدد
-                client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
-                print("🔄 در حال تلاش مجدد برای احراز هویت...")
-                print("📱 لطفاً شماره تلفن و کد تأیید جدید را وارد کنید")
+                client = TelegramClient(SESSION_NAMES[0], API_ID, API_HASH, flood_sleep_threshold=0)
+                logger.info("🔄 در حال تلاش مجدد برای احراز هویت...")
+                logger.info("📱 لطفاً شماره تلفن و کد تأیید جدید را وارد کنید")
                 await client.start()
-                print("✅ اتصال به تلگرام برقرار شد")
+                logger.info("✅ اتصال به تلگرام برقرار شد")
             else:
                 raise
         except Exception as auth_error:
@@ -495,8 +3953,8 @@ async def main():
                 "phone_code_hash", "server closed", "invalid code",
                 "connection", "0 bytes read"
             ]):
-                print("⚠️ خطا در احراز هویت: session نامعتبر یا کد تأیید نامعتبر است")
-                print("💡 در حال پاک کردن session و شروع مجدد احراز هویت...")
+                logger.warning("⚠️ خطا در احراز هویت: session نامعتبر یا کد تأیید نامعتبر است")
+                logger.info("💡 در حال پاک کردن session و شروع مجدد احراز هویت...")
                 
                 # قطع اتصال اگر متصل است
                 try:
@@ -505,159 +3963,179 @@ async def main():
                     pass
                 
                 # پاک کردن session فایل‌ها
-                if clear_session_files(SESSION_NAME):
-                    print("✅ فایل‌های session پاک شدند")
+                if clear_session_files(SESSION_NAMES[0]):
+                    logger.info("✅ فایل‌های session پاک شدند")
                 
                 # ایجاد کلاینت جدید و تلاش مجدد
-                client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
-                print("🔄 در حال تلاش مجدد برای احراز هویت...")
-                print("📱 لطفاً شماره تلفن و کد تأیید جدید را وارد کنید")
+                client = TelegramClient(SESSION_NAMES[0], API_ID, API_HASH, flood_sleep_threshold=0)
+                logger.info("🔄 در حال تلاش مجدد برای احراز هویت...")
+                logger.info("📱 لطفاً شماره تلفن و کد تأیید جدید را وارد کنید")
                 await client.start()
-                print("✅ اتصال به تلگرام برقرار شد")
+                logger.info("✅ اتصال به تلگرام برقرار شد")
             else:
-                print(f"❌ خطا در احراز هویت: {str(auth_error)}")
-                print("💡 راهنمایی:")
-                print("   - مطمئن شوید که API_ID و API_HASH صحیح هستند")
-                print("   - اگر کد تأیید نامعتبر بود، دوباره تلاش کنید")
-                print("   - در صورت نیاز، فایل session را پاک کنید و دوباره احراز هویت کنید")
+                logger.error(f"❌ خطا در احراز هویت: {str(auth_error)}")
+                logger.info(
+                    "💡 راهنمایی:"
+                    "\n   - مطمئن شوید که API_ID و API_HASH صحیح هستند"
+                    "\n   - اگر کد تأیید نامعتبر بود، دوباره تلاش کنید"
+                    "\n   - در صورت نیاز، فایل session را پاک کنید و دوباره احراز هویت کنید"
+                )
                 raise
         
-        # بررسی دسترسی به کانال هدف
-        print("🔐 در حال بررسی دسترسی به کانال هدف...")
-        await check_channel_access(client, TARGET_CHANNEL)
+        # حساب‌های دیگر در حالت چند حسابی
+        for session_name in SESSION_NAMES[1:]:
+            extra_client = TelegramClient(session_name, API_ID, API_HASH, flood_sleep_threshold=0)
+            logger.info(f"🔑 در حال اتصال حساب {session_name}...")
+            await extra_client.start()
+            extra_clients.append(extra_client)
+        if extra_clients:
+            global client_pool
+            client_pool = ClientPool(zip(SESSION_NAMES, [client] + extra_clients))
+            logger.info(f"👥 حالت چند حسابی با {len(client_pool.clients)} حساب فعال شد")
+        report_startup_phase('connect', startup_started)
         
-        # بررسی اولیه پیام‌های جدید
-        print("🔍 در حال بررسی پیام‌های جدید...")
-        await check_new_messages(client)
+        # ثبت handler ها قبل از هر کار دیگری تا پیام‌های منتشر شده در حین راه‌اندازی از دست نروند
+        # (اگر بین checkpoint و پیام جدید فاصله باشد، handler خودش پیام‌های قبلی را دریافت می‌کند)
+        with startup_phase('handlers'):
+            register_event_handlers([client] + extra_clients)
         
-        # ثبت handler برای پیام‌های جدید
-        @client.on(events.NewMessage(chats=SOURCE_CHANNELS))
-        async def handler(event):
-            message = event.message
-            
-            # جلوگیری از پردازش پیام‌های خود ربات
-            if message.out:
-                return
-            
-            # استخراج username کانال
-            entity = await event.get_chat()
-            # استفاده از تابع مشترک برای ساخت channel_key
-            channel_key = get_channel_key(entity, event.chat_id)
-            if not channel_key:
-                print(f"⚠️ نتوانست channel_key را برای chat_id {event.chat_id} بسازد")
-                return
-            
-            # دریافت همه کلیدهای ممکن برای این کانال
-            all_keys = get_all_channel_keys(entity, chat_id=event.chat_id)
-            
-            old_username = getattr(entity, 'username', None)
-            # استفاده از event.chat_id برای message_key برای سازگاری بین event handler و periodic check
-            # بررسی اینکه entity.id و event.chat_id یکسان هستند
-            if hasattr(entity, 'id') and entity.id != event.chat_id:
-                print(f"⚠️ هشدار: entity.id ({entity.id}) و event.chat_id ({event.chat_id}) متفاوت هستند!")
-            # استفاده از event.chat_id برای سازگاری کامل
-            message_key = f"{event.chat_id}:{message.id}"
-            
-            # استفاده از lock برای جلوگیری از پردازش همزمان
-            async with message_processing_lock:
-                # بررسی اینکه آیا این پیام قبلاً پردازش شده است
-                # بررسی با همه کلیدهای ممکن برای اطمینان کامل
-                last_messages = load_last_messages()
-                last_seen_id = max([last_messages.get(key, 0) for key in all_keys], default=0)
-                
-                # بررسی اینکه آیا این پیام در حال پردازش است
-                if message_key in processing_messages:
-                    print(f"⏭️ پیام {message.id} از {channel_key} در حال پردازش است")
-                    return
-                
-                # اگر پیام قبلاً پردازش شده، از پردازش مجدد جلوگیری می‌کنیم
-                if message.id <= last_seen_id:
-                    print(f"⏭️ پیام {message.id} از {channel_key} قبلاً پردازش شده است (آخرین: {last_seen_id})")
-                    return
-                
-                # اضافه کردن به لیست پیام‌های در حال پردازش
-                processing_messages.add(message_key)
-                
-                # به‌روزرسانی فوری قبل از ارسال برای جلوگیری از race condition
-                # ذخیره با همه کلیدهای ممکن برای اطمینان
-                for key in all_keys:
-                    last_messages[key] = message.id
-                save_last_messages(last_messages)
-            
-            print(f"📨 پیام جدید دریافت شد از {event.chat_id}")
-            
+        # endpoint متریک‌ها و ارسال پیام‌هایی که در اجرای قبلی ارسال نشده‌اند
+        with startup_phase('outbox'):
+            metrics_server = await start_metrics_server()
+            start_outbox_workers(client)
+        
+        # بررسی همزمان دسترسی به کانال‌های هدف
+        with startup_phase('access_check'):
+            logger.info("🔐 در حال بررسی دسترسی به کانال هدف...")
+            if client_pool is not None:
+                # دسترسی همه حساب‌ها به هر کانال هدف و عضویت آن‌ها در کانال‌های منبع
+                await verify_pool_access(TARGET_CHANNELS, get_source_channels())
+            else:
+                await asyncio.gather(*(
+                    check_channel_access(client, target_channel)
+                    for target_channel in TARGET_CHANNELS
+                ))
+        
+        # بررسی اولیه پیام‌های جدید در background
+        logger.info("🔍 در حال بررسی پیام‌های جدید...")
+        catch_up_task = asyncio.ensure_future(run_startup_catch_up(client))
+        
+        # بارگذاری دوباره تنظیمات با تغییر فایل یا سیگنال SIGHUP
+        reload_requested = asyncio.Event()
+        if hasattr(signal, 'SIGHUP'):
             try:
-                # ارسال پیام (حتی اگر old_username None باشد، forward_message آن را مدیریت می‌کند)
-                await forward_message(
-                    client,
-                    message,
-                    TARGET_CHANNEL,
-                    old_username,
-                    NEW_USERNAME
-                )
-            finally:
-                # حذف از لیست پیام‌های در حال پردازش
-                async with message_processing_lock:
-                    processing_messages.discard(message_key)
+                asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, reload_requested.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        config_task = asyncio.ensure_future(watch_config(client, [client] + extra_clients, reload_requested))
         
-        print("✅ ربات آماده است و در حال گوش دادن به پیام‌های جدید...")
-        print("📌 کانال‌های منبع:", ', '.join(SOURCE_CHANNELS))
-        print("📌 کانال هدف:", TARGET_CHANNEL)
+        logger.info("✅ ربات آماده است و در حال گوش دادن به پیام‌های جدید...")
+        logger.info(f"📌 کانال‌های منبع: {', '.join(SOURCE_CHANNELS)}")
+        logger.info(f"📌 کانال‌های هدف: {', '.join(TARGET_CHANNELS)}")
+        logger.info(f"⏱️ ربات {time.perf_counter() - startup_started:.2f} ثانیه بعد از شروع آماده شد", extra=log_context(stage='startup'))
         
-        # شروع بررسی دوره‌ای (هر 30 ثانیه) - task در background اجرا می‌شود
+        # شروع بررسی دوره‌ای تطبیقی - task در background اجرا می‌شود
         # استفاده از ensure_future برای اطمینان از اجرای task در event loop
-        loop = asyncio.get_event_loop()
-        periodic_task = loop.create_task(periodic_check(client, interval_seconds=30))
+        periodic_task = loop.create_task(periodic_check(client))
         
         # اطمینان از اینکه task شروع شده است
         await asyncio.sleep(0.5)
         if periodic_task.done():
-            print("⚠️ هشدار: task بررسی دوره‌ای فوراً تمام شد!")
+            logger.warning("⚠️ هشدار: task بررسی دوره‌ای فوراً تمام شد!")
             try:
                 await periodic_task
             except Exception as e:
-                print(f"❌ خطا در task: {e}")
+                logger.error(f"❌ خطا در task: {e}")
         else:
-            print("✅ Task بررسی دوره‌ای با موفقیت شروع شد و در حال اجرا است")
+            logger.info("✅ Task بررسی دوره‌ای با موفقیت شروع شد و در حال اجرا است")
         
         try:
-            # اجرای مداوم - periodic_task در background اجرا می‌شود
-            await client.run_until_disconnected()
+            # اجرای مداوم تا قطع اتصال یا دریافت SIGTERM - periodic_task در background اجرا می‌شود
+            disconnected_task = asyncio.ensure_future(client.run_until_disconnected())
+            shutdown_task = asyncio.ensure_future(shutdown_requested.wait())
+            try:
+                await asyncio.wait((disconnected_task, shutdown_task), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                shutdown_task.cancel()
+            if disconnected_task.done():
+                # خطای دریافت update ها مثل قبل در except بیرونی گزارش می‌شود
+                disconnected_task.result()
+            else:
+                # run_until_disconnected تا قطع اتصال در finally بیرونی ادامه می‌یابد تا ارسال‌ها انجام شوند
+                logger.info("⏹️ دریافت سیگنال توقف؛ در حال توقف منظم...")
         except (KeyboardInterrupt, asyncio.CancelledError):
-            print("\n⏹️ دریافت سیگنال توقف (Ctrl+C)...")
+            logger.info("⏹️ دریافت سیگنال توقف (Ctrl+C)...")
         finally:
-            # لغو task بررسی دوره‌ای
-            print("🔄 در حال توقف task بررسی دوره‌ای...")
-            if not periodic_task.done():
-                periodic_task.cancel()
-                try:
-                    await asyncio.wait_for(periodic_task, timeout=2.0)
-                except (asyncio.CancelledError, asyncio.TimeoutError):
-                    pass
-            print("✅ Task بررسی دوره‌ای متوقف شد")
+            shutdown_started = time.monotonic()
+            # ۱. توقف دریافت پیام: حذف handler ها و لغو بررسی دوره‌ای، بررسی اولیه و بررسی تنظیمات
+            # (checkpoint و outbox در یک تراکنش به‌روز می‌شوند، پس لغو آن‌ها پیامی را از دست نمی‌دهد)
+            remove_event_handlers()
+            logger.info("🔄 در حال توقف task بررسی دوره‌ای...")
+            for task in (catch_up_task, config_task, periodic_task):
+                if not task.done():
+                    task.cancel()
+                    try:
+                        await asyncio.wait_for(task, timeout=2.0)
+                    except (asyncio.CancelledError, asyncio.TimeoutError):
+                        pass
+            logger.info("✅ Task بررسی دوره‌ای متوقف شد")
+            
+            # ۲. ارسال پیام‌های در حال ارسال و صف شده تا پایان مهلت توقف
+            if client.is_connected():
+                remaining = await drain_outbox(max(0.0, SHUTDOWN_TIMEOUT - (time.monotonic() - shutdown_started)))
+                if remaining:
+                    logger.info(f"📥 {remaining} پیام ارسال نشده در outbox ماند و در اجرای بعدی ارسال می‌شود")
+                else:
+                    logger.info("✅ همه پیام‌های صف ارسال شدند")
         
     except (KeyboardInterrupt, asyncio.CancelledError):
-        print("\n⏹️ ربات متوقف شد")
+        logger.info("⏹️ ربات متوقف شد")
     except Exception as e:
-        print(f"❌ خطای غیرمنتظره: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ خطای غیرمنتظره: {str(e)}")
     finally:
         # قطع اتصال با مدیریت خطا
-        print("🔄 در حال قطع اتصال...")
+        logger.info("🔄 در حال قطع اتصال...")
         try:
             # استفاده از wait_for برای جلوگیری از گیر کردن در disconnect
             await asyncio.wait_for(client.disconnect(), timeout=5.0)
-            print("✅ اتصال با موفقیت قطع شد")
+            logger.info("✅ اتصال با موفقیت قطع شد")
         except asyncio.TimeoutError:
-            print("⚠️ قطع اتصال با تاخیر انجام شد (timeout)")
+            logger.warning("⚠️ قطع اتصال با تاخیر انجام شد (timeout)")
         except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
             # اگر KeyboardInterrupt، SystemExit یا CancelledError در حین disconnect رخ دهد، 
             # آن را نادیده می‌گیریم چون در حال خاموش شدن هستیم
-            print("⚠️ قطع اتصال در حین توقف برنامه انجام شد")
+            logger.warning("⚠️ قطع اتصال در حین توقف برنامه انجام شد")
         except Exception as e:
             # سایر خطاها را گزارش می‌کنیم اما برنامه را متوقف نمی‌کنیم
-            print(f"⚠️ خطا در قطع اتصال (غیر بحرانی): {str(e)}")
+            logger.warning(f"⚠️ خطا در قطع اتصال (غیر بحرانی): {str(e)}")
+        for extra_client in extra_clients:
+            try:
+                await asyncio.wait_for(extra_client.disconnect(), timeout=5.0)
+            except Exception:
+                pass
+        
+        if metrics_server is not None:
+            metrics_server.close()
+        
+        # ۳. ذخیره شاخص پیام‌های تکراری، کش‌ها و بستن پایگاه داده وضعیت
+        for cache in [entity_cache, *entity_caches.values()]:
+            if cache is not None:
+                cache.save()
+        if dedup_index is not None:
+            dedup_index.save()
+        if media_cache is not None:
+            media_cache.save()
+        if checkpoint_store is not None:
+            checkpoint_store.close()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    log_listener = setup_logging()
+    exit_code = 0
+    try:
+        if sys.argv[1:2] == ['replay']:
+            exit_code = asyncio.run(replay_main(parse_replay_args(sys.argv[2:])))
+        else:
+            asyncio.run(main())
+    finally:
+        log_listener.stop()
+    sys.exit(exit_code)
\ No newline at end of file
@@ -0,0 +1,703 @@
+"""اسکریپت‌های benchmark ربات (بدون نیاز به حساب تلگرام)
+
+نمونه اجرا:
+    python benchmark.py transform --iterations 2000 --extra-rules 50
+    python benchmark.py stress --channels 5 --messages 200
+    python benchmark.py neardup --entries 100000
+    python benchmark.py keywords --patterns 2000
+    python benchmark.py pipeline --channels 5 --rate 2 --duration 20 --flood-rate 0.01
+"""
+import io
+import os
+import re
+import time
+import random
+import asyncio
+import argparse
+import shutil
+import atexit
+import tempfile
+import contextlib
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+from array import array
+from datetime import datetime, timezone
+
+# app.py در زمان import متغیرهای محیطی را می‌خواند؛ وضعیت ربات در یک پوشه موقت نگه داشته می‌شود
+BENCHMARK_DIR = tempfile.mkdtemp(prefix='ajanews-benchmark-')
+# پایگاه‌داده‌ها و snapshotهای ساخته‌شده در این پوشه (از جمله پوشه‌های reset_bot_state) پس از اجرا پاک می‌شوند
+atexit.register(shutil.rmtree, BENCHMARK_DIR, ignore_errors=True)
+os.environ.setdefault('API_ID', '0')
+os.environ.setdefault('API_HASH', 'benchmark')
+os.environ.setdefault('TARGET_CHANNEL', '@benchmark_target')
+os.environ.setdefault('STATE_DB_FILE', os.path.join(BENCHMARK_DIR, 'bot_state.db'))
+os.environ.setdefault('ENTITY_CACHE_FILE', os.path.join(BENCHMARK_DIR, 'entity_cache.json'))
+os.environ.setdefault('DEDUP_SNAPSHOT_FILE', os.path.join(BENCHMARK_DIR, 'dedup_index.json'))
+os.environ.setdefault('MEDIA_CACHE_FILE', os.path.join(BENCHMARK_DIR, 'media_cache.json'))
+# محدودیت‌های نرخ تلگرام در محیط جعلی معنا ندارند
+os.environ.setdefault('SEND_RATE_PER_CHAT', '1000000')
+os.environ.setdefault('SEND_BURST_PER_CHAT', '1000000')
+os.environ.setdefault('SEND_RATE_GLOBAL', '1000000')
+os.environ.setdefault('SEND_BURST_GLOBAL', '1000000')
+
+from telethon import utils
+from telethon.errors import FloodWaitError
+from telethon.tl import types
+
+import app
+
+# نمونه پست‌های واقعی خبری فارسی (با امضای کانال، username و لینک)
+PERSIAN_NEWS_CORPUS = [
+    "🔴 فوری | نرخ دلار در بازار آزاد تهران امروز به ۵۸ هزار و ۳۰۰ تومان رسید\n\n"
+    "به گزارش خبرنگار اقتصادی، قیمت دلار در معاملات امروز با افزایش ۴۰۰ تومانی همراه بود.\n\n"
+    "🆔 @donyaye_eqtesad\n📌 کانال رسمی روزنامه دنیای اقتصاد 📌",
+
+    "📊 شاخص کل بورس تهران با رشد ۱۲ هزار واحدی به ۲ میلیون و ۱۵۰ هزار واحد رسید.\n"
+    "ارزش معاملات خرد امروز به ۸ هزار میلیارد تومان رسید که نسبت به روز گذشته ۱۵ درصد افزایش داشت.\n"
+    "نمادهای پالایشی و فلزی بیشترین تأثیر مثبت را بر شاخص داشتند.\n\n"
+    "کانال  رسمی   روزنامه دنیای اقتصاد\n@donyaye_eqtesad",
+
+    "✅ رئیس کل بانک مرکزی: نرخ تورم نقطه به نقطه در ماه گذشته کاهش یافت\n"
+    "وی افزود سیاست‌های انقباضی پولی تا پایان سال ادامه خواهد داشت.\n"
+    "🔗 ادامه خبر: https://www.donya-e-eqtesad.com/news/123456\n\n@tasnimnews | @isna_news",
+
+    "⚡️ قیمت طلا و سکه امروز\n\n"
+    "🔸 سکه امامی: ۴۲ میلیون تومان\n🔸 نیم سکه: ۲۳ میلیون تومان\n🔸 ربع سکه: ۱۳ میلیون تومان\n"
+    "🔸 طلای ۱۸ عیار: ۳ میلیون و ۱۰۰ هزار تومان\n\n"
+    "💠 کانال رسمی روزنامه دنیای اقتصاد 💠\n🆔 @donyaye_eqtesad",
+
+    "وزیر نفت از افزایش ظرفیت تولید گاز در پارس جنوبی خبر داد؛ "
+    "به گفته وی با بهره‌برداری از فاز جدید، روزانه ۲۸ میلیون مترمکعب به تولید کشور افزوده می‌شود "
+    "و بخشی از کسری گاز زمستان جبران خواهد شد. این طرح با سرمایه‌گذاری ۳ میلیارد دلاری اجرا شده است.\n"
+    "@irna_1313",
+
+    "🎥 ویدیو | لحظه برخورد دو قطار باری در ایستگاه مرکزی\n\n@akhbarefori",
+]
+
+# شروع‌های متداول امضای کانال‌ها برای ساخت قوانین مصنوعی
+SIGNATURE_PREFIXES = [
+    'کانال رسمی', 'عضویت در کانال', 'ما را دنبال کنید', 'منبع خبر', 'اخبار فوری',
+    'پیوستن به', 'کانال تلگرام', 'صفحه رسمی',
+]
+
+def legacy_remove_channel_signature(text):
+    """پیاده‌سازی قبلی حذف امضا (چهار regex جداگانه و یک regex خطوط خالی) - مبنای مقایسه"""
+    if not text:
+        return text
+    patterns = [
+        r'[^\w\s]*\s*کانال\s+رسمی\s+روزنامه\s+دنیای\s+اقتصاد\s*[^\w\s]*',
+        r'[^\w\s]*\s*کانال\s*رسمی\s*روزنامه\s*دنیای\s*اقتصاد\s*[^\w\s]*',
+        r'^[^\w\s]*\s*کانال\s+رسمی\s+روزنامه\s+دنیای\s+اقتصاد\s*[^\w\s]*\s*',
+        r'\s*[^\w\s]*\s*کانال\s+رسمی\s+روزنامه\s+دنیای\s+اقتصاد\s*[^\w\s]*$',
+    ]
+    for pattern in patterns:
+        text = re.sub(pattern, '', text, flags=re.IGNORECASE | re.MULTILINE)
+    text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
+    return text.strip()
+
+def legacy_transform(text, signature_patterns, replace_usernames, new_username):
+    """پیاده‌سازی قبلی زنجیره تبدیل: یک re.sub برای هر قانون - مبنای مقایسه"""
+    text = legacy_remove_channel_signature(text)
+    for pattern in signature_patterns:
+        text = re.sub(pattern, '', text, flags=re.IGNORECASE | re.MULTILINE)
+    for old_username in replace_usernames:
+        text = app.replace_username_in_text(text, old_username, new_username)
+    return app.add_username_to_long_text(text, new_username, min_length=200)
+
+def time_per_message(func, corpus, iterations):
+    """میانگین زمان پردازش هر پیام به میکروثانیه"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for text in corpus:
+            func(text)
+    return (time.perf_counter() - started) / (iterations * len(corpus)) * 1e6
+
+def run_transform_benchmark(iterations, extra_rules):
+    """مقایسه زنجیره compile شده با پیاده‌سازی قبلی برای تعداد مختلف قوانین"""
+    new_username = '@my_news_channel'
+    print(f"📚 {len(PERSIAN_NEWS_CORPUS)} پست نمونه × {iterations} تکرار")
+    print(f"{'قوانین':>8} | {'قبلی (µs/پیام)':>16} | {'compile شده (µs/پیام)':>22} | {'نسبت':>6}")
+
+    rule_counts = sorted({0, extra_rules // 4, extra_rules // 2, extra_rules})
+    for rule_count in rule_counts:
+        signatures = [
+            f'{SIGNATURE_PREFIXES[i % len(SIGNATURE_PREFIXES)]} خبرگزاری شماره {i}'
+            for i in range(rule_count)
+        ]
+        usernames = ['@donyaye_eqtesad', '@tasnimnews', '@isna_news', '@irna_1313', '@akhbarefori']
+        usernames += [f'@source_channel_{i}' for i in range(rule_count)]
+
+        pipeline = app.TransformPipeline(
+            app.DEFAULT_TRANSFORM_RULES['signatures']['*'] + signatures,
+            usernames,
+            new_username,
+            200
+        )
+        signature_patterns = [app.signature_to_pattern(signature) for signature in signatures]
+
+        # اطمینان از اینکه هر دو پیاده‌سازی خروجی یکسان دارند
+        for text in PERSIAN_NEWS_CORPUS:
+            expected = legacy_transform(text, signature_patterns, usernames, new_username)
+            assert pipeline.apply(text) == expected, f"خروجی متفاوت برای:\n{text}"
+
+        legacy_us = time_per_message(
+            lambda text: legacy_transform(text, signature_patterns, usernames, new_username),
+            PERSIAN_NEWS_CORPUS,
+            iterations
+        )
+        pipeline_us = time_per_message(pipeline.apply, PERSIAN_NEWS_CORPUS, iterations)
+        print(f"{rule_count:>8} | {legacy_us:>16.1f} | {pipeline_us:>22.1f} | {legacy_us / pipeline_us:>5.1f}x")
+
+def reword(text, seed):
+    """بازنویسی ساده یک خبر: تغییر حروف عربی/فارسی، نیم‌فاصله و جایگزینی یک کلمه"""
+    rng = random.Random(seed)
+    words = text.replace('ی', 'ي').replace('ک', 'ك').replace('\u200c', ' ').split()
+    words[rng.randrange(len(words))] = 'همچنین'
+    return ' '.join(words)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def synthetic_news(rng):
+    """خبر ساختگی از روی یک خبر نمونه: بخشی از کلمات (و امضای کانال) حفظ و بقیه با واژه‌های خبرهای دیگر جایگزین می‌شود
+
+    خبرهای یک روز واژه‌ها و امضای کانال مشترک دارند، بنابراین باندهای LSH آن‌ها مثل پنجره واقعی
+    با هم برخورد می‌کنند و کاندیداها باید با مقایسه امضا رد شوند.
+    """
+    overlap = rng.uniform(0.3, 0.7)
+    words = rng.choice(PERSIAN_NEWS_CORPUS).split()
+    return ' '.join(word if rng.random() < overlap else rng.choice(SYNTHETIC_WORDS) for word in words)
+
+def near_dup_candidates(index, signature):
+    """تعداد کاندیداهای LSH یک امضا (خبرهایی که در مرحله دوم find با امضای کامل مقایسه می‌شوند)"""
+    return len(index._candidates(signature))
+
+# خبر نرخ دلار، به‌روزرسانی آن توسط همان کانال و بازنویسی آن توسط کانال دیگر
+DOLLAR_RATE_NEWS = (
+    "نرخ دلار در بازار آزاد تهران امروز به ۵۸ هزار و ۳۰۰ تومان رسید. به گزارش خبرنگار اقتصادی، "
+    "قیمت دلار در معاملات امروز با افزایش ۴۰۰ تومانی همراه بود و معامله‌گران منتظر تصمیم بانک مرکزی هستند."
+)
+
+def check_near_dup_sources(threshold):
+    """به‌روزرسانی خبر توسط همان کانال منبع ارسال شود و بازنویسی آن توسط کانال دیگر تکراری باشد"""
+    index = app.NearDupIndex(3600, threshold)
+    update = DOLLAR_RATE_NEWS.replace('۵۸ هزار و ۳۰۰', '۵۸ هزار و ۷۰۰').replace('۴۰۰', '۸۰۰')
+    signatures = [app.minhash(app.tokenize_persian(text)) for text in (DOLLAR_RATE_NEWS, update, reword(DOLLAR_RATE_NEWS, 1))]
+    errors = []
+    if not index.claim(signatures[0], 1, 10, '@target'):
+        errors.append('خبر اول تکراری تشخیص داده شد')
+    if not index.claim(signatures[1], 1, 11, '@target'):
+        similarity = app.minhash_similarity(signatures[0], signatures[1])
+        errors.append(f'به‌روزرسانی خبر توسط همان کانال تکراری تشخیص داده شد (شباهت {similarity:.2f})')
+    if index.claim(signatures[2], 2, 50, '@target'):
+        errors.append('بازنویسی خبر توسط کانال دیگر تکراری تشخیص داده نشد')
+    return errors
+
+def run_near_dup_benchmark(entries, lookups, threshold, seed):
+    """زمان جستجوی خبر مشابه در NearDupIndex با تعداد مختلف خبر در پنجره
+
+    پنجره با خبرهای ساختگی مبتنی بر متن واقعی پر می‌شود. نیمی از جستجوها بازنویسی خبری از پنجره
+    (باید پیدا شود) و نیم دیگر خبر جدید (نباید پیدا شود) است.
+    """
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    for text in PERSIAN_NEWS_CORPUS:
+        app.minhash(app.tokenize_persian(text))
+    fingerprint_us = (time.perf_counter() - started) / len(PERSIAN_NEWS_CORPUS) * 1e6
+    print(f"🔑 محاسبه امضای MinHash: {fingerprint_us:.0f} µs/پیام")
+    errors = check_near_dup_sources(threshold)
+    for error in errors:
+        print(f"❌ {error}")
+    if not errors:
+        print("✅ به‌روزرسانی خبر توسط همان کانال ارسال و بازنویسی آن توسط کانال دیگر حذف شد")
+    print(f"{'خبر در پنجره':>12} | {'p50 (µs)':>9} | {'p99 (µs)':>9} | {'کاندیدا/جستجو':>13} | {'بازنویسی پیدا شد':>16} | {'مثبت کاذب':>9}")
+
+    index = app.NearDupIndex(3600, threshold, max_entries=entries)
+    texts = []
+    sizes = sorted({min(entries, size) for size in (1000, 10000, 100000, entries)})
+    for size in sizes:
+        while len(texts) < size:
+            texts.append(synthetic_news(rng))
+            index.add(app.minhash(app.tokenize_persian(texts[-1])), ('window', len(texts)))
+        reworded = [
+            app.minhash(app.tokenize_persian(reword(rng.choice(texts), rng.getrandbits(32))))
+            for _ in range(lookups // 2)
+        ]
+        fresh = [app.minhash(app.tokenize_persian(synthetic_news(rng))) for _ in range(lookups - len(reworded))]
+        timings = []
+        candidates = 0
+        results = []
+        for signature in reworded + fresh:
+            started = time.perf_counter()
+            results.append(index.find(signature))
+            timings.append((time.perf_counter() - started) * 1e6)
+            candidates += near_dup_candidates(index, signature)
+        found = sum(1 for key in results[:len(reworded)] if key is not None)
+        false_positives = sum(1 for key in results[len(reworded):] if key is not None)
+        print(f"{len(index):>12} | {percentile(timings, 0.5):>9.1f} | {percentile(timings, 0.99):>9.1f} | "
+              f"{candidates / len(timings):>13.1f} | {found:>9}/{len(reworded)} | {false_positives:>5}/{len(fresh)}")
+
+# کلمات فارسی برای ساخت کلمات کلیدی مصنوعی
+KEYWORD_WORDS = [
+    'دلار', 'بورس', 'تورم', 'بانک مرکزی', 'نفت', 'گاز', 'طلا', 'سکه', 'مسکن', 'خودرو', 'یارانه',
+    'مالیات', 'صادرات', 'واردات', 'قیمت', 'شاخص', 'سهام', 'ارز', 'بودجه', 'تعرفه', 'خرید فوری',
+    'تخفیف ویژه', 'سیگنال رایگان', 'عضویت', 'تبلیغات', 'پیشنهاد شگفت‌انگیز',
+]
+
+def synthetic_keyword_rules(pattern_count, rules_count, rng):
+    """قوانین مصنوعی drop و require با pattern_count کلمه کلیدی (عبارت‌های یک تا سه کلمه‌ای)"""
+    rules = [{'name': f'rule_{i}', 'action': 'require' if i % 2 else 'drop', 'keywords': []} for i in range(rules_count)]
+    for i in range(pattern_count):
+        phrase = ' '.join(rng.choice(KEYWORD_WORDS) for _ in range(rng.randint(1, 3)))
+        # بیشتر کلمات کلیدی در متن‌ها وجود ندارند (مثل قوانین واقعی)
+        keyword = phrase if i < len(KEYWORD_WORDS) else f'{phrase} {i}'
+        rules[i % rules_count]['keywords'].append(keyword)
+    return rules
+
+def run_keyword_benchmark(pattern_count, rules_count, iterations, seed):
+    """مقایسه automaton Aho-Corasick با یک regex جداگانه برای هر کلمه کلیدی"""
+    rng = random.Random(seed)
+    corpus = [app.normalize_for_keywords(text) for text in PERSIAN_NEWS_CORPUS]
+    print(f"📚 {len(corpus)} پست نمونه × {iterations} تکرار، {rules_count} قانون")
+    print(f"{'کلمات کلیدی':>12} | {'ساخت (ms)':>10} | {'regex جداگانه (µs/پیام)':>24} | {'Aho-Corasick (µs/پیام)':>23} | {'نسبت':>6}")
+
+    sizes = sorted({min(pattern_count, size) for size in (10, 100, 1000, pattern_count)})
+    for size in sizes:
+        rules = synthetic_keyword_rules(size, min(rules_count, size), rng)
+        started = time.perf_counter()
+        message_filter = app.MessageFilter(rules)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        patterns = [
+            (re.compile(re.escape(app.normalize_for_keywords(keyword))), rule_id)
+            for rule_id, rule in enumerate(rules) for keyword in rule['keywords']
+        ]
+
+        def regex_match(text):
+            text = app.normalize_for_keywords(text)
+            return {rule_id for pattern, rule_id in patterns if pattern.search(text)}
+
+        # اطمینان از اینکه هر دو روش قوانین یکسانی پیدا می‌کنند
+        for text in PERSIAN_NEWS_CORPUS:
+            assert message_filter.match(text) == regex_match(text), f"نتیجه متفاوت برای:\n{text}"
+
+        regex_us = time_per_message(regex_match, PERSIAN_NEWS_CORPUS, iterations)
+        automaton_us = time_per_message(message_filter.match, PERSIAN_NEWS_CORPUS, iterations)
+        print(f"{size:>12} | {build_ms:>10.1f} | {regex_us:>24.1f} | {automaton_us:>23.1f} | {regex_us / automaton_us:>5.1f}x")
+
+class FakeMessage:
+    """پیام جعلی با همان ویژگی‌هایی که ربات از پیام Telethon استفاده می‌کند"""
+
+    def __init__(self, message_id, text='', media=None, grouped_id=None, date=None):
+        self.id = message_id
+        self.text = text
+        self.raw_text = text
+        self.media = media
+        self.grouped_id = grouped_id
+        self.out = False
+        self.date = date or datetime.now(timezone.utc)
+
+class FakeEvent:
+    """event جعلی NewMessage"""
+
+    def __init__(self, channel, message):
+        self.chat = channel
+        self.chat_id = utils.get_peer_id(channel)
+        self.message = message
+
+    async def get_chat(self):
+        return self.chat
+
+class FakeTelegramClient:
+    """جایگزین درون‌برنامه‌ای TelegramClient برای اجرای ربات بدون حساب واقعی
+
+    send_latency و fetch_latency حداکثر تأخیر تصادفی هر ارسال و هر دریافت (ثانیه) هستند و
+    هر ارسال با احتمال flood_rate با FloodWaitError به مدت flood_seconds رد می‌شود.
+    """
+
+    def __init__(self, send_latency=0.0, fetch_latency=0.0, flood_rate=0.0, flood_seconds=1):
+        self.send_latency = send_latency
+        self.fetch_latency = fetch_latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.channels = {}  # peer_id -> (entity, [messages])
+        self.usernames = {}  # username -> peer_id
+        self.sent = []  # (target, text یا caption ها, media)
+        self.sent_at = []  # زمان (time.monotonic) هر ارسال در sent
+        self.flood_waits = 0
+        self.fetches = 0  # تعداد درخواست‌های دریافت (get_entity، get_messages و iter_messages)
+        self.edited = []  # (target، شناسه پیام، متن جدید)
+        self.deleted = []  # (target، شناسه پیام‌ها)
+
+    def add_channel(self, username, channel_id):
+        """ساخت یک کانال منبع جعلی"""
+        entity = types.Channel(
+            id=channel_id,
+            title=username,
+            photo=types.ChatPhotoEmpty(),
+            date=datetime.now(timezone.utc),
+            access_hash=channel_id * 7,
+            username=username.lstrip('@')
+        )
+        peer_id = utils.get_peer_id(entity)
+        self.channels[peer_id] = (entity, [])
+        self.usernames[username.lstrip('@').lower()] = peer_id
+        return entity
+
+    def post(self, entity, text='', media=None, grouped_id=None):
+        """انتشار یک پیام جدید در کانال جعلی"""
+        messages = self.channels[utils.get_peer_id(entity)][1]
+        message = FakeMessage(len(messages) + 1, text, media, grouped_id)
+        messages.append(message)
+        return message
+
+    def _channel(self, entity):
+        if isinstance(entity, str):
+            return self.channels[self.usernames[entity.lstrip('@').lower()]]
+        return self.channels[app.get_canonical_chat_id(entity)]
+
+    async def _simulate_fetch(self):
+        self.fetches += 1
+        await asyncio.sleep(random.uniform(0, self.fetch_latency) if self.fetch_latency else 0)
+
+    async def get_entity(self, key):
+        await self._simulate_fetch()
+        return self._channel(key)[0]
+
+    async def get_messages(self, entity, limit=None, ids=None):
+        await self._simulate_fetch()
+        messages = self._channel(entity)[1]
+        if ids is not None:
+            return [messages[i - 1] if 0 < i <= len(messages) else None for i in ids]
+        return list(reversed(messages))[:limit]
+
+    async def iter_messages(self, entity, limit=None, min_id=0, max_id=0, reverse=False, wait_time=None, offset_date=None):
+        messages = self._channel(entity)[1]
+        selected = [m for m in messages if m.id > min_id and (not max_id or m.id < max_id)
+                    and (offset_date is None or m.date > offset_date)]
+        if not reverse:
+            selected.reverse()
+        await self._simulate_fetch()
+        for message in selected[:limit]:
+            await asyncio.sleep(0)
+            yield message
+
+    async def _simulate_send(self):
+        await asyncio.sleep(random.uniform(0, self.send_latency) if self.send_latency else 0)
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+    async def send_message(self, target, text, **kwargs):
+        await self._simulate_send()
+        self.sent.append((target, text, None))
+        self.sent_at.append(time.monotonic())
+        return FakeMessage(len(self.sent), text)
+
+    async def edit_message(self, target, message_id, text=None, **kwargs):
+        await self._simulate_send()
+        self.edited.append((target, message_id, text))
+
+    async def delete_messages(self, target, message_ids, **kwargs):
+        await self._simulate_send()
+        self.deleted.append((target, list(message_ids)))
+
+    async def send_file(self, target, file, caption=None, **kwargs):
+        await self._simulate_send()
+        self.sent.append((target, caption, file))
+        self.sent_at.append(time.monotonic())
+        # پیام ارسال شده در کانال هدف (برای کش ارجاع رسانه‌ها)
+        if isinstance(file, list):
+            return [FakeMessage(len(self.sent), '', media) for media in file]
+        return FakeMessage(len(self.sent), caption or '', file)
+
+def reset_bot_state(source_channels):
+    """شروع هر سناریو با وضعیت خالی ربات"""
+    app.SOURCE_CHANNELS = list(source_channels)
+    app.checkpoint_store = app.CheckpointStore(os.path.join(tempfile.mkdtemp(dir=BENCHMARK_DIR), 'bot_state.db'))
+    app.entity_cache = app.EntityCache(os.path.join(BENCHMARK_DIR, f'entity_cache_{time.time_ns()}.json'), 3600)
+    app.channel_locks.clear()
+    app.catch_up_locks.clear()
+    app.gap_catch_up_times.clear()
+    app.outbox = None
+    app.message_map = None
+    app.near_dup_index = app.NearDupIndex(3600, app.NEAR_DUP_THRESHOLD)
+    app.dedup_index = app.DedupIndex(os.path.join(BENCHMARK_DIR, f'dedup_index_{time.time_ns()}.json'), 3600, 100000)
+    app.media_cache = app.MediaCache(os.path.join(BENCHMARK_DIR, f'media_cache_{time.time_ns()}.json'), 10000)
+    app.outbox_workers.clear()
+    app.outbox_wakeups.clear()
+    app.poll_scheduler = None
+
+async def wait_for_outbox_drain(timeout=60):
+    """صبر تا ارسال همه پیام‌های outbox"""
+    deadline = time.monotonic() + timeout
+    while app.get_outbox().pending_count() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+async def run_stress_scenario(channel_count, message_count, poll_rounds, seed):
+    """ارسال همزمان event و بررسی دوره‌ای برای ID های یکسان و بررسی ارسال دقیقاً یک بار و به ترتیب"""
+    random.seed(seed)
+    client = FakeTelegramClient(send_latency=0.002)
+    channels = [client.add_channel(f'@stress_source_{i}', 1000 + i) for i in range(channel_count)]
+    reset_bot_state([f'@{channel.username}' for channel in channels])
+
+    # اولین پیام هر کانال checkpoint اولیه است و ارسال نمی‌شود
+    for channel in channels:
+        first = client.post(channel, 'start')
+        app.get_checkpoint_store().advance(utils.get_peer_id(channel), first.id)
+
+    events = []
+    for channel in channels:
+        for _ in range(message_count):
+            message = client.post(channel)
+            message.text = message.raw_text = f'{channel.username}:{message.id}'
+            events.append(FakeEvent(channel, message))
+    # event ها با ترتیب تصادفی و تأخیر تصادفی می‌رسند (مثل شبکه واقعی)
+    random.shuffle(events)
+
+    async def deliver(event):
+        await asyncio.sleep(random.uniform(0, 0.05))
+        await app.handle_new_message(client, event)
+
+    async def poll():
+        for _ in range(poll_rounds):
+            await asyncio.sleep(random.uniform(0, 0.05))
+            await app.check_new_messages(client)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(deliver(event) for event in events), *(poll() for _ in range(3)))
+    # فاصله‌هایی که event handler به دلیل GAP_CATCHUP_MIN_INTERVAL دریافت نکرده با بررسی دوره‌ای بعدی پر می‌شوند
+    for _ in range(message_count // app.CATCHUP_MAX_MESSAGES + 2):
+        if all(app.get_checkpoint_store().get(utils.get_peer_id(channel)) >= message_count + 1 for channel in channels):
+            break
+        await app.check_new_messages(client)
+    await wait_for_outbox_drain()
+    elapsed = time.perf_counter() - started
+
+    # بررسی ارسال دقیقاً یک بار و به ترتیب برای هر کانال
+    sent_by_channel = {}
+    for _, text, _ in client.sent:
+        username, message_id = text.rsplit(':', 1)
+        sent_by_channel.setdefault(username, []).append(int(message_id))
+    errors = []
+    for channel in channels:
+        expected = list(range(2, message_count + 2))
+        actual = sent_by_channel.get(channel.username, [])
+        if actual != expected:
+            errors.append(f"{channel.username}: {len(actual)} ارسال، مورد انتظار {len(expected)} (به ترتیب)")
+    return elapsed, len(client.sent), client.fetches, errors
+
+def run_stress_benchmark(channel_count, message_count, poll_rounds, seed):
+    """اجرای سناریوی stress و گزارش نتیجه"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed, sent_count, fetches, errors = asyncio.run(
+            run_stress_scenario(channel_count, message_count, poll_rounds, seed)
+        )
+    print(f"📨 {channel_count} کانال × {message_count} پیام، event و بررسی دوره‌ای همزمان")
+    print(f"⏱️ {elapsed:.2f} ثانیه، {sent_count} ارسال ({sent_count / elapsed:.0f} پیام در ثانیه)")
+    print(f"🔍 {fetches} درخواست دریافت (GAP_CATCHUP_MIN_INTERVAL={app.GAP_CATCHUP_MIN_INTERVAL:g})")
+    if errors:
+        for error in errors:
+            print(f"❌ {error}")
+        raise SystemExit(1)
+    print("✅ همه پیام‌ها دقیقاً یک بار و به ترتیب هر کانال ارسال شدند")
+
+# واژه‌های متن‌های مصنوعی؛ هر پیام ترکیب تصادفی متفاوتی دارد تا تکراری تشخیص داده نشود
+SYNTHETIC_WORDS = sorted({word for text in PERSIAN_NEWS_CORPUS for word in re.findall(r'\w+', text) if len(word) > 2})
+MESSAGE_MARKER_PATTERN = re.compile(r'#m(\d+)_(\d+)')
+
+def synthetic_text(rng, channel_index, message_id, word_count):
+    words = ' '.join(rng.choice(SYNTHETIC_WORDS) + str(rng.randrange(1000)) for _ in range(word_count))
+    return f'{words}\n#m{channel_index}_{message_id}'
+
+def synthetic_photo(rng):
+    photo = types.Photo(
+        id=rng.getrandbits(62), access_hash=0, file_reference=b'',
+        date=datetime.now(timezone.utc), sizes=[], dc_id=1
+    )
+    return types.MessageMediaPhoto(photo=photo)
+
+async def produce_channel(client, channel, channel_index, rate, duration, rng, deliver, posted):
+    """انتشار پیام‌های مصنوعی (متن، عکس، آلبوم و لینک) با نرخ ثابت در یک کانال جعلی"""
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        await asyncio.sleep(rng.expovariate(rate))
+        kind = rng.choices(('text', 'photo', 'album', 'webpage'), weights=(50, 25, 10, 15))[0]
+        next_id = len(client.channels[utils.get_peer_id(channel)][1]) + 1
+        if kind == 'album':
+            grouped_id = rng.getrandbits(62)
+            parts = [
+                client.post(channel, synthetic_text(rng, channel_index, next_id, 30) if i == 0 else '',
+                            synthetic_photo(rng), grouped_id)
+                for i in range(rng.randint(2, 5))
+            ]
+        elif kind == 'photo':
+            parts = [client.post(channel, synthetic_text(rng, channel_index, next_id, 40), synthetic_photo(rng))]
+        elif kind == 'webpage':
+            webpage = types.MessageMediaWebPage(webpage=types.WebPageEmpty(id=rng.getrandbits(62)))
+            parts = [client.post(channel, synthetic_text(rng, channel_index, next_id, 20) + '\nhttps://example.com', webpage)]
+        else:
+            parts = [client.post(channel, synthetic_text(rng, channel_index, next_id, rng.randint(20, 120)))]
+        posted[(channel_index, parts[0].id)] = (time.monotonic(), kind)
+        for part in parts:
+            asyncio.ensure_future(deliver(FakeEvent(channel, part)))
+
+async def run_pipeline_scenario(channel_count, rate, duration, poll_interval, send_latency,
+                                fetch_latency, flood_rate, event_loss, seed, adaptive=False):
+    """اجرای کل مسیر ربات (handler، بررسی دوره‌ای و outbox) روی کانال‌های مصنوعی"""
+    rng = random.Random(seed)
+    random.seed(seed)
+    client = FakeTelegramClient(send_latency, fetch_latency, flood_rate)
+    channels = [client.add_channel(f'@pipeline_source_{i}', 2000 + i) for i in range(channel_count)]
+    reset_bot_state([f'@{channel.username}' for channel in channels])
+    for channel in channels:
+        first = client.post(channel, 'start')
+        app.get_checkpoint_store().advance(utils.get_peer_id(channel), first.id)
+
+    async def deliver(event):
+        # بخشی از event ها از دست می‌روند و فقط با بررسی دوره‌ای (یا پر کردن فاصله) ارسال می‌شوند
+        await asyncio.sleep(rng.uniform(0, 0.05))
+        if rng.random() >= event_loss:
+            with app.handler_seconds.time():
+                await app.handle_new_message(client, event)
+
+    async def poll(stop):
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                await app.check_new_messages(client)
+
+    posted = {}
+    stop = asyncio.Event()
+    if adaptive:
+        # بررسی دوره‌ای تطبیقی خود ربات با فاصله بین poll_interval و 8 برابر آن
+        app.poll_scheduler = app.PollScheduler(
+            app.SOURCE_CHANNELS, poll_interval, poll_interval * 8, app.POLL_BACKOFF_FACTOR
+        )
+        poller = asyncio.ensure_future(app.periodic_check(client, tick_seconds=poll_interval))
+    else:
+        poller = asyncio.ensure_future(poll(stop))
+    started = time.monotonic()
+    await asyncio.gather(*(
+        produce_channel(client, channel, index, rate, duration, rng, deliver, posted)
+        for index, channel in enumerate(channels)
+    ))
+    # پیام‌هایی که event آن‌ها از دست رفته با یک دور بررسی نهایی دریافت می‌شوند
+    await asyncio.sleep(0.1)
+    await app.check_new_messages(client)
+    await wait_for_outbox_drain(timeout=120)
+    elapsed = time.monotonic() - started
+    fetches = client.fetches
+    stop.set()
+    if adaptive:
+        poller.cancel()
+    await poller
+
+    latencies = {}
+    published = set()
+    for (_, text, _), sent_at in zip(client.sent, client.sent_at):
+        captions = text if isinstance(text, list) else [text or '']
+        for caption in captions:
+            match = MESSAGE_MARKER_PATTERN.search(caption or '')
+            if match:
+                key = (int(match.group(1)), int(match.group(2)))
+                if key in posted and key not in published:
+                    published.add(key)
+                    posted_at, kind = posted[key]
+                    latencies.setdefault(kind, []).append(sent_at - posted_at)
+    missing = len(posted) - len(published)
+    return elapsed, len(posted), latencies, missing, client.flood_waits, fetches
+
+def peak_memory_mb():
+    """حداکثر حافظه مصرف شده پروسه (MB)"""
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_pipeline_benchmark(channel_count, rate, duration, poll_interval, send_latency,
+                           fetch_latency, flood_rate, event_loss, seed, adaptive=False):
+    """اجرای سناریوی کامل و گزارش توان عملیاتی، تأخیر، تعداد درخواست‌های دریافت و حافظه"""
+    memory_before = peak_memory_mb()
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed, posted_count, latencies, missing, flood_waits, fetches = asyncio.run(run_pipeline_scenario(
+            channel_count, rate, duration, poll_interval, send_latency,
+            fetch_latency, flood_rate, event_loss, seed, adaptive
+        ))
+    print(f"📨 {channel_count} کانال × {rate} پیام در ثانیه به مدت {duration} ثانیه "
+          f"(از دست رفتن event: {event_loss:.0%}، FloodWait: {flood_rate:.1%})")
+    print(f"⏱️ {posted_count} پیام در {elapsed:.1f} ثانیه ({posted_count / elapsed:.1f} پیام در ثانیه)، {flood_waits} FloodWait")
+    print(f"🔍 {fetches} درخواست دریافت ({'بررسی دوره‌ای تطبیقی' if adaptive else f'بررسی هر {poll_interval} ثانیه'})")
+    print(f"{'نوع':>8} | {'تعداد':>6} | {'p50 (ms)':>9} | {'p99 (ms)':>9}")
+    all_latencies = []
+    for kind in ('text', 'photo', 'album', 'webpage'):
+        values = latencies.get(kind, [])
+        all_latencies.extend(values)
+        if values:
+            print(f"{kind:>8} | {len(values):>6} | {percentile(values, 0.5) * 1000:>9.1f} | {percentile(values, 0.99) * 1000:>9.1f}")
+    if all_latencies:
+        print(f"{'همه':>8} | {len(all_latencies):>6} | {percentile(all_latencies, 0.5) * 1000:>9.1f} | "
+              f"{percentile(all_latencies, 0.99) * 1000:>9.1f}")
+    print(f"💾 حداکثر حافظه: {peak_memory_mb():.1f} MB (قبل از اجرا: {memory_before:.1f} MB)")
+    if missing:
+        print(f"❌ {missing} پیام ارسال نشد")
+        raise SystemExit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark های ربات')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    transform_parser = subparsers.add_parser('transform', help='زنجیره تبدیل متن')
+    transform_parser.add_argument('--iterations', type=int, default=500)
+    transform_parser.add_argument('--extra-rules', type=int, default=40)
+
+    stress_parser = subparsers.add_parser('stress', help='ارسال دقیقاً یک بار با event و بررسی دوره‌ای همزمان')
+    stress_parser.add_argument('--channels', type=int, default=5)
+    stress_parser.add_argument('--messages', type=int, default=200)
+    stress_parser.add_argument('--poll-rounds', type=int, default=5)
+    stress_parser.add_argument('--seed', type=int, default=1)
+
+    near_dup_parser = subparsers.add_parser('neardup', help='جستجوی خبر مشابه در شاخص LSH')
+    near_dup_parser.add_argument('--entries', type=int, default=100000)
+    near_dup_parser.add_argument('--lookups', type=int, default=2000)
+    near_dup_parser.add_argument('--threshold', type=float, default=app.NEAR_DUP_THRESHOLD)
+    near_dup_parser.add_argument('--seed', type=int, default=1)
+
+    keyword_parser = subparsers.add_parser('keywords', help='تطبیق کلمات کلیدی قوانین فیلتر')
+    keyword_parser.add_argument('--patterns', type=int, default=2000)
+    keyword_parser.add_argument('--rules', type=int, default=200)
+    keyword_parser.add_argument('--iterations', type=int, default=200)
+    keyword_parser.add_argument('--seed', type=int, default=1)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='کل مسیر ربات روی کانال‌های مصنوعی با کلاینت جعلی')
+    pipeline_parser.add_argument('--channels', type=int, default=5)
+    pipeline_parser.add_argument('--rate', type=float, default=2, help='پیام در ثانیه برای هر کانال')
+    pipeline_parser.add_argument('--duration', type=float, default=20)
+    pipeline_parser.add_argument('--poll-interval', type=float, default=5)
+    pipeline_parser.add_argument('--send-latency', type=float, default=0.2)
+    pipeline_parser.add_argument('--fetch-latency', type=float, default=0.1)
+    pipeline_parser.add_argument('--flood-rate', type=float, default=0.0)
+    pipeline_parser.add_argument('--event-loss', type=float, default=0.05)
+    pipeline_parser.add_argument('--seed', type=int, default=1)
+    pipeline_parser.add_argument('--adaptive', action='store_true', help='بررسی دوره‌ای تطبیقی به جای فاصله ثابت')
+
+    args = parser.parse_args()
+    if args.command == 'transform':
+        run_transform_benchmark(args.iterations, args.extra_rules)
+    elif args.command == 'stress':
+        run_stress_benchmark(args.channels, args.messages, args.poll_rounds, args.seed)
+    elif args.command == 'neardup':
+        run_near_dup_benchmark(args.entries, args.lookups, args.threshold, args.seed)
+    elif args.command == 'keywords':
+        run_keyword_benchmark(args.patterns, args.rules, args.iterations, args.seed)
+    elif args.command == 'pipeline':
+        run_pipeline_benchmark(
+            args.channels, args.rate, args.duration, args.poll_interval, args.send_latency,
+            args.fetch_latency, args.flood_rate, args.event_loss, args.seed, args.adaptive
+        )
+
+if __name__ == '__main__':
+    main()